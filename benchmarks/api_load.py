@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+HTTP load against the service on the simulated backend.
+
+Starts the service as `run` does, every loop, the interlock, the
+supervisor and the API as configured (in process or `[api] process`), in
+real time against a `SimulatedChamber` and `SimulatedGPIO`. For every
+load level, that many client processes poll the API in a closed loop with
+the given endpoint mix while the benchmark records:
+
+- request throughput and latency percentiles, overall and per endpoint
+- the period of the sensor and the pressure control loop (jitter)
+- the actuation latency, from a PUT /pump/on|off of a probe client until
+  the pump pin changes
+
+Level 0 is the unloaded baseline. Admission control is disabled unless
+`--admission` is given, so the load reaches the handlers. The result is
+printed as JSON, to be diffed between releases.
+
+The clients need httpx, see benchmarks/requirements.txt.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/api_load.py
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+
+from pmpctrl.__main__ import Settings
+from pmpctrl.__main__ import apply_config
+from pmpctrl.__main__ import init_actuator_journal
+from pmpctrl.__main__ import init_api
+from pmpctrl.__main__ import init_auto_setpoint
+from pmpctrl.__main__ import init_interlock
+from pmpctrl.__main__ import init_local_server
+from pmpctrl.__main__ import init_pressure_control
+from pmpctrl.__main__ import init_pressure_sensore
+from pmpctrl.__main__ import init_profiler
+from pmpctrl.__main__ import init_pump_control
+from pmpctrl.__main__ import init_session_control
+from pmpctrl.__main__ import init_session_recorder
+from pmpctrl.__main__ import init_state_checkpoint
+from pmpctrl.__main__ import init_supervisor
+from pmpctrl.__main__ import init_trace_capture
+from pmpctrl.__main__ import init_valve_control
+from pmpctrl.__main__ import read_config
+from pmpctrl.__main__ import stop_service
+from pmpctrl.__main__ import wait_for_api
+from pmpctrl.__main__ import wait_for_first_sample
+from pmpctrl.control_data import ControlData
+from pmpctrl.simulation import SimulatedChamber
+from pmpctrl.simulation import SimulatedGPIO
+from pmpctrl.trace_capture import CommandCapture
+from statistics import pstdev
+from tempfile import TemporaryDirectory
+from time import monotonic
+from time import monotonic_ns
+from time import sleep
+
+MIX_DEFAULT = 'GET /=4,GET /pressure=4,PUT /pressure/target=1,PUT /mode=1'
+# bodies of the PUT endpoints, chosen to leave the state unchanged
+BODIES = {
+    '/pressure/target': {},
+    '/mode': { 'mode': 'hold' },
+    '/pressure/setpoint': { 'auto_setpoint': False },
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', help='config file, defaults of Settings if omitted')
+    parser.add_argument('-l', '--levels', help='comma separated numbers of concurrent clients', default='0,1,4,16')
+    parser.add_argument('-d', '--duration', help='seconds per load level', type=float, default=10.0)
+    parser.add_argument('-i', '--interval', help='pause between requests of a client in seconds, 0 for none',
+                        type=float, default=0.0)
+    parser.add_argument('-m', '--mix', help='endpoint mix as "METHOD /path=weight,..."', default=MIX_DEFAULT)
+    parser.add_argument('-p', '--port', help='API port, a free one if omitted', type=int)
+    parser.add_argument('--probe-interval', help='seconds between pump actuations of the probe',
+                        type=float, default=0.5)
+    parser.add_argument('--admission', help='keep the admission control limits of the config',
+                        action='store_true')
+    return parser.parse_args()
+
+
+def parse_mix(mix: str) -> list:
+    endpoints = []
+    for item in mix.split(','):
+        endpoint, _, weight = item.strip().rpartition('=')
+        method, path = endpoint.split()
+        endpoints.append((method.upper(), path, int(weight)))
+    return endpoints
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values: list, scale: float=1.0) -> dict:
+    if not values:
+        return None
+    values = sorted(values)
+    def at(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))] * scale
+    return {
+        'count': len(values),
+        'p50': at(0.50),
+        'p90': at(0.90),
+        'p99': at(0.99),
+        'max': values[-1] * scale,
+    }
+
+
+def client(url: str, endpoints: list, interval: float, start: float, duration: float, results):
+    """Load client process, polls `endpoints` until start + duration."""
+    import httpx
+    from random import Random
+
+    random = Random(os.getpid())
+    weights = [weight for _, _, weight in endpoints]
+    latencies = {}
+    statuses = {}
+    with httpx.Client(base_url=url, timeout=10.0) as http:
+        while monotonic() < start:
+            sleep(0.001)
+        while monotonic() < start + duration:
+            method, path, _ = random.choices(endpoints, weights)[0]
+            time_start = monotonic_ns()
+            try:
+                if method == 'GET':
+                    status = http.get(path).status_code
+                else:
+                    status = http.request(method, path, json=BODIES.get(path)).status_code
+            except httpx.HTTPError as e:
+                status = e.__class__.__name__
+            latencies.setdefault(f'{method} {path}', []).append(monotonic_ns() - time_start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if interval:
+                sleep(interval)
+    results.put((latencies, statuses))
+
+
+def probe(url: str, interval: float, start: float, duration: float, results):
+    """Probe process, switches the pump on and off and notes when it asked to."""
+    import httpx
+
+    requests = []
+    with httpx.Client(base_url=url, timeout=10.0) as http:
+        while monotonic() < start:
+            sleep(0.001)
+        on = True
+        while monotonic() < start + duration - interval:
+            time_request = monotonic_ns()
+            response = http.put('/pump/on' if on else '/pump/off')
+            if response.status_code < 300:
+                requests.append((time_request, on))
+                on = not on
+            sleep(interval)
+        if not on:
+            http.put('/pump/off')
+    results.put(requests)
+
+
+class Service:
+    """
+    The service wired by the init functions of `pmpctrl.__main__` in the
+    order of `run`, on a SimulatedChamber and SimulatedGPIO.
+    """
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.control_data = ControlData()
+        self.control_data.event_run.set()
+        apply_config(self.control_data, settings)
+        self.chamber = SimulatedChamber(seed=0)
+        self.gpio = SimulatedGPIO(self.chamber,
+                                  pin_pump=settings.PUMP_CONTROL_PIN_NUMBER,
+                                  pin_valve=settings.VALVE_CONTROL_PIN_NUMBER)
+        self.sensor_steps = []
+        self.control_steps = []
+        self.pump_edges = []
+        self._instrument_gpio()
+
+        control_data = self.control_data
+        workers = self.workers = {}
+        init_actuator_journal(control_data, settings)
+        init_state_checkpoint(control_data, settings)
+        trace_capture = init_trace_capture(control_data, settings)
+        commands = control_data
+        if trace_capture is not None:
+            workers['trace_capture'] = trace_capture
+            commands = CommandCapture(control_data, trace_capture)
+        workers['pump_control'], pump_control = init_pump_control(control_data, settings, self.gpio)
+        workers['valve_control'], valve_control = init_valve_control(control_data, settings, self.gpio)
+        interlock = init_interlock(control_data, settings, workers['pump_control'], workers['valve_control'])
+        if interlock is not None:
+            workers['interlock'] = interlock
+        workers['pressure_sensor'], pressure_sensor = init_pressure_sensore(control_data, settings, interlock,
+                                                                            smbus_factory=self.chamber.open_smbus,
+                                                                            bmp280_factory=self.chamber.open_bmp280)
+        workers['pressure_control'], pressure_control = init_pressure_control(control_data, settings)
+        workers['session_control'], session_control = init_session_control(control_data, settings)
+        if wait_for_first_sample(control_data) is None:
+            raise TimeoutError('no pressure sample')
+
+        workers['auto_setpoint'], auto_setpoint = init_auto_setpoint(control_data)
+        session_recorder, session_recorder_thread = init_session_recorder(control_data, settings)
+        if session_recorder is not None:
+            workers['session_recorder'] = session_recorder
+        profiler = init_profiler(control_data, settings)
+        if profiler is not None:
+            workers['profiler'] = profiler
+        threads = {
+            'pump_control' : pump_control,
+            'valve_control' : valve_control,
+            'pressure_sensor' : pressure_sensor,
+            'pressure_control' : pressure_control,
+            'session_control' : session_control,
+            'auto_setpoint' : auto_setpoint
+        }
+        if session_recorder_thread is not None:
+            threads['session_recorder'] = session_recorder_thread
+        workers['supervisor'], self._supervisor_thread = init_supervisor(control_data, settings, workers, threads)
+        self.api_server, self._api_server_thread = init_api(commands, settings)
+        self.local_server, self._local_server_thread = init_local_server(commands, settings)
+        if wait_for_api(self.api_server, timeout=30.0) is None:
+            raise TimeoutError('API did not start')
+        # the loops look up step on every cycle, the instance attribute wins
+        workers['pressure_sensor'].step = self._instrument(workers['pressure_sensor'].step, self.sensor_steps)
+        workers['pressure_control'].step = self._instrument(workers['pressure_control'].step, self.control_steps)
+
+    @staticmethod
+    def _instrument(step, times: list):
+        def instrumented(*args, **kwargs):
+            times.append(monotonic_ns())
+            return step(*args, **kwargs)
+        return instrumented
+
+    def _instrument_gpio(self):
+        output = self.gpio.output
+        pin_pump = self.settings.PUMP_CONTROL_PIN_NUMBER
+        levels = {}
+        def instrumented(pin: int, level: int):
+            if pin == pin_pump and levels.get(pin) != bool(level):
+                self.pump_edges.append((monotonic_ns(), bool(level)))
+            levels[pin] = bool(level)
+            output(pin, level)
+        self.gpio.output = instrumented
+
+    def reset(self):
+        self.sensor_steps.clear()
+        self.control_steps.clear()
+        self.pump_edges.clear()
+
+    def stop(self):
+        stop_service(self.control_data, self.settings, self.workers, self._supervisor_thread,
+                     self.api_server, self._api_server_thread, self.local_server, self._local_server_thread)
+
+
+def periods(times: list, cycle_time: float) -> dict:
+    deltas = [(b - a) / 1e9 for a, b in zip(times, times[1:])]
+    result = percentiles(deltas)
+    if result is None:
+        return None
+    result['cycle_time'] = cycle_time
+    result['stdev'] = pstdev(deltas)
+    result['late_2x'] = sum(1 for delta in deltas if delta > 2 * cycle_time)
+    return result
+
+
+def actuation_latencies(requests: list, edges: list) -> list:
+    latencies = []
+    for time_request, on in requests:
+        for time_edge, level in edges:
+            if time_edge >= time_request and level == on:
+                latencies.append((time_edge - time_request) / 1e9)
+                break
+    return latencies
+
+
+def run_level(service: Service, url: str, clients: int, args, endpoints: list) -> dict:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    # spawned clients import httpx first, start all of them together
+    start = monotonic() + 2.0 + 0.3 * clients
+    processes = [context.Process(target=client, args=(url, endpoints, args.interval, start, args.duration, results))
+                 for _ in range(clients)]
+    processes.append(context.Process(target=probe, args=(url, args.probe_interval, start, args.duration, results)))
+    for process in processes:
+        process.start()
+    while monotonic() < start:
+        sleep(0.01)
+    service.reset()
+    sleep(args.duration)
+    sensor_steps = list(service.sensor_steps)
+    control_steps = list(service.control_steps)
+
+    latencies = {}
+    statuses = {}
+    requests = []
+    for _ in processes:
+        result = results.get()
+        if isinstance(result, list):
+            requests = result
+            continue
+        for endpoint, values in result[0].items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for status, count in result[1].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    for process in processes:
+        process.join()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'clients': clients,
+        'requests': len(all_latencies),
+        'throughput': len(all_latencies) / args.duration,
+        'statuses': statuses,
+        'latency': percentiles(all_latencies, 1e-9),
+        'latency_endpoints': { endpoint: percentiles(values, 1e-9) for endpoint, values in latencies.items() },
+        'sensor_period': periods(sensor_steps, service.settings.PRESSURE_SENSOR_CYCLE_TIME),
+        'control_period': periods(control_steps, service.settings.PRESSURE_CONTROL_CYCLE_TIME),
+        'actuation_latency': percentiles(actuation_latencies(requests, list(service.pump_edges))),
+    }
+
+
+def main():
+    args = parse_arguments()
+    endpoints = parse_mix(args.mix)
+    settings = read_config(args.config) if args.config else Settings()
+    settings.LOG_LEVEL = logging.WARNING
+    settings.API_PORT = args.port or free_port()
+    if not args.admission:
+        settings.API_RATE_LIMIT = 0
+        settings.API_CONCURRENCY_MAX = 0
+    levels = []
+    with TemporaryDirectory() as directory:
+        # the files of the benchmark apart from the real ones, those turned off stay off
+        for name in ('JOURNAL_ACTUATOR_FILE', 'CHECKPOINT_FILE', 'PRESSURE_SENSOR_SETPOINT_FILE',
+                     'RECORDER_DIRECTORY', 'CAPTURE_DIRECTORY', 'API_UNIX_SOCKET'):
+            if getattr(settings, name):
+                setattr(settings, name, os.path.join(directory, os.path.basename(getattr(settings, name))))
+        service = Service(settings)
+        url = f'http://127.0.0.1:{settings.API_PORT}'
+        try:
+            for clients in (int(level) for level in args.levels.split(',')):
+                levels.append(run_level(service, url, clients, args, endpoints))
+        finally:
+            service.stop()
+
+    result = {
+        'duration': args.duration,
+        'interval': args.interval,
+        'mix': args.mix,
+        'api_process': settings.API_PROCESS,
+        'api_workers': settings.API_WORKERS if settings.API_PROCESS else 1,
+        'admission': args.admission,
+        'cpus': os.cpu_count(),
+        'levels': levels,
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
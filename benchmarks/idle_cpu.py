@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+CPU usage of the idle service, with and without the idle rate policy.
+
+Runs the control threads (sensor, pressure, pump, valve and session control
+plus AutoSetpoint) in real time against a `SimulatedChamber` without a
+session, once with `IDLE_DELAY` 0 (always full rate, the behaviour before
+the policy) and once with the policy enabled. After the idle delay has
+passed, the CPU time of the process and the sample rate are measured for
+`--duration` seconds. Then a session is started and the time until the next
+sample and until the sensor is back at its full rate is reported.
+
+Every configuration runs in its own process, as ControlData is a singleton.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/idle_cpu.py
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+from pmpctrl.__main__ import Settings
+from pmpctrl.__main__ import apply_config
+from pmpctrl.auto_setpoint import AutoSetpoint
+from pmpctrl.control_data import ControlData
+from pmpctrl.pressure_control import PressureControl
+from pmpctrl.pressure_sensor import PressureSensor
+from pmpctrl.pump_control import PumpControl
+from pmpctrl.session_control import SessionControl
+from pmpctrl.simulation import SimulatedChamber
+from pmpctrl.simulation import SimulatedGPIO
+from pmpctrl.valve_control import ValveControl
+from threading import Thread
+from time import monotonic_ns
+from time import process_time
+from time import sleep
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', help='seconds of idle measured', type=float, default=20.0)
+    parser.add_argument('--idle-delay', help='IDLE_DELAY of the run with the policy', type=float, default=2.0)
+    return parser.parse_args()
+
+
+def measure(idle_delay: float, duration: float, results):
+    settings = Settings()
+    settings.LOG_LEVEL = logging.WARNING
+    settings.IDLE_DELAY = idle_delay
+    control_data = ControlData()
+    control_data.event_run.set()
+    apply_config(control_data, settings)
+    control_data.event_auto_setpoint.set()
+    chamber = SimulatedChamber(seed=0)
+    gpio = SimulatedGPIO(chamber, pin_pump=settings.PUMP_CONTROL_PIN_NUMBER, pin_valve=settings.VALVE_CONTROL_PIN_NUMBER)
+    workers = [
+        PressureSensor(control_data=control_data,
+                       cycle_time=settings.PRESSURE_SENSOR_CYCLE_TIME,
+                       smbus_factory=chamber.open_smbus,
+                       bmp280_factory=chamber.open_bmp280,
+                       idle_delay=settings.IDLE_DELAY,
+                       idle_cycle_time=settings.IDLE_CYCLE_TIME,
+                       idle_pressure_delta=settings.IDLE_PRESSURE_DELTA),
+        PressureControl(control_data=control_data,
+                        cycle_time=settings.PRESSURE_CONTROL_CYCLE_TIME,
+                        idle_cycle_time=settings.IDLE_CYCLE_TIME),
+        PumpControl(control_data=control_data,
+                    pin_number=settings.PUMP_CONTROL_PIN_NUMBER,
+                    cycle_time=settings.PUMP_CONTROL_CYCLE_TIME,
+                    gpio=gpio),
+        ValveControl(control_data=control_data,
+                     pin_number=settings.VALVE_CONTROL_PIN_NUMBER,
+                     cycle_time=settings.VALVE_CONTROL_CYCLE_TIME,
+                     gpio=gpio,
+                     idle_cycle_time=settings.IDLE_CYCLE_TIME),
+        SessionControl(control_data, idle_cycle_time=settings.IDLE_CYCLE_TIME),
+        AutoSetpoint(control_data=control_data),
+    ]
+    threads = [Thread(target=worker.run, name=worker.__class__.__name__) for worker in workers]
+    for thread in threads:
+        thread.start()
+
+    sleep(idle_delay + 1.0)
+    sequence_start = control_data.get_pressure_sample().sequence
+    cpu_start = process_time()
+    sleep(duration)
+    cpu = process_time() - cpu_start
+    samples = control_data.get_pressure_sample().sequence - sequence_start
+
+    # back to full rate on session start
+    sample = control_data.get_pressure_sample()
+    time_start = monotonic_ns()
+    control_data.start_session()
+    sample = control_data.wait_for_sample(sample.sequence, timeout=5.0)
+    first_sample = (monotonic_ns() - time_start) / 1e9
+    fast = None
+    time_last = sample.time_ns
+    while fast is None:
+        sample = control_data.wait_for_sample(sample.sequence, timeout=5.0)
+        if sample.time_ns - time_last <= 2 * settings.PRESSURE_SENSOR_CYCLE_TIME * 1e9:
+            fast = (sample.time_ns - time_start) / 1e9
+        time_last = sample.time_ns
+    control_data.stop_session()
+    control_data.stop()
+    for thread in threads:
+        thread.join()
+    results.put({
+        'idle_delay': idle_delay,
+        'cpu_percent': 100.0 * cpu / duration,
+        'sample_rate': samples / duration,
+        'session_start_first_sample_s': first_sample,
+        'session_start_full_rate_s': fast,
+    })
+
+
+def main():
+    args = parse_arguments()
+    context = multiprocessing.get_context('spawn')
+    runs = {}
+    for name, idle_delay in (('before', 0.0), ('after', args.idle_delay)):
+        results = context.Queue()
+        process = context.Process(target=measure, args=(idle_delay, args.duration, results))
+        process.start()
+        runs[name] = results.get()
+        process.join()
+    print(json.dumps({ 'duration': args.duration, 'cpus': os.cpu_count(), **runs }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Trip latency of the interlock in real time.
+
+Runs the sensor, pump and valve threads against a `SimulatedChamber`, holds
+the pressure below ambient with the pump and then breaks the chamber
+(a large leak with the valve closed) until the interlock trips on the rate
+of rise. Reports the latency the interlock measured from the violating
+sample until both pins were driven, next to the pump control cycle time
+the actuator loop would have added.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/interlock_trip.py
+"""
+import argparse
+import json
+import logging
+
+from pmpctrl.__main__ import Settings
+from pmpctrl.control_data import ControlData
+from pmpctrl.interlock import Interlock
+from pmpctrl.pressure_sensor import PressureSensor
+from pmpctrl.pump_control import PumpControl
+from pmpctrl.simulation import SimulatedChamber
+from pmpctrl.simulation import SimulatedGPIO
+from pmpctrl.valve_control import ValveControl
+from statistics import median
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--trips', help='number of provoked trips', type=int, default=20)
+    return parser.parse_args()
+
+
+def wait_for(condition, timeout: float=30.0) -> bool:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.001)
+    return True
+
+
+def main():
+    args = parse_arguments()
+    settings = Settings()
+    control_data = ControlData()
+    control_data.set_log_level(logging.CRITICAL)
+    control_data.event_run.set()
+    chamber = SimulatedChamber(seed=0)
+    gpio = SimulatedGPIO(chamber, settings.PUMP_CONTROL_PIN_NUMBER, settings.VALVE_CONTROL_PIN_NUMBER)
+    pump_control = PumpControl(control_data, settings.PUMP_CONTROL_PIN_NUMBER, settings.PUMP_CONTROL_CYCLE_TIME, gpio=gpio)
+    valve_control = ValveControl(control_data, settings.VALVE_CONTROL_PIN_NUMBER, settings.VALVE_CONTROL_CYCLE_TIME, gpio=gpio)
+    interlock = Interlock(control_data, pump_control, valve_control,
+                          rate_fall_max=settings.INTERLOCK_RATE_FALL_MAX,
+                          rate_rise_max=settings.INTERLOCK_RATE_RISE_MAX,
+                          rate_window=settings.INTERLOCK_RATE_WINDOW,
+                          pump_on_time_max=settings.INTERLOCK_PUMP_ON_TIME_MAX)
+    pressure_sensor = PressureSensor(control_data, cycle_time=settings.PRESSURE_SENSOR_CYCLE_TIME,
+                                     smbus_factory=chamber.open_smbus,
+                                     bmp280_factory=chamber.open_bmp280,
+                                     interlock=interlock)
+    threads = [Thread(target=worker.run) for worker in (pump_control, valve_control, pressure_sensor)]
+    for thread in threads:
+        thread.start()
+
+    latencies = []
+    try:
+        for _ in range(args.trips):
+            chamber.rate_leak = 0.002
+            wait_for(interlock.reset)
+            control_data.request_valve_close()
+            control_data.request_pump_on()
+            wait_for(lambda: chamber.get_pressure() < 900.0)
+            # a burst chamber, the valve still closed
+            chamber.rate_leak = 2.0
+            if wait_for(control_data.event_interlock_tripped.is_set, timeout=5.0):
+                latencies.append(interlock.get_status()['latency_last'])
+    finally:
+        control_data.stop()
+        for thread in threads:
+            thread.join()
+
+    status = interlock.get_status()
+    result = {
+        'trips': status['trip_count'],
+        'reason': status['reason'],
+        'latency_median': median(latencies) if latencies else None,
+        'latency_max': status['latency_max'],
+        'pump_control_cycle_time': settings.PUMP_CONTROL_CYCLE_TIME,
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
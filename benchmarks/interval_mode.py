@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+CPU cost and reaction time of SessionControl in interval mode.
+
+Runs SessionControl in real time in an interval session, with a feeder
+thread in place of the sensor publishing a sample every
+`--sample-interval` seconds. The pressure stays at the target while the
+target is above the peak pressure and falls at `--rate` mbar/s once it is
+at the peak, so every cycle passes through all phases. Reported are the
+CPU time of the SessionControl thread per second, its steps per second,
+the steps per phase, and the delay from the first sample at or below the
+peak pressure until SessionControl left the peak phase.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/interval_mode.py
+"""
+import argparse
+import json
+import logging
+import time
+
+from pmpctrl.control_data import ControlData
+from pmpctrl.session_control import SessionControl
+from statistics import mean
+from threading import Thread
+
+PHASES = {
+    SessionControl.PHASE_IDLE : 'idle',
+    SessionControl.PHASE_INTERVAL_WAIT : 'wait',
+    SessionControl.PHASE_INTERVAL_RAMP : 'ramp',
+    SessionControl.PHASE_INTERVAL_PEAK : 'peak',
+    SessionControl.PHASE_INTERVAL_DWELL : 'dwell',
+    SessionControl.PHASE_INTERVAL_RETURN : 'return',
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', help='seconds of session measured', type=float, default=30.0)
+    parser.add_argument('--interval-time', help='interval time of the mode', type=float, default=3.0)
+    parser.add_argument('--dwell-time', help='dwell time of the mode', type=float, default=2.0)
+    parser.add_argument('--ramp-time', help='ramp time of the mode', type=float, default=1.0)
+    parser.add_argument('--rate', help='mbar/s the pressure falls towards the peak', type=float, default=40.0)
+    parser.add_argument('--sample-interval', help='seconds between two samples', type=float, default=0.01)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    control_data = ControlData()
+    control_data.set_log_level(logging.WARNING)
+    control_data.event_run.set()
+    control_data.set_pressure_target(875.0)
+    control_data.set_mode_interval_peak_pressure(790.0)
+    control_data.set_mode_interval_time(args.interval_time)
+    control_data.set_mode_interval_dwell_time(args.dwell_time)
+    control_data.set_mode_interval_ramp_time(args.ramp_time)
+    control_data.set_mode(ControlData.MODE_INTERVAL)
+    peak = control_data.get_mode_interval_peak_pressure()
+    session_control = SessionControl(control_data)
+
+    steps = {}
+    peak_left = []
+    step = session_control.step
+
+    def counted_step():
+        phase = session_control._phase
+        timeout = step()
+        steps[PHASES[phase]] = steps.get(PHASES[phase], 0) + 1
+        if phase == SessionControl.PHASE_INTERVAL_PEAK and session_control._phase != phase:
+            peak_left.append(time.monotonic_ns())
+        return timeout
+    session_control.step = counted_step
+
+    cpu = {}
+
+    def run_session_control():
+        session_control.run()
+        cpu['session_control'] = time.thread_time()
+
+    crossings = []
+
+    def feed():
+        pressure = control_data.get_pressure_target()
+        while control_data.event_run.is_set():
+            target = control_data.get_pressure_target()
+            if target > peak:
+                pressure = target
+            else:
+                below = pressure <= peak
+                pressure -= args.rate * args.sample_interval
+                if pressure <= peak and not below:
+                    crossings.append(time.monotonic_ns())
+            control_data.set_pressure_actual(pressure)
+            time.sleep(args.sample_interval)
+
+    threads = [Thread(target=run_session_control, name='SessionControl'), Thread(target=feed, name='Feeder')]
+    for thread in threads:
+        thread.start()
+    control_data.start_session()
+    time.sleep(args.duration)
+    control_data.stop_session()
+    control_data.stop()
+    for thread in threads:
+        thread.join()
+
+    delays = [(left - crossed) / 1e6 for crossed, left in zip(crossings, peak_left)]
+    print(json.dumps({
+        'duration': args.duration,
+        'cycles': len(peak_left),
+        'cpu_percent': 100.0 * cpu['session_control'] / args.duration,
+        'steps_per_second': sum(steps.values()) / args.duration,
+        'steps': steps,
+        'peak_reaction_ms_mean': mean(delays) if delays else None,
+        'peak_reaction_ms_max': max(delays) if delays else None,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Read latency of local consumers: HTTP+JSON against the Unix domain socket.
+
+Serves the same ControlData through PmpctrlAPI (uvicorn on localhost) and
+through LocalServer, then times `--reads` sequential reads of GET /pressure
+over a keep-alive connection and of COMMAND_TELEMETRY frames. A subscribed
+client additionally measures the delay from publishing a sample until its
+frame arrives.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/local_socket.py
+"""
+import argparse
+import httpx
+import json
+import os
+import socket
+import tempfile
+import uvicorn
+
+from pmpctrl.admission_control import AdmissionControl
+from pmpctrl.control_data import ControlData
+from pmpctrl.local_server import LocalClient
+from pmpctrl.local_server import LocalServer
+from pmpctrl.pmpctrl_api import PmpctrlAPI
+from threading import Thread
+from time import monotonic_ns
+from time import sleep
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--reads', help='reads per transport', type=int, default=2000)
+    parser.add_argument('-s', '--samples', help='samples published to the subscriber', type=int, default=200)
+    return parser.parse_args()
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+    def at(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))] / 1e3
+    return {
+        'p50_us': at(0.50),
+        'p99_us': at(0.99),
+        'max_us': values[-1] / 1e3,
+    }
+
+
+def time_reads(read, reads: int) -> list:
+    # warm up connections and code paths first
+    for _ in range(min(100, reads)):
+        read()
+    times = []
+    for _ in range(reads):
+        time_start = monotonic_ns()
+        read()
+        times.append(monotonic_ns() - time_start)
+    return times
+
+
+def main():
+    args = parse_arguments()
+    control_data = ControlData()
+    control_data.event_run.set()
+    control_data.set_pressure_actual(962.0)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    api = PmpctrlAPI(control_data, admission_control=AdmissionControl())
+    api_server = uvicorn.Server(uvicorn.Config(api, host='127.0.0.1', port=port, log_level='warning'))
+    api_server_thread = Thread(target=api_server.run)
+    api_server_thread.start()
+    path = os.path.join(tempfile.mkdtemp(prefix='pmpctrl-'), 'local.sock')
+    local_server = LocalServer(control_data, path)
+    local_server_thread = Thread(target=local_server.run)
+    local_server_thread.start()
+    while not api_server.started:
+        sleep(0.05)
+
+    try:
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}') as http:
+            http_times = time_reads(lambda: http.get('/pressure').json(), args.reads)
+        client = LocalClient(path)
+        socket_times = time_reads(client.telemetry, args.reads)
+        client.close()
+
+        subscriber = LocalClient(path)
+        frames = subscriber.subscribe()
+        next(frames)
+        delays = []
+        for i in range(args.samples):
+            time_publish = monotonic_ns()
+            control_data.set_pressure_actual(962.0 + i % 10)
+            next(frames)
+            delays.append(monotonic_ns() - time_publish)
+        subscriber.close()
+    finally:
+        api_server.should_exit = True
+        api_server_thread.join()
+        local_server.stop()
+        local_server_thread.join()
+        os.rmdir(os.path.dirname(path))
+
+    result = {
+        'reads': args.reads,
+        'http_get_pressure': percentiles(http_times),
+        'unix_socket_telemetry': percentiles(socket_times),
+        'unix_socket_subscription_delay': percentiles(delays),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
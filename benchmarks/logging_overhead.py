@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Loop time of `PressureControl._pressure_hold` with DEBUG off and on.
+
+With DEBUG on the records either go through the queue of
+`pmpctrl.logging_config` (output on the listener thread) or, for
+comparison, through a synchronous handler on the calling thread. Output
+is written to /dev/null in both cases.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/logging_overhead.py
+"""
+import argparse
+import json
+import logging
+import os
+import pmpctrl.logging_config
+
+from pmpctrl.control_data import ControlData
+from pmpctrl.pressure_control import PressureControl
+from time import perf_counter
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', help='control iterations per run', type=int, default=20000)
+    return parser.parse_args()
+
+
+def loop_time(pressure_control: PressureControl, iterations: int) -> float:
+    # alternate between too low, too high and good to take every branch
+    pressures = [800.0, 900.0, 870.0]
+    time_start = perf_counter()
+    for i in range(iterations):
+        pressure_control._pressure_hold(pressures[i % 3])
+    return (perf_counter() - time_start) / iterations * 1e6
+
+
+def main():
+    args = parse_arguments()
+    devnull = open(os.devnull, 'w')
+    pmpctrl.logging_config.stream_handler.setStream(devnull)
+    # every record is distinct enough for the repeat filter to be bypassed
+    pmpctrl.logging_config.queue_handler.filters.clear()
+
+    control_data = ControlData()
+    control_data.set_pressure_target(875.0)
+    pressure_control = PressureControl(control_data=control_data)
+    logger = logging.getLogger(PressureControl.__name__)
+
+    result = {}
+    logger.setLevel(logging.WARNING)
+    result['debug_off_us'] = loop_time(pressure_control, args.iterations)
+
+    logger.setLevel(logging.DEBUG)
+    result['debug_on_queued_us'] = loop_time(pressure_control, args.iterations)
+    pmpctrl.logging_config.queue_listener.stop()
+    pmpctrl.logging_config.queue_listener.start()
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    sync_handler = logging.StreamHandler(devnull)
+    sync_handler.setFormatter(logging.Formatter(fmt=pmpctrl.logging_config.LOG_FORMAT,
+                                                datefmt=pmpctrl.logging_config.LOG_DATEFMT))
+    root.handlers = [sync_handler]
+    result['debug_on_synchronous_us'] = loop_time(pressure_control, args.iterations)
+    root.handlers = handlers
+
+    result['dropped_records'] = pmpctrl.logging_config.queue_handler.dropped
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Noise and cycle cost of the sensor fusion.
+
+Reads 1 to `--sensors` simulated BMP280 on a `SimulatedChamber` held at
+ambient pressure with PressureSensor, fused by mean and by median, and
+compares the published pressure with the true chamber pressure. For every
+configuration it reports the measured noise of the fused reading, the
+noise reduction against a single sensor, the one PressureSensor estimated
+itself, and the time of one acquisition cycle. A last run offsets one
+sensor by `--offset` mbar to show the error with that sensor excluded.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/sensor_fusion.py
+"""
+import argparse
+import json
+
+from pmpctrl.control_data import ControlData
+from pmpctrl.pressure_sensor import PressureSensor
+from pmpctrl.simulation import SimulatedChamber
+from statistics import mean
+from statistics import median
+from statistics import pstdev
+from time import perf_counter_ns
+
+ADDRESSES = ((1, 0x76), (1, 0x77), (3, 0x76), (3, 0x77), (4, 0x76))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--samples', help='acquisition cycles per configuration', type=int, default=5000)
+    parser.add_argument('-s', '--sensors', help='largest number of sensors', type=int, default=3)
+    parser.add_argument('--offset', help='offset in mbar of the faulty sensor', type=float, default=5.0)
+    return parser.parse_args()
+
+
+def measure(control_data: ControlData, channels: tuple, fusion: str, samples: int, offset: float=0.0) -> dict:
+    chamber = SimulatedChamber(seed=0)
+    if offset:
+        chamber.set_sensor_offset(*channels[-1], offset)
+    pressure_sensor = PressureSensor(control_data=control_data,
+                                     channels=channels,
+                                     fusion=fusion,
+                                     smbus_factory=chamber.open_smbus,
+                                     bmp280_factory=chamber.open_bmp280)
+    errors = []
+    step_times = []
+    for _ in range(samples):
+        time_start = perf_counter_ns()
+        pressure_sensor.step()
+        step_times.append(perf_counter_ns() - time_start)
+        errors.append(control_data.get_pressure_actual() - chamber.get_pressure())
+    status = pressure_sensor.get_status()
+    return {
+        'sensors': len(channels),
+        'fusion': fusion,
+        'offset': offset,
+        'excluded': sum(1 for channel in status['channels'] if channel['state'] == 'excluded'),
+        'error_mean': mean(errors),
+        'noise': pstdev(errors),
+        'noise_reduction_estimated': status['noise_reduction'],
+        'step_us': median(step_times) / 1e3,
+    }
+
+
+def main():
+    args = parse_arguments()
+    control_data = ControlData()
+    control_data.event_run.set()
+
+    results = []
+    for fusion in (PressureSensor.FUSION_MEAN, PressureSensor.FUSION_MEDIAN):
+        for sensors in range(1, args.sensors + 1):
+            results.append(measure(control_data, ADDRESSES[:sensors], fusion, args.samples))
+    noise_single = results[0]['noise']
+    for result in results:
+        result['noise_reduction'] = noise_single / result['noise']
+    if args.sensors >= 3:
+        results.append(measure(control_data, ADDRESSES[:args.sensors], PressureSensor.FUSION_MEAN,
+                               args.samples, args.offset))
+    print(json.dumps({ 'samples': args.samples, 'results': results }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
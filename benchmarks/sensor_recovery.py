@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Fault injection against the simulated I2C sensor.
+
+Runs `PressureSensor` on a `SimulatedChamber`, injects I2C faults of the
+given duration and measures how long the reading stays stale after each
+fault has cleared (recovery latency) as well as the total stale time.
+
+The sensor is set up during a fault of `--boot-fault` seconds, so it
+starts with a stale reading and has to recover like after any other
+fault. Exits with 1 if the sensor did not start that way or a fault was
+not recovered from.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/sensor_recovery.py
+"""
+import argparse
+import json
+import sys
+
+from pmpctrl.control_data import ControlData
+from pmpctrl.pressure_sensor import PressureSensor
+from pmpctrl.simulation import SimulatedChamber
+from statistics import fmean
+from statistics import median
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--faults', help='number of injected faults', type=int, default=20)
+    parser.add_argument('-d', '--duration', help='fault duration in seconds', type=float, default=0.05)
+    parser.add_argument('--cycle-time', help='sensor cycle time in seconds', type=float, default=0.01)
+    parser.add_argument('--boot-fault', help='fault duration in seconds while the sensor is set up', type=float, default=0.2)
+    return parser.parse_args()
+
+
+def wait_for(condition, timeout: float=10.0) -> float:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return None
+        sleep(0.0005)
+    return monotonic()
+
+
+def main():
+    args = parse_arguments()
+    control_data = ControlData()
+    control_data.event_run.set()
+    chamber = SimulatedChamber(seed=0)
+    time_boot = monotonic()
+    if args.boot_fault > 0:
+        chamber.inject_fault(args.boot_fault)
+    pressure_sensor = PressureSensor(control_data=control_data,
+                                     cycle_time=args.cycle_time,
+                                     smbus_factory=chamber.open_smbus,
+                                     bmp280_factory=chamber.open_bmp280)
+    thread = Thread(target=pressure_sensor.run)
+    thread.start()
+
+    boot_stale = control_data.event_pressure_stale.is_set()
+    latencies = []
+    stale_times = []
+    try:
+        time_boot_fresh = wait_for(lambda: not control_data.event_pressure_stale.is_set())
+        for _ in range(args.faults):
+            time_fault = monotonic()
+            chamber.inject_fault(args.duration)
+            time_stale = wait_for(control_data.event_pressure_stale.is_set)
+            time_fresh = wait_for(lambda: not control_data.event_pressure_stale.is_set())
+            if time_stale is None or time_fresh is None:
+                continue
+            latencies.append(time_fresh - (time_fault + args.duration))
+            stale_times.append(time_fresh - time_stale)
+            sleep(0.1)
+    finally:
+        control_data.stop()
+        thread.join()
+
+    boot_recovered = time_boot_fresh is not None and (boot_stale or args.boot_fault <= 0)
+    result = {
+        'boot_fault': args.boot_fault,
+        'boot_stale': boot_stale,
+        'boot_recovery_time': time_boot_fresh - time_boot if time_boot_fresh is not None else None,
+        'faults': args.faults,
+        'faults_recovered': len(latencies),
+        'fault_duration': args.duration,
+        'recoveries': control_data.get_sensor_recovery_count(),
+        'recovery_time_max': control_data.get_sensor_recovery_time_max(),
+        'latency_after_fault_mean': fmean(latencies) if latencies else None,
+        'latency_after_fault_median': median(latencies) if latencies else None,
+        'latency_after_fault_max': max(latencies) if latencies else None,
+        'stale_time_mean': fmean(stale_times) if stale_times else None,
+    }
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if boot_recovered and len(latencies) == args.faults else 1)
+
+
+if __name__ == '__main__':
+    main()
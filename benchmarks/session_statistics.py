@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Cost of the live session statistics per pressure sample.
+
+Publishes `--samples` samples through ControlData.set_pressure_actual
+without a session and within a session, where every sample also updates
+SessionStatistics, and reports the time per sample of both, the time of
+get_session_statistics and the memory allocated by the session samples,
+which stays constant as no sample is kept.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/session_statistics.py
+"""
+import argparse
+import json
+import logging
+import math
+import time
+import tracemalloc
+
+from pmpctrl.control_data import ControlData
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--samples', help='samples published per run', type=int, default=100000)
+    return parser.parse_args()
+
+
+def publish(control_data: ControlData, samples: int) -> float:
+    time_start = time.perf_counter()
+    for index in range(samples):
+        control_data.set_pressure_actual(870.0 + 10.0 * math.sin(index / 100.0))
+    return (time.perf_counter() - time_start) / samples
+
+
+def main():
+    args = parse_arguments()
+    control_data = ControlData()
+    control_data.set_log_level(logging.WARNING)
+    control_data.set_pressure_target(875.0)
+
+    idle = publish(control_data, args.samples)
+    control_data.start_session()
+    session = publish(control_data, args.samples)
+
+    tracemalloc.start()
+    publish(control_data, args.samples // 10)
+    memory_short = tracemalloc.get_traced_memory()[0]
+    publish(control_data, args.samples)
+    memory_long = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    time_start = time.perf_counter()
+    for _ in range(1000):
+        statistics = control_data.get_session_statistics()
+    get_time = (time.perf_counter() - time_start) / 1000
+    control_data.stop_session()
+
+    print(json.dumps({
+        'samples': args.samples,
+        'sample_us_without_session': idle * 1e6,
+        'sample_us_with_session': session * 1e6,
+        'get_statistics_us': get_time * 1e6,
+        'memory_growth_bytes': memory_long - memory_short,
+        'statistics': statistics,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Measures the cold start and the stop of the service.
+
+Starts `python -m pmpctrl` with the given config file (log level forced to
+INFO), reads the startup timings the service logs itself and probes the API
+port from the outside. Reports time-to-first-sample and time-to-API-ready,
+both relative to process spawn, then stops the service again with SIGTERM
+and reports the stop time it logs and the time until the process exited.
+"""
+import argparse
+import configparser
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+RE_FIRST_SAMPLE = re.compile(r'startup: time to first sample ([0-9.]+)s')
+RE_API_READY = re.compile(r'startup: time to API ready ([0-9.]+)s')
+RE_STOPPED = re.compile(r'shutdown: stopped in ([0-9.]+)s')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', help='config file', required=True)
+    parser.add_argument('-r', '--runs', help='number of cold starts', type=int, default=3)
+    parser.add_argument('-t', '--timeout', help='timeout per start in seconds', type=float, default=30.0)
+    return parser.parse_args()
+
+
+def write_config(config_file: str) -> tuple:
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    config.set('logging', 'log_level', 'INFO')
+    fd, path = tempfile.mkstemp(suffix='.ini')
+    with os.fdopen(fd, 'w') as f:
+        config.write(f)
+    return path, config.getint('api', 'port')
+
+
+def port_open(port: int) -> bool:
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=0.05):
+            return True
+    except OSError:
+        return False
+
+
+def cold_start(config_file: str, port: int, timeout: float) -> dict:
+    result = {
+        'first_sample_reported': None,
+        'api_ready_reported': None,
+        'first_sample_observed': None,
+        'api_ready_observed': None,
+        'stop_reported': None,
+        'stop_observed': None,
+    }
+    time_spawn = monotonic()
+    process = subprocess.Popen([sys.executable, '-m', 'pmpctrl', '-c', config_file],
+                               stderr=subprocess.PIPE,
+                               text=True)
+
+    def read_log():
+        for line in process.stderr:
+            match = RE_FIRST_SAMPLE.search(line)
+            if match:
+                result['first_sample_reported'] = float(match.group(1))
+                result['first_sample_observed'] = monotonic() - time_spawn
+            match = RE_API_READY.search(line)
+            if match:
+                result['api_ready_reported'] = float(match.group(1))
+            match = RE_STOPPED.search(line)
+            if match:
+                result['stop_reported'] = float(match.group(1))
+
+    log_reader = Thread(target=read_log, daemon=True)
+    log_reader.start()
+    try:
+        deadline = time_spawn + timeout
+        while monotonic() < deadline and process.poll() is None:
+            if result['api_ready_observed'] is None and port_open(port):
+                result['api_ready_observed'] = monotonic() - time_spawn
+            if result['api_ready_observed'] is not None and result['api_ready_reported'] is not None:
+                break
+            sleep(0.005)
+    finally:
+        time_stop = monotonic()
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=timeout)
+        result['stop_observed'] = monotonic() - time_stop
+        log_reader.join(timeout=1.0)
+    return result
+
+
+def main():
+    args = parse_arguments()
+    config_file, port = write_config(args.config)
+    try:
+        runs = [cold_start(config_file, port, args.timeout) for _ in range(args.runs)]
+    finally:
+        os.unlink(config_file)
+    print(json.dumps({'runs': runs}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,122 @@
 #!/usr/bin/env python3
+from time import monotonic
+
+# taken before anything else is imported to measure the cold start budget
+TIME_START = monotonic()
+
 import argparse
 import configparser
 import logging
+import os
 import pmpctrl.logging_config
 import signal
 import sys
-import uvicorn
 
 from functools import partial
+from pmpctrl.actuator_journal import ActuatorJournal
 from pmpctrl.auto_setpoint import AutoSetpoint
 from pmpctrl.control_data import ControlData
-from pmpctrl.pmpctrl_api import PmpctrlAPI
+from pmpctrl.interlock import Interlock
 from pmpctrl.pressure_control import PressureControl
 from pmpctrl.pressure_sensor import PressureSensor
+from pmpctrl.profiler import SamplingProfiler
 from pmpctrl.pump_control import PumpControl
 from pmpctrl.session_control import SessionControl
+from pmpctrl.session_recorder import SessionRecorder
+from pmpctrl.setpoint_calibration import SetpointStore
+from pmpctrl.state_checkpoint import StateCheckpoint
+from pmpctrl.supervisor import Supervisor
+from pmpctrl.trace_capture import CommandCapture
+from pmpctrl.trace_capture import TraceCapture
 from pmpctrl.valve_control import ValveControl
+from threading import Lock
 from threading import Thread
 from time import sleep
 
 class Settings:
     LOG_LEVEL = logging.WARNING
     API_PORT = 8000
+    API_PROCESS = False
+    API_WORKERS = 1
+    API_RATE_LIMIT = 20.0
+    API_RATE_BURST = 40.0
+    API_CONCURRENCY_MAX = 8
+    API_UNIX_SOCKET = ''
     PRESSURE_CONTROL_CYCLE_TIME = 0.01
+    PRESSURE_CONTROL_TOLERANCE_PLUS = 10.0
+    PRESSURE_CONTROL_TOLERANCE_MINUS = 10.0
     PRESSURE_SENSOR_CYCLE_TIME = 0.01
     PRESSURE_SENSOR_BUS_NR = 1
     PRESSURE_SENSOR_I2C_ADR = 0x76
+    PRESSURE_SENSOR_SETPOINT_FILE = 'setpoint.json'
+    PRESSURE_SENSOR_SETPOINT_AGE_MAX = 86400.0
+    PRESSURE_SENSOR_CALIBRATION_STDERR = 0.01
+    PRESSURE_SENSOR_CALIBRATION_SAMPLES_MAX = 1000
+    PRESSURE_SENSOR_BACKOFF_MIN = 0.01
+    PRESSURE_SENSOR_BACKOFF_MAX = 1.0
+    # (bus, I2C address) of every sensor, only the one above if empty
+    PRESSURE_SENSOR_CHANNELS = ()
+    PRESSURE_SENSOR_FUSION = 'mean'
+    PRESSURE_SENSOR_DISAGREEMENT_MAX = 2.0
     PUMP_CONTROL_CYCLE_TIME = 0.5
     PUMP_CONTROL_PIN_NUMBER = 24
     VALVE_CONTROL_CYCLE_TIME = 0.1
     VALVE_CONTROL_PIN_NUMBER = 23
+    MODE_INTERVAL_PEAK_PRESSURE = 790.0
+    MODE_INTERVAL_TIME = 20.0
+    MODE_INTERVAL_DWELL_TIME = 0.0
+    MODE_INTERVAL_RAMP_TIME = 0.0
+    MODE_PULSATING_PUMP_TIME = 2.5
+    MODE_PULSATING_RELEASE_TIME = 1.7
+    JOURNAL_ACTUATOR_FILE = 'actuator_journal.bin'
+    CHECKPOINT_FILE = 'state.checkpoint'
+    CHECKPOINT_AGE_MAX = 5.0
+    RECORDER_DIRECTORY = 'sessions'
+    # trace of samples, commands and actuator edges for TraceReplay, off if empty
+    CAPTURE_DIRECTORY = ''
+    CAPTURE_FILE_SIZE_MAX = 64 * 1024 * 1024
+    CAPTURE_FILES_MAX = 8
+    INTERLOCK_ENABLED = True
+    INTERLOCK_RATE_FALL_MAX = 200.0
+    INTERLOCK_RATE_RISE_MAX = 50.0
+    INTERLOCK_RATE_WINDOW = 0.2
+    INTERLOCK_PUMP_ON_TIME_MAX = 120.0
+    # seconds without activity before the loops slow down, 0 never does
+    IDLE_DELAY = 10.0
+    IDLE_CYCLE_TIME = 0.5
+    IDLE_PRESSURE_DELTA = 1.0
+    SUPERVISOR_CHECK_INTERVAL = 0.1
+    SUPERVISOR_DEADLINE_PERIODS = 3.0
+    SUPERVISOR_BACKOFF_MIN = 0.5
+    SUPERVISOR_BACKOFF_MAX = 30.0
+    # seconds each stage of the shutdown may take
+    SHUTDOWN_DEADLINE = 0.5
+    DEBUG_PROFILER = False
+    DEBUG_PROFILER_INTERVAL = 0.01
+
+    # settings tied to hardware, a reload changing them is refused
+    HARDWARE = ('PRESSURE_SENSOR_BUS_NR',
+                'PRESSURE_SENSOR_I2C_ADR',
+                'PRESSURE_SENSOR_CHANNELS',
+                'PUMP_CONTROL_PIN_NUMBER',
+                'VALVE_CONTROL_PIN_NUMBER')
+    # settings applied on reload, everything else requires a restart
+    LIVE = ('LOG_LEVEL',
+            'PRESSURE_CONTROL_CYCLE_TIME',
+            'PRESSURE_CONTROL_TOLERANCE_PLUS',
+            'PRESSURE_CONTROL_TOLERANCE_MINUS',
+            'PRESSURE_SENSOR_CYCLE_TIME',
+            'PUMP_CONTROL_CYCLE_TIME',
+            'VALVE_CONTROL_CYCLE_TIME',
+            'MODE_INTERVAL_PEAK_PRESSURE',
+            'MODE_INTERVAL_TIME',
+            'MODE_INTERVAL_DWELL_TIME',
+            'MODE_INTERVAL_RAMP_TIME',
+            'MODE_PULSATING_PUMP_TIME',
+            'MODE_PULSATING_RELEASE_TIME')
+
+    def as_dict(self) -> dict:
+        return { name : getattr(self, name) for name in dir(Settings) if name.isupper() and name not in ('HARDWARE', 'LIVE') }
 
 
 def parse_arguments():
@@ -38,10 +125,22 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def parse_config(control_data: ControlData, config_file: str) -> Settings:
+def parse_sensor_channels(sensors: str) -> tuple:
+    # "bus:address, ..." e.g. "1:0x76, 1:0x77"
+    channels = []
+    for sensor in sensors.split(','):
+        if not sensor.strip():
+            continue
+        bus_nr, _, i2c_addr = sensor.strip().partition(':')
+        channels.append((int(bus_nr), int(i2c_addr, 0)))
+    return tuple(channels)
+
+
+def read_config(config_file: str) -> Settings:
     config = configparser.ConfigParser()
-    config.read(config_file)
-    settings = Settings
+    if not config.read(config_file):
+        raise FileNotFoundError(f'config file {config_file} not found')
+    settings = Settings()
 
     config_log_level = config.get('logging', 'log_level')
     logging_log_levels = logging.getLevelNamesMapping().items()
@@ -49,127 +148,609 @@ def parse_config(control_data: ControlData, config_file: str) -> Settings:
         if config_log_level in key:
             settings.LOG_LEVEL = value
 
-    control_data.set_log_level(settings.LOG_LEVEL)
-
     settings.API_PORT = config.getint('api', 'port')
+    settings.API_PROCESS = config.getboolean('api', 'process', fallback=Settings.API_PROCESS)
+    settings.API_WORKERS = config.getint('api', 'workers', fallback=Settings.API_WORKERS)
+    settings.API_RATE_LIMIT = config.getfloat('api', 'rate_limit', fallback=Settings.API_RATE_LIMIT)
+    settings.API_RATE_BURST = config.getfloat('api', 'rate_burst', fallback=Settings.API_RATE_BURST)
+    settings.API_CONCURRENCY_MAX = config.getint('api', 'concurrency_max', fallback=Settings.API_CONCURRENCY_MAX)
+    settings.API_UNIX_SOCKET = config.get('api', 'unix_socket', fallback=Settings.API_UNIX_SOCKET)
     settings.PRESSURE_CONTROL_CYCLE_TIME = config.getfloat('pressure_control', 'cycle_time')
-    
-    control_data.set_pressure_target_tolerance_plus(config.getfloat('pressure_control', 'tolerance_plus'))
-    control_data.set_pressure_target_tolerance_minus(config.getfloat('pressure_control', 'tolerance_minus'))
+    settings.PRESSURE_CONTROL_TOLERANCE_PLUS = config.getfloat('pressure_control', 'tolerance_plus')
+    settings.PRESSURE_CONTROL_TOLERANCE_MINUS = config.getfloat('pressure_control', 'tolerance_minus')
 
     settings.PRESSURE_SENSOR_CYCLE_TIME = config.getfloat('pressure_sensor', 'cycle_time')
     settings.PRESSURE_SENSOR_BUS_NR = config.getint('pressure_sensor', 'smbus_nr')
     settings.PRESSURE_SENSOR_I2C_ADR = int(config.get('pressure_sensor', 'i2c_address'), 0)
+    settings.PRESSURE_SENSOR_SETPOINT_FILE = config.get('pressure_sensor', 'setpoint_file',
+                                                        fallback=Settings.PRESSURE_SENSOR_SETPOINT_FILE)
+    settings.PRESSURE_SENSOR_SETPOINT_AGE_MAX = config.getfloat('pressure_sensor', 'setpoint_age_max',
+                                                                fallback=Settings.PRESSURE_SENSOR_SETPOINT_AGE_MAX)
+    settings.PRESSURE_SENSOR_CALIBRATION_STDERR = config.getfloat('pressure_sensor', 'calibration_stderr',
+                                                                  fallback=Settings.PRESSURE_SENSOR_CALIBRATION_STDERR)
+    settings.PRESSURE_SENSOR_CALIBRATION_SAMPLES_MAX = config.getint('pressure_sensor', 'calibration_samples_max',
+                                                                     fallback=Settings.PRESSURE_SENSOR_CALIBRATION_SAMPLES_MAX)
+    settings.PRESSURE_SENSOR_BACKOFF_MIN = config.getfloat('pressure_sensor', 'backoff_min',
+                                                           fallback=Settings.PRESSURE_SENSOR_BACKOFF_MIN)
+    settings.PRESSURE_SENSOR_BACKOFF_MAX = config.getfloat('pressure_sensor', 'backoff_max',
+                                                           fallback=Settings.PRESSURE_SENSOR_BACKOFF_MAX)
+    settings.PRESSURE_SENSOR_CHANNELS = parse_sensor_channels(config.get('pressure_sensor', 'sensors', fallback=''))
+    settings.PRESSURE_SENSOR_FUSION = config.get('pressure_sensor', 'fusion',
+                                                 fallback=Settings.PRESSURE_SENSOR_FUSION)
+    settings.PRESSURE_SENSOR_DISAGREEMENT_MAX = config.getfloat('pressure_sensor', 'disagreement_max',
+                                                                fallback=Settings.PRESSURE_SENSOR_DISAGREEMENT_MAX)
     settings.PUMP_CONTROL_CYCLE_TIME = config.getfloat('pump_control', 'cycle_time')
     settings.PUMP_CONTROL_PIN_NUMBER = config.getint('pump_control', 'pin_number')
     settings.VALVE_CONTROL_CYCLE_TIME = config.getfloat('valve_control', 'cycle_time')
     settings.VALVE_CONTROL_PIN_NUMBER = config.getint('valve_control', 'pin_number')
+    settings.MODE_INTERVAL_PEAK_PRESSURE = config.getfloat('mode_interval', 'peak_pressure',
+                                                           fallback=Settings.MODE_INTERVAL_PEAK_PRESSURE)
+    settings.MODE_INTERVAL_TIME = config.getfloat('mode_interval', 'interval_time',
+                                                  fallback=Settings.MODE_INTERVAL_TIME)
+    settings.MODE_INTERVAL_DWELL_TIME = config.getfloat('mode_interval', 'dwell_time',
+                                                        fallback=Settings.MODE_INTERVAL_DWELL_TIME)
+    settings.MODE_INTERVAL_RAMP_TIME = config.getfloat('mode_interval', 'ramp_time',
+                                                       fallback=Settings.MODE_INTERVAL_RAMP_TIME)
+    settings.MODE_PULSATING_PUMP_TIME = config.getfloat('mode_pulsating', 'pump_time',
+                                                        fallback=Settings.MODE_PULSATING_PUMP_TIME)
+    settings.MODE_PULSATING_RELEASE_TIME = config.getfloat('mode_pulsating', 'release_time',
+                                                           fallback=Settings.MODE_PULSATING_RELEASE_TIME)
+    settings.JOURNAL_ACTUATOR_FILE = config.get('journal', 'actuator_file',
+                                                fallback=Settings.JOURNAL_ACTUATOR_FILE)
+    settings.CHECKPOINT_FILE = config.get('checkpoint', 'file',
+                                          fallback=Settings.CHECKPOINT_FILE)
+    settings.CHECKPOINT_AGE_MAX = config.getfloat('checkpoint', 'age_max',
+                                                  fallback=Settings.CHECKPOINT_AGE_MAX)
+    settings.RECORDER_DIRECTORY = config.get('recorder', 'directory',
+                                             fallback=Settings.RECORDER_DIRECTORY)
+    settings.CAPTURE_DIRECTORY = config.get('capture', 'directory',
+                                            fallback=Settings.CAPTURE_DIRECTORY)
+    settings.CAPTURE_FILE_SIZE_MAX = config.getint('capture', 'file_size_max',
+                                                   fallback=Settings.CAPTURE_FILE_SIZE_MAX)
+    settings.CAPTURE_FILES_MAX = config.getint('capture', 'files_max',
+                                               fallback=Settings.CAPTURE_FILES_MAX)
+    settings.INTERLOCK_ENABLED = config.getboolean('interlock', 'enabled',
+                                                   fallback=Settings.INTERLOCK_ENABLED)
+    settings.INTERLOCK_RATE_FALL_MAX = config.getfloat('interlock', 'rate_fall_max',
+                                                       fallback=Settings.INTERLOCK_RATE_FALL_MAX)
+    settings.INTERLOCK_RATE_RISE_MAX = config.getfloat('interlock', 'rate_rise_max',
+                                                       fallback=Settings.INTERLOCK_RATE_RISE_MAX)
+    settings.INTERLOCK_RATE_WINDOW = config.getfloat('interlock', 'rate_window',
+                                                     fallback=Settings.INTERLOCK_RATE_WINDOW)
+    settings.INTERLOCK_PUMP_ON_TIME_MAX = config.getfloat('interlock', 'pump_on_time_max',
+                                                          fallback=Settings.INTERLOCK_PUMP_ON_TIME_MAX)
+    settings.IDLE_DELAY = config.getfloat('idle', 'delay',
+                                          fallback=Settings.IDLE_DELAY)
+    settings.IDLE_CYCLE_TIME = config.getfloat('idle', 'cycle_time',
+                                               fallback=Settings.IDLE_CYCLE_TIME)
+    settings.IDLE_PRESSURE_DELTA = config.getfloat('idle', 'pressure_delta',
+                                                   fallback=Settings.IDLE_PRESSURE_DELTA)
+    settings.SUPERVISOR_CHECK_INTERVAL = config.getfloat('supervisor', 'check_interval',
+                                                         fallback=Settings.SUPERVISOR_CHECK_INTERVAL)
+    settings.SUPERVISOR_DEADLINE_PERIODS = config.getfloat('supervisor', 'deadline_periods',
+                                                           fallback=Settings.SUPERVISOR_DEADLINE_PERIODS)
+    settings.SUPERVISOR_BACKOFF_MIN = config.getfloat('supervisor', 'backoff_min',
+                                                      fallback=Settings.SUPERVISOR_BACKOFF_MIN)
+    settings.SUPERVISOR_BACKOFF_MAX = config.getfloat('supervisor', 'backoff_max',
+                                                      fallback=Settings.SUPERVISOR_BACKOFF_MAX)
+    settings.SHUTDOWN_DEADLINE = config.getfloat('shutdown', 'deadline',
+                                                 fallback=Settings.SHUTDOWN_DEADLINE)
+    settings.DEBUG_PROFILER = config.getboolean('debug', 'profiler',
+                                                fallback=Settings.DEBUG_PROFILER)
+    settings.DEBUG_PROFILER_INTERVAL = config.getfloat('debug', 'profiler_interval',
+                                                       fallback=Settings.DEBUG_PROFILER_INTERVAL)
 
     return settings
 
 
-def init_pressure_sensore(control_data: ControlData, settings: Settings) -> Thread:
+# one reload at a time, SIGHUP and PUT /config/reload share the settings
+_reload_lock = Lock()
+
+# setters of ControlData of the settings applied to it
+CONTROL_DATA_SETTERS = {
+    'LOG_LEVEL' : 'set_log_level',
+    # the tolerance of the session, not the override of an interval
+    'PRESSURE_CONTROL_TOLERANCE_PLUS' : 'set_session_tolerance_plus',
+    'PRESSURE_CONTROL_TOLERANCE_MINUS' : 'set_pressure_target_tolerance_minus',
+    'MODE_INTERVAL_PEAK_PRESSURE' : 'set_mode_interval_peak_pressure',
+    'MODE_INTERVAL_TIME' : 'set_mode_interval_time',
+    'MODE_INTERVAL_DWELL_TIME' : 'set_mode_interval_dwell_time',
+    'MODE_INTERVAL_RAMP_TIME' : 'set_mode_interval_ramp_time',
+    'MODE_PULSATING_PUMP_TIME' : 'set_mode_pulsating_pump_time',
+    'MODE_PULSATING_RELEASE_TIME' : 'set_mode_pulsating_release_time',
+}
+# workers whose cycle time the settings are
+WORKER_CYCLE_TIMES = {
+    'PRESSURE_CONTROL_CYCLE_TIME' : 'pressure_control',
+    'PRESSURE_SENSOR_CYCLE_TIME' : 'pressure_sensor',
+    'PUMP_CONTROL_CYCLE_TIME' : 'pump_control',
+    'VALVE_CONTROL_CYCLE_TIME' : 'valve_control',
+}
+
+
+def apply_config(control_data: ControlData, settings: Settings, names: tuple=None):
+    """
+    Applies the settings `names` to ControlData, all of them if None, so
+    that a reload leaves the values set through the API alone unless their
+    setting changed.
+    """
+    logger = logging.getLogger(__name__)
+    for name, setter in CONTROL_DATA_SETTERS.items():
+        if names is not None and name not in names:
+            continue
+        value = getattr(settings, name)
+        if name == 'MODE_INTERVAL_PEAK_PRESSURE':
+            pressure_min = control_data.get_pressure_min()
+            pressure_max = control_data.get_pressure_max()
+            if not pressure_min <= value <= pressure_max:
+                logger.warning(f'Ignoring interval peak pressure {value}, not within min={pressure_min} to max={pressure_max}')
+                continue
+        getattr(control_data, setter)(value)
+
+
+def parse_config(control_data: ControlData, config_file: str) -> Settings:
+    settings = read_config(config_file)
+    apply_config(control_data, settings)
+    return settings
+
+
+def reload_config(control_data: ControlData, settings: Settings, config_file: str, workers: dict) -> dict:
+    """
+    Re-parses the config file and applies the changed loop periods,
+    tolerances, mode parameters and log level to the running service.
+    Unchanged settings are not applied again, values set through the API
+    stay. The reload is refused if a hardware setting (pins, bus, I2C
+    address) changed. Other changed settings are reported as requiring a
+    restart. SIGHUP and the API reload one after the other.
+    """
+    with _reload_lock:
+        return _reload_config(control_data, settings, config_file, workers)
+
+
+def _reload_config(control_data: ControlData, settings: Settings, config_file: str, workers: dict) -> dict:
+    logger = logging.getLogger(__name__)
+    try:
+        settings_new = read_config(config_file)
+    except (OSError, configparser.Error, ValueError) as e:
+        logger.error(f'Config reload failed: {e}')
+        return { 'status' : 'failed', 'error' : str(e) }
+
+    values = settings.as_dict()
+    values_new = settings_new.as_dict()
+    changed = { name : [values[name], values_new[name]] for name in values if values[name] != values_new[name] }
+    refused = { name : value for name, value in changed.items() if name in Settings.HARDWARE }
+    if refused:
+        logger.warning(f'Config reload refused, hardware settings changed: {", ".join(refused)}')
+        return { 'status' : 'refused', 'refused' : refused }
+
+    applied = { name : value for name, value in changed.items() if name in Settings.LIVE }
+    restart_required = { name : value for name, value in changed.items() if name not in Settings.LIVE }
+    for name in applied:
+        setattr(settings, name, values_new[name])
+
+    apply_config(control_data, settings, tuple(applied))
+    if 'LOG_LEVEL' in applied:
+        logger.setLevel(settings.LOG_LEVEL)
+        # workers is still filled while the service starts
+        for worker in list(workers.values()):
+            worker.set_log_level(settings.LOG_LEVEL)
+    for name, worker in WORKER_CYCLE_TIMES.items():
+        if name in applied and worker in workers:
+            workers[worker].set_cycle_time(getattr(settings, name))
+
+    logger.info(f'Config reloaded, applied: {", ".join(applied) or "nothing"}')
+    return { 'status' : 'applied', 'applied' : applied, 'restart_required' : restart_required }
+
+
+def init_actuator_journal(control_data: ControlData, settings: Settings) -> ActuatorJournal:
+    if not settings.JOURNAL_ACTUATOR_FILE:
+        return None
+    actuator_journal = ActuatorJournal(settings.JOURNAL_ACTUATOR_FILE)
+    # session ids continue from the last journaled session
+    control_data.set_session_id(actuator_journal.get_session_id_last())
+    control_data.set_actuator_journal(actuator_journal)
+    return actuator_journal
+
+
+def init_state_checkpoint(control_data: ControlData, settings: Settings) -> StateCheckpoint:
+    if not settings.CHECKPOINT_FILE:
+        return None
+    logger = logging.getLogger(__name__)
+    state_checkpoint = StateCheckpoint(settings.CHECKPOINT_FILE)
+    checkpoint = state_checkpoint.read()
+    if checkpoint is not None:
+        age, state = checkpoint
+        if age <= settings.CHECKPOINT_AGE_MAX:
+            if state['shutdown_clean'] and state['session_on']:
+                # crash recovery only, the session was stopped on purpose
+                logger.info(f'Session {state["session_id"]} ended with an orderly shutdown -> not resuming it')
+                state = dict(state, session_on=False)
+            control_data.restore_state(state)
+            if state['session_on']:
+                logger.warning(f'Resuming session {state["session_id"]} from a {age:.3f}s old checkpoint')
+            else:
+                logger.info(f'Restored state from a {age:.3f}s old checkpoint')
+        else:
+            logger.info(f'Checkpoint is {age:.1f}s old -> starting with defaults')
+    control_data.set_state_checkpoint(state_checkpoint)
+    return state_checkpoint
+
+
+def init_interlock(control_data: ControlData, settings: Settings, pump_control: PumpControl, valve_control: ValveControl) -> Interlock:
+    if not settings.INTERLOCK_ENABLED:
+        return None
+    interlock = Interlock(control_data=control_data,
+                          pump_control=pump_control,
+                          valve_control=valve_control,
+                          rate_fall_max=settings.INTERLOCK_RATE_FALL_MAX,
+                          rate_rise_max=settings.INTERLOCK_RATE_RISE_MAX,
+                          rate_window=settings.INTERLOCK_RATE_WINDOW,
+                          pump_on_time_max=settings.INTERLOCK_PUMP_ON_TIME_MAX)
+    control_data.set_interlock(interlock)
+    return interlock
+
+
+def init_pressure_sensore(control_data: ControlData, settings: Settings, interlock: Interlock=None,
+                          smbus_factory: type=None, bmp280_factory: type=None) -> tuple:
+    logger = logging.getLogger(__name__)
+    setpoint_store = SetpointStore(settings.PRESSURE_SENSOR_SETPOINT_FILE)
+    # warm start from the last calibration, recalibrate only without one
+    setpoint = setpoint_store.load(settings.PRESSURE_SENSOR_SETPOINT_AGE_MAX)
+    if setpoint is not None:
+        control_data.set_pressure_setpoint(setpoint[0])
+        logger.info(f'Warm start with setpoint {setpoint[0]} from {setpoint[1].isoformat()}')
+    elif not control_data.event_session_on.is_set():
+        # never calibrate against the chamber of a resumed session
+        control_data.event_set_setpoint.set()
+
     pressure_sensor = PressureSensor(control_data=control_data,
                                      cycle_time=settings.PRESSURE_SENSOR_CYCLE_TIME,
                                      smbus_nr=settings.PRESSURE_SENSOR_BUS_NR,
-                                     i2c_addr=settings.PRESSURE_SENSOR_I2C_ADR)
-    pressure_sensor_thread = Thread(target=pressure_sensor.run)
+                                     i2c_addr=settings.PRESSURE_SENSOR_I2C_ADR,
+                                     setpoint_store=setpoint_store,
+                                     calibration_stderr=settings.PRESSURE_SENSOR_CALIBRATION_STDERR,
+                                     calibration_samples_max=settings.PRESSURE_SENSOR_CALIBRATION_SAMPLES_MAX,
+                                     backoff_min=settings.PRESSURE_SENSOR_BACKOFF_MIN,
+                                     backoff_max=settings.PRESSURE_SENSOR_BACKOFF_MAX,
+                                     smbus_factory=smbus_factory,
+                                     bmp280_factory=bmp280_factory,
+                                     interlock=interlock,
+                                     channels=settings.PRESSURE_SENSOR_CHANNELS,
+                                     fusion=settings.PRESSURE_SENSOR_FUSION,
+                                     disagreement_max=settings.PRESSURE_SENSOR_DISAGREEMENT_MAX,
+                                     idle_delay=settings.IDLE_DELAY,
+                                     idle_cycle_time=settings.IDLE_CYCLE_TIME,
+                                     idle_pressure_delta=settings.IDLE_PRESSURE_DELTA)
+    control_data.set_pressure_sensor(pressure_sensor)
+    pressure_sensor_thread = Thread(target=pressure_sensor.run, name='PressureSensor')
     pressure_sensor_thread.start()
-    return pressure_sensor_thread
+    return pressure_sensor, pressure_sensor_thread
+
+
+def init_supervisor(control_data: ControlData, settings: Settings, workers: dict, threads: dict) -> tuple:
+    supervisor = Supervisor(control_data=control_data,
+                            pump_control=workers['pump_control'],
+                            valve_control=workers['valve_control'],
+                            check_interval=settings.SUPERVISOR_CHECK_INTERVAL,
+                            deadline_periods=settings.SUPERVISOR_DEADLINE_PERIODS,
+                            backoff_min=settings.SUPERVISOR_BACKOFF_MIN,
+                            backoff_max=settings.SUPERVISOR_BACKOFF_MAX)
+    # a dead critical loop leaves the chamber uncontrolled
+    critical = ('pump_control', 'valve_control', 'pressure_sensor', 'pressure_control', 'session_control')
+    for name, thread in threads.items():
+        supervisor.add(thread.name, workers[name], thread, critical=name in critical)
+    control_data.set_supervisor(supervisor)
+    supervisor_thread = Thread(target=supervisor.run, name='Supervisor')
+    supervisor_thread.start()
+    return supervisor, supervisor_thread
+
+
+def init_profiler(control_data: ControlData, settings: Settings) -> SamplingProfiler:
+    if not settings.DEBUG_PROFILER:
+        return None
+    profiler = SamplingProfiler(control_data=control_data, interval=settings.DEBUG_PROFILER_INTERVAL)
+    control_data.set_profiler(profiler)
+    return profiler
 
 
-def init_pressure_control(control_data: ControlData, settings: Settings) -> Thread:
+def init_pressure_control(control_data: ControlData, settings: Settings) -> tuple:
     pressure_ctrl = PressureControl(control_data=control_data,
-                                    cycle_time=settings.PRESSURE_CONTROL_CYCLE_TIME)
-    pressure_ctrl_thread = Thread(target=pressure_ctrl.run)
+                                    cycle_time=settings.PRESSURE_CONTROL_CYCLE_TIME,
+                                    idle_cycle_time=settings.IDLE_CYCLE_TIME)
+    pressure_ctrl_thread = Thread(target=pressure_ctrl.run, name='PressureControl')
     pressure_ctrl_thread.start()
-    return pressure_ctrl_thread
+    return pressure_ctrl, pressure_ctrl_thread
 
 
-def init_valve_control(control_data: ControlData, settings: Settings) -> Thread:
+def init_valve_control(control_data: ControlData, settings: Settings, gpio=None) -> tuple:
     valve_ctrl = ValveControl(control_data=control_data,
                               pin_number=settings.VALVE_CONTROL_PIN_NUMBER,
-                              cycle_time=settings.VALVE_CONTROL_CYCLE_TIME)
-    valve_ctrl_thread = Thread(target=valve_ctrl.run)
+                              cycle_time=settings.VALVE_CONTROL_CYCLE_TIME,
+                              idle_cycle_time=settings.IDLE_CYCLE_TIME,
+                              gpio=gpio)
+    valve_ctrl_thread = Thread(target=valve_ctrl.run, name='ValveControl')
     valve_ctrl_thread.start()
-    return valve_ctrl_thread
+    return valve_ctrl, valve_ctrl_thread
 
-def init_pump_control(control_data: ControlData, settings: Settings) -> Thread:
+def init_pump_control(control_data: ControlData, settings: Settings, gpio=None) -> tuple:
     pump_ctrl = PumpControl(control_data=control_data,
                             pin_number=settings.PUMP_CONTROL_PIN_NUMBER,
-                            cycle_time=settings.PUMP_CONTROL_CYCLE_TIME)
-    pump_ctrl_thread = Thread(target=pump_ctrl.run)
+                            cycle_time=settings.PUMP_CONTROL_CYCLE_TIME,
+                            gpio=gpio)
+    pump_ctrl_thread = Thread(target=pump_ctrl.run, name='PumpControl')
     pump_ctrl_thread.start()
-    return pump_ctrl_thread
+    return pump_ctrl, pump_ctrl_thread
 
-def init_auto_setpoint(control_data: ControlData) -> Thread:
+def init_auto_setpoint(control_data: ControlData) -> tuple:
     auto_setpoint = AutoSetpoint(control_data=control_data)
-    auto_setpoint_thread = Thread(target=auto_setpoint.run)
+    auto_setpoint_thread = Thread(target=auto_setpoint.run, name='AutoSetpoint')
     auto_setpoint_thread.start()
-    return auto_setpoint_thread
+    return auto_setpoint, auto_setpoint_thread
 
-def init_api(control_data: ControlData, settings: Settings) -> tuple:
-    api = PmpctrlAPI(control_data)
+def init_session_recorder(control_data: ControlData, settings: Settings) -> tuple:
+    if not settings.RECORDER_DIRECTORY:
+        return None, None
+    session_recorder = SessionRecorder(control_data=control_data,
+                                       directory=settings.RECORDER_DIRECTORY)
+    control_data.set_session_recorder(session_recorder)
+    session_recorder_thread = Thread(target=session_recorder.run, name='SessionRecorder')
+    session_recorder_thread.start()
+    return session_recorder, session_recorder_thread
+
+def init_trace_capture(control_data: ControlData, settings: Settings) -> TraceCapture:
+    if not settings.CAPTURE_DIRECTORY:
+        return None
+    trace_capture = TraceCapture(control_data=control_data,
+                                 directory=settings.CAPTURE_DIRECTORY,
+                                 settings=settings.as_dict(),
+                                 file_size_max=settings.CAPTURE_FILE_SIZE_MAX,
+                                 files_max=settings.CAPTURE_FILES_MAX)
+    control_data.set_trace_capture(trace_capture)
+    return trace_capture
+
+def init_api(control_data: ControlData, settings: Settings, config_reload=None) -> tuple:
+    if settings.API_PROCESS:
+        return init_api_process(control_data, settings, config_reload)
+    # FastAPI, pydantic and uvicorn are imported only after the control path
+    # is up, so that a restarted service regains control of the pump first
+    import uvicorn
+    from pmpctrl.admission_control import AdmissionControl
+    from pmpctrl.pmpctrl_api import PmpctrlAPI
+
+    admission_control = AdmissionControl(rate=settings.API_RATE_LIMIT,
+                                         burst=settings.API_RATE_BURST,
+                                         concurrency_max=settings.API_CONCURRENCY_MAX)
+    api = PmpctrlAPI(control_data, config_reload=config_reload, admission_control=admission_control)
     # https://github.com/encode/uvicorn/issues/506#issuecomment-561071254
     api_server_config = uvicorn.Config(api,
                                        host="0.0.0.0",
                                        port=settings.API_PORT,
                                        log_level=settings.LOG_LEVEL,
-                                       loop='none')
-    api_server_config.log_config['formatters']['access']['fmt'] = '%(asctime)s.%(msecs)03dZ | %(levelname)-8s | %(name)-16s | %(funcName)-16s | %(message)s'
-    api_server_config.log_config['formatters']['access']['datefmt'] = '%Y-%m-%dT%H:%M:%S'
+                                       loop='none',
+                                       timeout_graceful_shutdown=settings.SHUTDOWN_DEADLINE)
+    api_server_config.log_config['formatters']['access']['fmt'] = pmpctrl.logging_config.LOG_FORMAT
+    api_server_config.log_config['formatters']['access']['datefmt'] = pmpctrl.logging_config.LOG_DATEFMT
     api_server = uvicorn.Server(config=api_server_config)
-    api_server_thread = Thread(target=api_server.run)
+    api_server_thread = Thread(target=api_server.run, name='uvicorn')
     api_server_thread.start()
     return api_server, api_server_thread
 
-def init_session_control(control_data: ControlData) -> Thread:
-    session_control = SessionControl(control_data)
-    session_control_thread = Thread(target=session_control.run)
+def init_api_process(control_data: ControlData, settings: Settings, config_reload=None) -> tuple:
+    from pmpctrl.api_process import ApiProcess
+
+    api_process = ApiProcess(control_data=control_data,
+                             port=settings.API_PORT,
+                             workers=settings.API_WORKERS,
+                             log_level=settings.LOG_LEVEL,
+                             journal_file=settings.JOURNAL_ACTUATOR_FILE,
+                             recorder_directory=settings.RECORDER_DIRECTORY,
+                             admission=(settings.API_RATE_LIMIT, settings.API_RATE_BURST, settings.API_CONCURRENCY_MAX),
+                             config_reload=config_reload,
+                             stop_timeout=settings.SHUTDOWN_DEADLINE)
+    api_process_thread = Thread(target=api_process.run, name='ApiProcess')
+    api_process_thread.start()
+    return api_process, api_process_thread
+
+def init_local_server(control_data: ControlData, settings: Settings) -> tuple:
+    if not settings.API_UNIX_SOCKET:
+        return None, None
+    from pmpctrl.local_server import LocalServer
+
+    local_server = LocalServer(control_data=control_data, path=settings.API_UNIX_SOCKET)
+    local_server_thread = Thread(target=local_server.run, name='LocalServer')
+    local_server_thread.start()
+    return local_server, local_server_thread
+
+def init_session_control(control_data: ControlData, settings: Settings) -> tuple:
+    session_control = SessionControl(control_data, idle_cycle_time=settings.IDLE_CYCLE_TIME)
+    session_control_thread = Thread(target=session_control.run, name='SessionControl')
     session_control_thread.start()
-    return session_control_thread
+    return session_control, session_control_thread
+
+
+def wait_for_first_sample(control_data: ControlData, timeout: float=10.0) -> float:
+    if control_data.wait_for_sample(0, timeout=timeout) is None:
+        return None
+    return monotonic() - TIME_START
+
+
+def wait_for_api(api_server, timeout: float=10.0) -> float:
+    deadline = monotonic() + timeout
+    while not api_server.started:
+        if api_server.should_exit or monotonic() > deadline:
+            return None
+        sleep(0.01)
+    return monotonic() - TIME_START
+
+
+def reload(signum, frame, reload_handler):
+    logger = logging.getLogger(__name__)
+    logger.info('SIGHUP recived -> reloading config')
+    # not within the handler, it would wait for a reload of the API in
+    # progress while interrupting the main thread
+    Thread(target=reload_handler, name='ConfigReload', daemon=True).start()
 
 
 def shutdown(signum, frame, control_data: ControlData):
     logger = logging.getLogger(__name__)
     logger.info('SIGTERM recived')
-    control_data.event_run.clear()
+    control_data.stop()
+
+
+def join_threads(threads: list, timeout: float) -> list:
+    """Joins `threads` within `timeout` seconds in all, returns the names of those still running."""
+    deadline = monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - monotonic(), 0.0))
+    return [thread.name for thread in threads if thread.is_alive()]
+
+
+def stop_service(control_data: ControlData, settings: Settings, workers: dict, supervisor_thread: Thread,
+                 api_server, api_server_thread: Thread, local_server, local_server_thread: Thread) -> list:
+    """
+    Stops the service in a fixed order, each stage within SHUTDOWN_DEADLINE
+    seconds: the supervisor, so that no loop is restarted, then the pump
+    off, the valve safe, the sensor with the other loops and last the API,
+    which serves the state until the end. A shutdown requested through
+    ControlData.stop, by SIGTERM or keyboard interrupt, then marks the
+    checkpoint clean, so that the next start does not resume its session.
+    Returns the names of the threads that missed their deadline.
+    """
+    logger = logging.getLogger(__name__)
+    deadline = settings.SHUTDOWN_DEADLINE
+    supervisor = workers.get('supervisor')
+    time_start = monotonic()
+    time_stage = time_start
+    stages = []
+    stuck = []
+
+    def stage(name: str, running: list):
+        nonlocal time_stage
+        now = monotonic()
+        stages.append(f'{name} {now - time_stage:.3f}s')
+        time_stage = now
+        if running:
+            logger.error(f'shutdown: {name} missed its deadline of {deadline}s, still running: {", ".join(running)}')
+            stuck.extend(running)
+
+    def stop_actuator(name: str, loop: str):
+        time_end = monotonic() + deadline
+        running = supervisor.join((loop,), deadline) if supervisor is not None else []
+        workers[name].shutdown(max(time_end - monotonic(), 0.0))
+        return running
+
+    # requested, not an exception of run
+    requested = control_data.event_stop.is_set()
+    # every loop wakes up and exits, the actuators are left to the stages
+    control_data.stop()
+    if supervisor_thread is not None:
+        stage('supervisor', join_threads([supervisor_thread], deadline))
+    if 'pump_control' in workers:
+        stage('pump', stop_actuator('pump_control', 'PumpControl'))
+    if 'valve_control' in workers:
+        stage('valve', stop_actuator('valve_control', 'ValveControl'))
+    if supervisor is not None:
+        # the loops restarted by the supervisor run in threads of their own
+        loops = tuple(loop for loop in supervisor.get_status()['loops'] if loop not in stuck)
+        stage('sensor', supervisor.join(loops, deadline))
+    threads = []
+    if api_server is not None:
+        api_server.should_exit = True
+        threads.append(api_server_thread)
+    if local_server is not None:
+        local_server.stop()
+        threads.append(local_server_thread)
+    stage('api', join_threads(threads, deadline))
+    if requested:
+        control_data.set_shutdown_clean()
+
+    logger.info(f'shutdown: stopped in {monotonic() - time_start:.3f}s ({", ".join(stages)})')
+    return stuck
 
 
-def run(control_data: ControlData, settings: Settings):
+def run(control_data: ControlData, settings: Settings, config_file: str):
     try:
         logger = logging.getLogger(__name__)
         logger.setLevel(settings.LOG_LEVEL)
+        workers = {}
+        supervisor_thread = None
+        api_server = api_server_thread = None
+        local_server = local_server_thread = None
+
+        actuator_journal = init_actuator_journal(control_data, settings)
+        state_checkpoint = init_state_checkpoint(control_data, settings)
+        trace_capture = init_trace_capture(control_data, settings)
+        # the command interfaces get the ControlData capturing their calls
+        commands = control_data
+        if trace_capture is not None:
+            workers['trace_capture'] = trace_capture
+            commands = CommandCapture(control_data, trace_capture)
+
+        # control path first: GPIO, the interlock on the first sample, sensor
+        # and pressure control
+        workers['pump_control'], pump_control = init_pump_control(control_data, settings)
+        workers['valve_control'], valve_control = init_valve_control(control_data, settings)
+        interlock = init_interlock(control_data, settings, workers['pump_control'], workers['valve_control'])
+        if interlock is not None:
+            workers['interlock'] = interlock
+        workers['pressure_sensor'], pressure_sensor = init_pressure_sensore(control_data, settings, interlock)
+        workers['pressure_control'], pressure_control = init_pressure_control(control_data, settings)
+        workers['session_control'], session_control = init_session_control(control_data, settings)
+
+        # before waiting for anything, the default action of SIGHUP ends the process
+        reload_handler = partial(reload_config, commands, settings, config_file, workers)
+        signal.signal(signal.SIGHUP, partial(reload, reload_handler=reload_handler))
+
+        time_first_sample = wait_for_first_sample(control_data)
+        if time_first_sample is None:
+            logger.warning('startup: no pressure sample received yet')
+        else:
+            logger.info(f'startup: time to first sample {time_first_sample:.3f}s')
+
+        # everything else afterwards
+        workers['auto_setpoint'], auto_setpoint = init_auto_setpoint(control_data)
+        session_recorder, session_recorder_thread = init_session_recorder(control_data, settings)
+        if session_recorder is not None:
+            workers['session_recorder'] = session_recorder
+        profiler = init_profiler(control_data, settings)
+        if profiler is not None:
+            workers['profiler'] = profiler
+        threads = {
+            'pump_control' : pump_control,
+            'valve_control' : valve_control,
+            'pressure_sensor' : pressure_sensor,
+            'pressure_control' : pressure_control,
+            'session_control' : session_control,
+            'auto_setpoint' : auto_setpoint
+        }
+        if session_recorder_thread is not None:
+            threads['session_recorder'] = session_recorder_thread
+        workers['supervisor'], supervisor_thread = init_supervisor(control_data, settings, workers, threads)
+        api_server, api_server_thread = init_api(commands, settings, reload_handler)
+        local_server, local_server_thread = init_local_server(commands, settings)
+
+        time_api_ready = wait_for_api(api_server)
+        if time_api_ready is None:
+            logger.warning('startup: API not ready yet')
+        else:
+            logger.info(f'startup: time to API ready {time_api_ready:.3f}s')
 
-        pressure_sensor = init_pressure_sensore(control_data, settings)
-        pressure_control = init_pressure_control(control_data, settings)
-        pump_control = init_pump_control(control_data, settings)
-        valve_control = init_valve_control(control_data, settings)
-        auto_setpoint = init_auto_setpoint(control_data)
-        api_server, api_server_thread = init_api(control_data, settings)
-        session_control = init_session_control(control_data)
-    
         while control_data.event_run.is_set():
             session_on = ' ON' if control_data.event_session_on.is_set() else 'OFF'
             pressure_actual = control_data.get_pressure_actual()
             pressure_target = control_data.get_pressure_target()
             pressure_target_tolerance_plus = control_data.get_pressure_target_tolerance_plus()
             pressure_target_tolerance_minus = control_data.get_pressure_target_tolerance_minus()
-            events = f'SESSION = {session_on}'
             pressure = f'Pressue: ACT = {pressure_actual:.2f}, TGT = {pressure_target:.2f} +{pressure_target_tolerance_plus:.2f}/-{pressure_target_tolerance_minus:.2f}'
             logger.info(f"Session: {session_on} | {pressure}")
-            sleep(1.0)
+            control_data.event_stop.wait(1.0)
     except KeyboardInterrupt:
             logger.info('Program stopped by user through keyboard interrupt.')
-            control_data.event_run.clear()
+            control_data.stop()
     finally:
-        api_server.should_exit = True
-        api_server_thread.join()
-        pressure_sensor.join()
-        pressure_control.join()
-        valve_control.join()
-        auto_setpoint.join()
-        session_control.join()
+        if stop_service(control_data, settings, workers, supervisor_thread,
+                        api_server, api_server_thread, local_server, local_server_thread):
+            control_data.event_error.set()
 
 
 def main():
@@ -179,11 +760,14 @@ def main():
     sigterm_handler = partial(shutdown, control_data=control_data)
     signal.signal(signal.SIGTERM, sigterm_handler)
     settings = parse_config(control_data, args.config)
-    run(control_data, settings)
+    run(control_data, settings, args.config)
     if not control_data.event_error.is_set():
         sys.exit(0)
     else:
-        sys.exit(1)
+        # a thread stuck past the shutdown would keep the process alive,
+        # atexit does not run, the queued log records are written first
+        pmpctrl.logging_config.queue_listener.stop()
+        os._exit(1)
 
 
 if __name__ == "__main__":
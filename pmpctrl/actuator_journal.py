@@ -0,0 +1,168 @@
+import logging
+import os
+import pmpctrl.logging_config
+import struct
+
+from pmpctrl.control_data import ControlData
+from statistics import fmean
+from threading import Lock
+
+
+class ActuatorJournal:
+    """
+    Append-only binary journal of every actuator edge.
+
+    Each record is 16 bytes: monotonic timestamp in ns, session id,
+    actuator, new state and cause (see ControlData.ACTUATOR_* and
+    ControlData.CAUSE_*). Session starts and stops are recorded as edges of
+    ControlData.ACTUATOR_SESSION. An index of the file offset of every
+    session start is kept in memory, so per session statistics only read
+    the records of that session.
+
+    A read-only journal follows a file written by another process, the
+    index is extended with the records appended since the last read.
+    """
+    RECORD = struct.Struct('<QIBBBx')
+
+    _logger: logging.Logger
+    _path: str
+    _fd: int
+    _lock: Lock
+    _size: int
+    _session_offsets: dict
+    _read_only: bool
+
+    def __init__(self, path: str, read_only: bool=False):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = path
+        self._lock = Lock()
+        self._read_only = read_only
+        self._fd = None
+        self._session_offsets = {}
+        self._size = 0
+        if not read_only:
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # ignore a partially written record at the end
+            size = os.path.getsize(path)
+            if size % self.RECORD.size:
+                self._logger.warning(f'Truncating partial record at the end of {self._path}')
+                os.truncate(self._path, size - size % self.RECORD.size)
+        with self._lock:
+            self._update_index()
+
+    def _update_index(self):
+        # called with the lock held
+        try:
+            size = os.path.getsize(self._path)
+        except OSError:
+            return
+        size -= size % self.RECORD.size
+        if size <= self._size:
+            return
+        with open(self._path, 'rb') as f:
+            f.seek(self._size)
+            data = f.read(size - self._size)
+        size = self._size + len(data) - len(data) % self.RECORD.size
+        for offset in range(0, size - self._size, self.RECORD.size):
+            _, session_id, actuator, state, _ = self.RECORD.unpack_from(data, offset)
+            if actuator == ControlData.ACTUATOR_SESSION and state and session_id not in self._session_offsets:
+                self._session_offsets[session_id] = self._size + offset
+        self._size = size
+
+    def append(self, time_ns: int, session_id: int, actuator: int, state: bool, cause: int):
+        if self._read_only:
+            raise PermissionError(f'actuator journal {self._path} is opened read-only')
+        record = self.RECORD.pack(time_ns, session_id, actuator, int(state), cause)
+        with self._lock:
+            if actuator == ControlData.ACTUATOR_SESSION and state and session_id not in self._session_offsets:
+                self._session_offsets[session_id] = self._size
+            try:
+                os.write(self._fd, record)
+            except OSError as e:
+                self._logger.error(f'Could not write actuator journal: {e}')
+                return
+            self._size += self.RECORD.size
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+
+    def get_session_ids(self) -> list:
+        with self._lock:
+            if self._read_only:
+                self._update_index()
+            return sorted(self._session_offsets)
+
+    def get_session_id_last(self) -> int:
+        with self._lock:
+            if self._read_only:
+                self._update_index()
+            return max(self._session_offsets, default=0)
+
+    def read_session(self, session_id: int) -> list:
+        """Returns the records (time_ns, session_id, actuator, state, cause) of a session."""
+        with self._lock:
+            if self._read_only:
+                self._update_index()
+            offset = self._session_offsets.get(session_id)
+            size = self._size
+        if offset is None:
+            return None
+        records = []
+        with open(self._path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        for record in self.RECORD.iter_unpack(data):
+            if record[1] != session_id:
+                continue
+            records.append(record)
+            if record[2] == ControlData.ACTUATOR_SESSION and not record[3]:
+                break
+        return records
+
+    def get_session_statistics(self, session_id: int, time_now_ns: int=None) -> dict:
+        """
+        Computes on-time, start count and mean cycle period of pump and valve
+        for a session. Intervals still open at the end of the records are
+        closed at `time_now_ns` (running session) or at the last record.
+        """
+        records = self.read_session(session_id)
+        if records is None:
+            return None
+
+        time_start = records[0][0]
+        time_end = records[-1][0]
+        session_running = not (records[-1][2] == ControlData.ACTUATOR_SESSION and not records[-1][3])
+        if session_running and time_now_ns is not None:
+            time_end = max(time_end, time_now_ns)
+        duration = max(time_end - time_start, 0) / 1e9
+
+        statistics = {
+            'session_id' : session_id,
+            'running' : session_running,
+            'duration' : duration,
+        }
+        for actuator, name in ((ControlData.ACTUATOR_PUMP, 'pump'), (ControlData.ACTUATOR_VALVE, 'valve')):
+            starts = []
+            time_on = 0
+            time_edge_on = None
+            for time_ns, _, record_actuator, state, _ in records:
+                if record_actuator != actuator:
+                    continue
+                if state and time_edge_on is None:
+                    time_edge_on = time_ns
+                    starts.append(time_ns)
+                elif not state and time_edge_on is not None:
+                    time_on += max(time_ns - time_edge_on, 0)
+                    time_edge_on = None
+            if time_edge_on is not None:
+                time_on += max(time_end - time_edge_on, 0)
+            periods = [(b - a) / 1e9 for a, b in zip(starts, starts[1:])]
+            statistics[name] = {
+                'starts' : len(starts),
+                'on_time' : time_on / 1e9,
+                'duty_cycle' : time_on / 1e9 / duration if duration > 0 else None,
+                'cycle_period_mean' : fmean(periods) if periods else None,
+            }
+        return statistics
@@ -0,0 +1,165 @@
+import json
+import logging
+import math
+import pmpctrl.logging_config
+
+from threading import Lock
+from time import monotonic
+
+
+class AdmissionControl:
+    """
+    Decides which API requests are served, so that a misbehaving client
+    cannot starve the control loops.
+
+    Every client (by address) has a token bucket refilled with `rate`
+    tokens per second up to `burst`, each request takes one token. At most
+    `concurrency_max` requests are handled at once. Requests in PRIORITY,
+    the commands that bring the chamber to a safe state, are always
+    admitted and count neither against the bucket nor the cap, they are
+    tracked in flight apart from the other requests. A limit of
+    0 disables it. Rejected requests are answered with 429 and a
+    Retry-After header by AdmissionMiddleware.
+    """
+    PRIORITY = (('PUT', '/session/stop'),
+                ('PUT', '/pump/off'),
+                ('PUT', '/valve/open'))
+    CLIENTS_MAX = 1024
+    WINDOW = 60
+
+    _logger: logging.Logger
+    _lock: Lock
+    _rate: float
+    _burst: float
+    _concurrency_max: int
+    _buckets: dict
+    _in_flight: int
+    _priority_in_flight: int
+
+    def __init__(self, rate: float=0, burst: float=0, concurrency_max: int=0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = Lock()
+        self._rate = rate
+        self._burst = max(burst, 1.0) if rate else 0
+        self._concurrency_max = concurrency_max
+        self._buckets = {}
+        self._in_flight = 0
+        self._priority_in_flight = 0
+        self._in_flight_max = 0
+        self._admitted = 0
+        self._priority = 0
+        self._rejected_rate = 0
+        self._rejected_concurrency = 0
+        # rejections per second of the last WINDOW seconds
+        self._window = [0] * self.WINDOW
+        self._window_second = 0
+
+    def _advance_window(self, now: float):
+        # called with the lock held, clears the seconds passed since the last call
+        second = int(now)
+        if second - self._window_second >= self.WINDOW:
+            self._window = [0] * self.WINDOW
+        else:
+            for s in range(self._window_second + 1, second + 1):
+                self._window[s % self.WINDOW] = 0
+        self._window_second = max(self._window_second, second)
+
+    def _count_rejection(self, now: float):
+        # called with the lock held
+        self._advance_window(now)
+        self._window[self._window_second % self.WINDOW] += 1
+
+    def admit(self, method: str, path: str, client: str) -> float:
+        """
+        Returns None if the request is admitted, it must be released with
+        `release` of the same method and path once handled. Otherwise returns the seconds after which
+        the client should retry.
+        """
+        now = monotonic()
+        with self._lock:
+            if (method, path) in self.PRIORITY:
+                self._priority += 1
+                self._priority_in_flight += 1
+                return None
+
+            if self._concurrency_max and self._in_flight >= self._concurrency_max:
+                self._rejected_concurrency += 1
+                self._count_rejection(now)
+                return 1.0
+
+            if self._rate:
+                tokens, time_last = self._buckets.pop(client, (self._burst, now))
+                tokens = min(self._burst, tokens + (now - time_last) * self._rate)
+                if len(self._buckets) >= self.CLIENTS_MAX:
+                    # forget the least recently seen client, full bucket on return
+                    del self._buckets[next(iter(self._buckets))]
+                if tokens < 1.0:
+                    self._buckets[client] = (tokens, now)
+                    self._rejected_rate += 1
+                    self._count_rejection(now)
+                    return (1.0 - tokens) / self._rate
+                self._buckets[client] = (tokens - 1.0, now)
+
+            self._admitted += 1
+            self._in_flight += 1
+            self._in_flight_max = max(self._in_flight_max, self._in_flight)
+            return None
+
+    def release(self, method: str, path: str):
+        with self._lock:
+            if (method, path) in self.PRIORITY:
+                self._priority_in_flight -= 1
+            else:
+                self._in_flight -= 1
+
+    def get_statistics(self) -> dict:
+        with self._lock:
+            self._advance_window(monotonic())
+            return {
+                'rate' : self._rate,
+                'burst' : self._burst,
+                'concurrency_max' : self._concurrency_max,
+                'in_flight' : self._in_flight,
+                'in_flight_max' : self._in_flight_max,
+                'priority_in_flight' : self._priority_in_flight,
+                'clients' : len(self._buckets),
+                'admitted' : self._admitted,
+                'priority' : self._priority,
+                'rejected_rate' : self._rejected_rate,
+                'rejected_concurrency' : self._rejected_concurrency,
+                f'rejected_last_{self.WINDOW}s' : sum(self._window),
+            }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying an AdmissionControl to every HTTP request."""
+    def __init__(self, app, admission_control: AdmissionControl):
+        self._app = app
+        self._admission_control = admission_control
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self._app(scope, receive, send)
+            return
+        client = scope['client'][0] if scope.get('client') else ''
+        method, path = scope['method'], scope['path']
+        retry_after = self._admission_control.admit(method, path, client)
+        if retry_after is not None:
+            await self._reject(send, retry_after)
+            return
+        try:
+            await self._app(scope, receive, send)
+        finally:
+            self._admission_control.release(method, path)
+
+    @staticmethod
+    async def _reject(send, retry_after: float):
+        body = json.dumps({ 'detail' : 'Too many requests: retry later' }).encode()
+        await send({
+            'type' : 'http.response.start',
+            'status' : 429,
+            'headers' : [(b'content-type', b'application/json'),
+                         (b'content-length', str(len(body)).encode()),
+                         (b'retry-after', str(math.ceil(retry_after)).encode())],
+        })
+        await send({ 'type' : 'http.response.body', 'body' : body })
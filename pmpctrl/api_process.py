@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import pmpctrl.logging_config
+import signal
+import socket
+import subprocess
+import sys
+
+from pmpctrl.command_server import CommandServer
+from pmpctrl.control_data import ControlData
+from pmpctrl.state_snapshot import StateSnapshot
+from threading import Thread
+from time import sleep
+from typing import Callable
+
+ENV_SNAPSHOT = 'PMPCTRL_SNAPSHOT'
+ENV_COMMAND_ADDRESS = 'PMPCTRL_COMMAND_ADDRESS'
+ENV_AUTHKEY = 'PMPCTRL_AUTHKEY'
+ENV_LOG_LEVEL = 'PMPCTRL_LOG_LEVEL'
+ENV_JOURNAL_FILE = 'PMPCTRL_JOURNAL_FILE'
+ENV_RECORDER_DIRECTORY = 'PMPCTRL_RECORDER_DIRECTORY'
+ENV_ADMISSION = 'PMPCTRL_ADMISSION'
+ENV_PROFILER = 'PMPCTRL_PROFILER'
+
+
+class ApiProcess:
+    """
+    Runs PmpctrlAPI in a child process with one or more uvicorn workers, so
+    that request handling does not share the GIL with the control loops.
+
+    The state is published to the workers through a StateSnapshot in
+    shared memory, refreshed on every ControlData change and every
+    `refresh_interval` seconds for events set directly by the workers.
+    Commands come back through a CommandServer. `started` and
+    `should_exit` mirror uvicorn.Server, so the process is handled like the
+    in-process server. `admission` is (rate, burst, concurrency_max) of the
+    AdmissionControl of each worker. On exit the process is given
+    `stop_timeout` seconds to finish its requests before it is killed.
+    """
+    _logger: logging.Logger
+    _control_data: ControlData
+    _snapshot: StateSnapshot
+    _command_server: CommandServer
+    _process: subprocess.Popen
+
+    def __init__(self,
+                 control_data: ControlData,
+                 port: int,
+                 workers: int=1,
+                 log_level: int=logging.WARNING,
+                 journal_file: str=None,
+                 recorder_directory: str=None,
+                 admission: tuple=(0, 0, 0),
+                 config_reload: Callable=None,
+                 refresh_interval: float=0.05,
+                 stop_timeout: float=10.0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._port = port
+        self._workers = workers
+        self._log_level = log_level
+        self._journal_file = journal_file
+        self._recorder_directory = recorder_directory
+        self._admission = admission
+        self._refresh_interval = refresh_interval
+        self._stop_timeout = stop_timeout
+        self._snapshot = StateSnapshot()
+        control_data.set_state_snapshot(self._snapshot)
+        self._command_server = CommandServer(control_data, config_reload=config_reload)
+        self._process = None
+        self.should_exit = False
+
+    @property
+    def started(self) -> bool:
+        if self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('127.0.0.1', self._port), timeout=0.1).close()
+        except OSError:
+            return False
+        return True
+
+    def run(self):
+        command_server_thread = Thread(target=self._command_server.run, name='CommandServer')
+        command_server_thread.start()
+        env = dict(os.environ)
+        env[ENV_SNAPSHOT] = self._snapshot.name
+        env[ENV_COMMAND_ADDRESS] = self._command_server.address
+        env[ENV_AUTHKEY] = self._command_server.authkey.hex()
+        env[ENV_LOG_LEVEL] = str(self._log_level)
+        env[ENV_JOURNAL_FILE] = self._journal_file or ''
+        env[ENV_RECORDER_DIRECTORY] = self._recorder_directory or ''
+        env[ENV_ADMISSION] = ','.join(str(value) for value in self._admission)
+        env[ENV_PROFILER] = '1' if self._control_data.get_profiler() is not None else ''
+        try:
+            self._process = subprocess.Popen([sys.executable, '-m', 'pmpctrl.api_process',
+                                              '--port', str(self._port),
+                                              '--workers', str(self._workers),
+                                              '--stop-timeout', str(self._stop_timeout)],
+                                             env=env)
+            self._logger.info(f'API process {self._process.pid} started with {self._workers} worker(s)')
+            while not self.should_exit and self._process.poll() is None:
+                self._control_data.publish_state()
+                sleep(self._refresh_interval)
+            if self._process.poll() is not None and not self.should_exit:
+                self._logger.error(f'API process exited with {self._process.returncode}')
+        finally:
+            if self._process is not None and self._process.poll() is None:
+                self._process.terminate()
+                try:
+                    self._process.wait(timeout=self._stop_timeout)
+                except subprocess.TimeoutExpired:
+                    self._logger.warning('API process did not exit in time -> killing it')
+                    self._process.kill()
+                    self._process.wait()
+            self._command_server.stop()
+            command_server_thread.join()
+            self._control_data.set_state_snapshot(None)
+            self._snapshot.close()
+
+
+def create_app():
+    """uvicorn app factory of the API process, configured through the environment."""
+    from pmpctrl.admission_control import AdmissionControl
+    from pmpctrl.control_data_proxy import ControlDataProxy
+    from pmpctrl.pmpctrl_api import PmpctrlAPI
+
+    control_data = ControlDataProxy(snapshot_name=os.environ[ENV_SNAPSHOT],
+                                    command_address=os.environ[ENV_COMMAND_ADDRESS],
+                                    authkey=bytes.fromhex(os.environ[ENV_AUTHKEY]),
+                                    log_level=int(os.environ.get(ENV_LOG_LEVEL, logging.WARNING)),
+                                    journal_file=os.environ.get(ENV_JOURNAL_FILE) or None,
+                                    recorder_directory=os.environ.get(ENV_RECORDER_DIRECTORY) or None,
+                                    profiler=bool(os.environ.get(ENV_PROFILER)))
+    rate, burst, concurrency_max = os.environ.get(ENV_ADMISSION, '0,0,0').split(',')
+    admission_control = AdmissionControl(rate=float(rate), burst=float(burst), concurrency_max=int(concurrency_max))
+    return PmpctrlAPI(control_data, config_reload=control_data.config_reload, admission_control=admission_control)
+
+
+def watch_parent(parent_pid: int, interval: float=1.0):
+    # the API must not outlive the control process
+    while os.getppid() == parent_pid:
+        sleep(interval)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', help='API port', type=int, required=True)
+    parser.add_argument('--workers', help='uvicorn worker processes', type=int, default=1)
+    parser.add_argument('--stop-timeout', help='seconds open requests may take on exit', type=float, default=10.0)
+    return parser.parse_args()
+
+
+def main():
+    import uvicorn
+
+    args = parse_arguments()
+    log_level = int(os.environ.get(ENV_LOG_LEVEL, logging.WARNING))
+    Thread(target=watch_parent, args=(os.getppid(),), name='watch_parent', daemon=True).start()
+    log_config = uvicorn.config.LOGGING_CONFIG
+    log_config['formatters']['access']['fmt'] = pmpctrl.logging_config.LOG_FORMAT
+    log_config['formatters']['access']['datefmt'] = pmpctrl.logging_config.LOG_DATEFMT
+    uvicorn.run('pmpctrl.api_process:create_app',
+                factory=True,
+                host='0.0.0.0',
+                port=args.port,
+                workers=args.workers,
+                log_level=log_level,
+                log_config=log_config,
+                timeout_graceful_shutdown=args.stop_timeout)
+
+
+if __name__ == '__main__':
+    main()
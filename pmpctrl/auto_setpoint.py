@@ -2,13 +2,15 @@ import logging
 import pmpctrl.logging_config
 
 from pmpctrl.control_data import ControlData
-from time import sleep
 from statistics import fmean
 from statistics import stdev
 
 class AutoSetpoint:
     _logger: logging.Logger
     _cycle_time: float
+    _sequence: int
+    _block: list
+    _block_start_ns: int
 
     def __init__(self, control_data: ControlData, cycle_time: float=0.5):
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -16,25 +18,61 @@ class AutoSetpoint:
         self._control_data = control_data
         self._cycle_time = cycle_time
         self._pressure_readings = []
+        self._sequence = 0
+        self._block = []
+        self._block_start_ns = None
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def set_cycle_time(self, cycle_time: float):
+        self._cycle_time = cycle_time
+
+    def step(self, timeout: float=0.0):
+        """
+        Consumes the next sample, waiting up to `timeout` seconds for it.
+        Every sample is used, one reading is the mean of all samples within
+        cycle_time.
+        """
+        sample = self._control_data.wait_for_sample(self._sequence, timeout=timeout)
+        if sample is None:
+            return
+        self._sequence = sample.sequence
+        if self._control_data.event_session_on.is_set():
+            self._control_data.event_auto_setpoint.clear()
+            self._block = []
+            self._block_start_ns = None
+            return
+        if not self._control_data.event_auto_setpoint.is_set():
+            return
+
+        if self._block_start_ns is None:
+            self._block_start_ns = sample.time_ns
+        if sample.value > 0:
+            self._block.append(sample.value)
+        if sample.time_ns - self._block_start_ns < self._cycle_time * 1e9:
+            return
+        self._block_start_ns = None
+        if not self._block:
+            return
+        self._logger.debug('performing auto setpoint procedure')
+        if len(self._pressure_readings) >= 240:
+            self._pressure_readings.pop(0)
+        self._pressure_readings.append(fmean(self._block))
+        self._block = []
+        if len(self._pressure_readings) > 1:
+            setpoint = fmean(self._pressure_readings)
+            self._control_data.set_pressure_setpoint(setpoint)
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug('sample count: %s -> new setpoint: %s, stdev: %s',
+                                   len(self._pressure_readings), setpoint, stdev(self._pressure_readings))
 
     def run(self):
         try:
             while self._control_data.event_run.is_set():
-                if self._control_data.event_session_on.is_set():
-                    self._control_data.event_auto_setpoint.clear()
-                elif not self._control_data.event_session_on.is_set() and self._control_data.event_auto_setpoint.is_set():
-                    self._logger.debug(f'performing auto setpoint procedure')
-                    if len(self._pressure_readings) >= 240:
-                        self._pressure_readings.pop(0)
-                    pressure_actual = self._control_data.get_pressure_actual()
-                    if pressure_actual > 0:
-                        self._pressure_readings.append(pressure_actual)
-                    if len(self._pressure_readings) > 1:
-                        setpoint = fmean(self._pressure_readings)
-                        self._control_data.set_pressure_setpoint(setpoint)
-                        self._logger.debug(f'sample count: {len(self._pressure_readings)} -> new setpoint: {setpoint}, stdev: {stdev(self._pressure_readings)}')
-                sleep(self._cycle_time)
+                self._control_data.heartbeat(self.__class__.__name__, self._cycle_time)
+                self.step(timeout=self._cycle_time)
             self._logger.info('run event is FALSE -> Exiting')
         except KeyboardInterrupt:
             self._logger.info('Program stopped by user through keyboard interrupt.')
-            self._control_data.event_run.clear()
\ No newline at end of file
+            self._control_data.stop()
@@ -0,0 +1,54 @@
+import time
+
+from threading import Event
+
+
+class Clock:
+    """
+    Monotonic time source of the control loops. All timing in the package
+    goes through an instance of this class, held by ControlData, so that it
+    can be replaced by a VirtualClock for simulations.
+    """
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def monotonic_ns(self) -> int:
+        return time.monotonic_ns()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def wait(self, event: Event, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for `event`, returns its state."""
+        return event.wait(timeout)
+
+
+class VirtualClock(Clock):
+    """
+    Clock that only advances when told to. Sleeping and waiting advance the
+    time immediately, a simulation driver moves it with `advance_to`.
+    """
+    _time_ns: int
+
+    def __init__(self, start_ns: int=0):
+        self._time_ns = start_ns
+
+    def monotonic(self) -> float:
+        return self._time_ns / 1e9
+
+    def monotonic_ns(self) -> int:
+        return self._time_ns
+
+    def advance(self, seconds: float):
+        self._time_ns += max(int(seconds * 1e9), 0)
+
+    def advance_to(self, time_ns: int):
+        self._time_ns = max(self._time_ns, time_ns)
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def wait(self, event: Event, timeout: float) -> bool:
+        if not event.is_set():
+            self.advance(timeout)
+        return event.is_set()
@@ -0,0 +1,140 @@
+import logging
+import os
+import pmpctrl.logging_config
+import tempfile
+
+from multiprocessing.connection import Client
+from multiprocessing.connection import Connection
+from multiprocessing.connection import Listener
+from pmpctrl.control_data import ControlData
+from threading import Thread
+from typing import Callable
+
+
+class CommandServer:
+    """
+    Applies commands of API processes to ControlData in the control
+    process. Every API process connects once over a Unix domain socket and
+    sends (command, args) messages on its connection, each one answered
+    with ('ok', result) or ('error', message) after it was applied. The
+    state snapshot is republished before the answer, so the API process
+    reads its own writes.
+    """
+    # ControlData methods an API process may call
+    METHODS = ('set_mode',
+               'set_pressure_setpoint',
+               'set_pressure_target',
+               'set_pressure_target_tolerance_minus',
+               'set_pressure_target_tolerance_plus',
+               'set_session_tolerance_plus',
+               'set_mode_interval_peak_pressure',
+               'set_mode_interval_time',
+               'set_mode_interval_dwell_time',
+               'set_mode_interval_ramp_time',
+               'set_mode_pulsating_pump_time',
+               'set_mode_pulsating_release_time',
+               'request_pump_on',
+               'request_pump_off',
+               'request_valve_open',
+               'request_valve_close',
+               'start_session',
+               'stop_session')
+    # events an API process may set or clear
+    EVENTS = ('event_auto_setpoint',
+              'event_set_setpoint')
+    # methods an API process may call on the objects registered on
+    # ControlData, resolved through get_<name>
+    OBJECTS = { 'interlock' : ('get_status',
+                               'reset'),
+                'pressure_sensor' : ('get_status',),
+                'profiler' : ('start',
+                              'get_result'),
+                'supervisor' : ('get_status',) }
+    POLL_TIMEOUT = 0.5
+
+    _logger: logging.Logger
+    _control_data: ControlData
+    _config_reload: Callable
+    _listener: Listener
+    _running: bool
+    _threads: list
+
+    def __init__(self, control_data: ControlData, config_reload: Callable=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._config_reload = config_reload
+        self.authkey = os.urandom(32)
+        self._directory = tempfile.mkdtemp(prefix='pmpctrl-')
+        self.address = os.path.join(self._directory, 'command.sock')
+        self._listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        self._running = False
+        self._threads = []
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def _apply(self, command: str, args: tuple):
+        if command in self.METHODS:
+            return getattr(self._control_data, command)(*args)
+        event, _, action = command.rpartition('.')
+        if event in self.EVENTS and action in ('set', 'clear'):
+            getattr(getattr(self._control_data, event), action)()
+            return None
+        if action in self.OBJECTS.get(event, ()):
+            target = getattr(self._control_data, f'get_{event}')()
+            if target is not None:
+                return getattr(target, action)(*args)
+        if command == 'config_reload' and self._config_reload is not None:
+            return self._config_reload()
+        raise ValueError(f'unknown command {command}')
+
+    def _serve(self, connection: Connection):
+        try:
+            while self._running:
+                if not connection.poll(self.POLL_TIMEOUT):
+                    continue
+                command, args = connection.recv()
+                self._logger.debug('command %s%s', command, args)
+                try:
+                    result = ('ok', self._apply(command, args))
+                except Exception as e:
+                    self._logger.warning(f'Command {command} failed: {e}')
+                    result = ('error', f'{e.__class__.__name__}: {e}')
+                self._control_data.publish_state()
+                connection.send(result)
+        except (EOFError, OSError):
+            self._logger.info('API process disconnected')
+        finally:
+            connection.close()
+
+    def run(self):
+        self._running = True
+        while self._running:
+            try:
+                connection = self._listener.accept()
+            except OSError as e:
+                if self._running:
+                    self._logger.warning(f'Could not accept API process connection: {e}')
+                continue
+            if not self._running:
+                connection.close()
+                break
+            thread = Thread(target=self._serve, args=(connection,), name='CommandServer-connection')
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._running = False
+        # wake up the accept of run
+        try:
+            Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+        except OSError:
+            pass
+        for thread in self._threads:
+            thread.join()
+        self._listener.close()
+        try:
+            os.rmdir(self._directory)
+        except OSError:
+            pass
@@ -1,11 +1,28 @@
 import datetime
+import math
 
+from collections import deque
+from pmpctrl.clock import Clock
+from pmpctrl.session_statistics import SessionStatistics
+from threading import Condition
 from threading import Event
 from threading import Lock
+from typing import NamedTuple
+
+
+class PressureSample(NamedTuple):
+    time_ns: int
+    sequence: int
+    value: float
+
 
 class ControlData:
     _instance = None
     _lock = Lock()
+    _sample_condition = Condition(_lock)
+
+    # samples kept for consumers that fall behind
+    SAMPLE_BUFFER_SIZE = 256
 
     _log_level = 20
 
@@ -14,34 +31,76 @@ class ControlData:
     MODE_PULSATING = 2
     MODE_EXPERIMENTAL = 666
 
+    ACTUATOR_PUMP = 1
+    ACTUATOR_VALVE = 2
+    ACTUATOR_SESSION = 3
+
+    CAUSE_UNKNOWN = 0
+    CAUSE_PRESSURE_CONTROL = 1
+    CAUSE_SESSION_CONTROL = 2
+    CAUSE_API = 3
+    CAUSE_FAILSAFE = 4
+    CAUSE_SHUTDOWN = 5
+
     event_run: Event
     event_error: Event
     event_session_on: Event
     event_set_setpoint: Event
     event_auto_setpoint: Event
+    event_pressure_stale: Event
     event_pump_state_on: Event
     event_pump_turn_on: Event
     event_pump_turn_off: Event
     event_valve_state_closed: Event
     event_valve_open: Event
     event_valve_close: Event
+    event_interlock_tripped: Event
+    event_active: Event
+    event_session_update: Event
+
+    _clock: Clock
 
     _time_utc_now: datetime.datetime
     _time_utc_session_start: datetime.datetime
     _last_session_duration: int
+    _session_id: int
+    _session_statistics: SessionStatistics
+    _actuator_journal: object
+    _session_recorder: object
+    _interlock: object
+    _pressure_sensor: object
+    _profiler: object
+    _supervisor: object
+    _trace_capture: object
+    _heartbeats: dict
+    _state_snapshot: object
+    _state_checkpoint: object
+    _shutdown_clean: bool
+    _pump_cause: int
+    _valve_cause: int
     
     _pressure_actual: float
+    _pressure_sample: PressureSample
+    _pressure_samples: deque
+    _pressure_trigger: float
     _pressure_setpoint: float
     _pressure_target: float
     _pressure_target_tolerance_minus: float
     _pressure_target_tolerance_plus: float
+    _pressure_target_base: tuple
     _pressure_control: bool
     _pressure_max: float
     _pressure_min: float
 
+    _sensor_recovery_count: int
+    _sensor_recovery_time_last: float
+    _sensor_recovery_time_max: float
+
     _mode: int
     _mode_interval_peak_pressure: float
     _mode_interval_time: float
+    _mode_interval_dwell_time: float
+    _mode_interval_ramp_time: float
     _mode_pulsating_pump_time: float
     _mode_pulsating_release_time: float
 
@@ -52,10 +111,15 @@ class ControlData:
                     cls._instance = super().__new__(cls)
                     
                     cls.event_run = Event()
+                    # the loops wait on it in place of sleeping, see stop
+                    cls.event_stop = Event()
                     cls.event_error = Event()
                     cls.event_session_on = Event()
                     cls.event_set_setpoint = Event()
                     cls.event_auto_setpoint = Event()
+                    # no valid reading before the first sample
+                    cls.event_pressure_stale = Event()
+                    cls.event_pressure_stale.set()
                     cls.event_pump_state_on = Event()
                     cls.event_pump_turn_on = Event()
                     cls.event_pump_turn_off = Event()
@@ -64,10 +128,35 @@ class ControlData:
                     cls.event_valve_state_closed.set()
                     cls.event_valve_open = Event()
                     cls.event_valve_close = Event()
+                    cls.event_interlock_tripped = Event()
+                    # fast sampling until PressureSensor finds the system idle
+                    cls.event_active = Event()
+                    cls.event_active.set()
+                    # SessionControl sleeps on it between its deadlines
+                    cls.event_session_update = Event()
+                    cls._pressure_trigger = None
+                    cls._pressure_target_base = None
+
+                    cls._clock = Clock()
 
                     cls._time_utc_now = datetime.datetime.utcnow()
                     cls._time_utc_session_start = None
                     cls._last_session_duration = None
+                    cls._session_id = 0
+                    cls._session_statistics = None
+                    cls._actuator_journal = None
+                    cls._session_recorder = None
+                    cls._interlock = None
+                    cls._pressure_sensor = None
+                    cls._profiler = None
+                    cls._supervisor = None
+                    cls._trace_capture = None
+                    cls._heartbeats = {}
+                    cls._state_snapshot = None
+                    cls._state_checkpoint = None
+                    cls._shutdown_clean = False
+                    cls._pump_cause = ControlData.CAUSE_UNKNOWN
+                    cls._valve_cause = ControlData.CAUSE_UNKNOWN
 
                     #cls._pressure_setpoint = 1013.25 # sea level
                     # avg. human population 435m above seal level, air pressure 20°C at 435m -> 962.9274mbar
@@ -77,6 +166,9 @@ class ControlData:
                     cls._pressure_target_tolerance_plus = 10.0
                     #cls._pressure_tolerance_plus = 3.38639 # ~0.1inHg
                     cls._pressure_actual = -1.0
+                    # sequence 0 -> no sample yet
+                    cls._pressure_sample = PressureSample(0, 0, cls._pressure_actual)
+                    cls._pressure_samples = deque(maxlen=ControlData.SAMPLE_BUFFER_SIZE)
                     cls._pressure_target = 875.0
                     # auto control pressure to setpoint
                     cls._pressure_control = True
@@ -85,15 +177,36 @@ class ControlData:
                     # roughly -15inHg of setpoint
                     cls._pressure_min = 450.0
 
+                    cls._sensor_recovery_count = 0
+                    cls._sensor_recovery_time_last = None
+                    cls._sensor_recovery_time_max = None
+
                     # Default mode
                     cls._mode = ControlData.MODE_PRESSURE_HOLD
                     cls._mode_interval_peak_pressure = 790.0
                     cls._mode_interval_time = 20.0
+                    cls._mode_interval_dwell_time = 0.0
+                    cls._mode_interval_ramp_time = 0.0
                     cls._mode_pulsating_pump_time = 2.5
                     cls._mode_pulsating_release_time = 1.7
 
         return cls._instance
 
+    @classmethod
+    def reset(cls):
+        """Drops the instance, the next ControlData() starts from defaults."""
+        with cls._lock:
+            cls._instance = None
+
+    # clock
+    def get_clock(self) -> Clock:
+        with self._lock:
+            return self._clock
+
+    def set_clock(self, clock: Clock):
+        with self._lock:
+            self._clock = clock
+
     def set_log_level(self, log_level: int):
         with self._lock:
             self._log_level = log_level
@@ -116,6 +229,8 @@ class ControlData:
                 self._pressure_control = False
             elif mode == ControlData.MODE_EXPERIMENTAL:
                 self._mode = ControlData.MODE_EXPERIMENTAL
+            self._publish_state()
+        self.event_session_update.set()
 
     def get_mode(self) -> int:
         with self._lock:
@@ -139,6 +254,7 @@ class ControlData:
     def set_time_utc_session_start(self):
         with self._lock:
             self._time_utc_session_start = datetime.datetime.utcnow()
+            self._publish_state()
 
     def get_last_session_duration(self) -> int:
         with self._lock:
@@ -148,7 +264,393 @@ class ControlData:
 
     def set_last_session_duration(self):
         with self._lock:
-            self._last_session_duration = (self._time_utc_now - self._time_utc_session_start).seconds
+            self._last_session_duration = int((self._time_utc_now - self._time_utc_session_start).total_seconds())
+
+    # session
+    def get_session_id(self) -> int:
+        with self._lock:
+            return self._session_id
+
+    def set_session_id(self, session_id: int):
+        with self._lock:
+            self._session_id = session_id
+            self._publish_state()
+
+    def start_session(self, cause: int=CAUSE_UNKNOWN):
+        # the loops are back at full rate before they see the session
+        self.notify_activity()
+        with self._lock:
+            self._session_id += 1
+            self._session_statistics = SessionStatistics(self._clock.monotonic_ns(), self.event_pump_state_on.is_set())
+        self.event_session_on.set()
+        self.set_time_utc_session_start()
+        self.add_actuator_edge(ControlData.ACTUATOR_SESSION, True, cause)
+        with self._lock:
+            self._publish_state()
+        self.event_session_update.set()
+
+    def stop_session(self, cause: int=CAUSE_UNKNOWN):
+        self.event_session_on.clear()
+        self.set_time_utc_now()
+        self.set_last_session_duration()
+        if self.event_pump_state_on.is_set():
+            self.request_pump_off(cause)
+        if not self.event_valve_state_closed.is_set():
+            self.request_valve_close(cause)
+        self.add_actuator_edge(ControlData.ACTUATOR_SESSION, False, cause)
+        with self._lock:
+            if self._session_statistics is not None:
+                self._session_statistics.stop(self._clock.monotonic_ns())
+            self._publish_state()
+        self.event_session_update.set()
+
+    def get_session_statistics(self) -> dict:
+        """
+        Returns the statistics of the running session, or of the last one
+        once stopped, None before the first session. See SessionStatistics.
+        """
+        with self._lock:
+            if self._session_statistics is None:
+                return None
+            state = self._session_statistics.get_state()
+            time_ns = self._clock.monotonic_ns()
+        return SessionStatistics.summarize(state, time_ns)
+
+    # state checkpoint
+    def set_state_checkpoint(self, state_checkpoint):
+        with self._lock:
+            self._state_checkpoint = state_checkpoint
+            self._publish_state()
+
+    # state snapshot
+    def set_state_snapshot(self, state_snapshot):
+        with self._lock:
+            self._state_snapshot = state_snapshot
+            self._publish_state()
+
+    def publish_state(self):
+        """
+        Writes checkpoint and snapshot, for state changed directly through
+        the events.
+        """
+        with self._lock:
+            self._publish_state()
+
+    @staticmethod
+    def _utc_timestamp(time_utc: datetime.datetime) -> float:
+        if time_utc is None:
+            return math.nan
+        return time_utc.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def _publish_state(self):
+        # called with the lock held
+        if self._state_checkpoint is None and self._state_snapshot is None:
+            return
+        session_start = self._utc_timestamp(self._time_utc_session_start)
+        if self._state_snapshot is not None:
+            self._write_snapshot(session_start)
+        if self._state_checkpoint is None:
+            return
+        self._state_checkpoint.write((
+            self._session_id,
+            self._mode,
+            self.event_session_on.is_set(),
+            self.event_auto_setpoint.is_set(),
+            self._pressure_control,
+            self._shutdown_clean,
+            self._pressure_actual,
+            self._pressure_setpoint,
+            self._pressure_target,
+            self._pressure_target_tolerance_plus,
+            self._pressure_target_tolerance_minus,
+            self._pressure_min,
+            self._pressure_max,
+            self._mode_interval_peak_pressure,
+            self._mode_interval_time,
+            self._mode_interval_dwell_time,
+            self._mode_interval_ramp_time,
+            self._mode_pulsating_pump_time,
+            self._mode_pulsating_release_time,
+            session_start,
+            *(self._pressure_target_base if self._pressure_target_base is not None else (math.nan, math.nan))
+        ))
+
+    def _write_snapshot(self, session_start: float):
+        # called with the lock held
+        sample = self._pressure_sample
+        self._state_snapshot.write((
+            self._session_id,
+            self._mode,
+            sample.sequence,
+            sample.time_ns,
+            self._sensor_recovery_count,
+            self._log_level,
+            self.event_session_on.is_set(),
+            self.event_auto_setpoint.is_set(),
+            self._pressure_control,
+            self.event_pressure_stale.is_set(),
+            self.event_pump_state_on.is_set(),
+            self.event_valve_state_closed.is_set(),
+            self.event_set_setpoint.is_set(),
+            self.event_interlock_tripped.is_set(),
+            self._pressure_actual,
+            self._pressure_setpoint,
+            self._pressure_target,
+            self._pressure_target_tolerance_plus,
+            self._pressure_target_tolerance_minus,
+            self._pressure_min,
+            self._pressure_max,
+            self._mode_interval_peak_pressure,
+            self._mode_interval_time,
+            self._mode_interval_dwell_time,
+            self._mode_interval_ramp_time,
+            self._mode_pulsating_pump_time,
+            self._mode_pulsating_release_time,
+            session_start,
+            self._utc_timestamp(self._time_utc_now),
+            self._last_session_duration if self._last_session_duration is not None else math.nan,
+            self._sensor_recovery_time_last if self._sensor_recovery_time_last is not None else math.nan,
+            self._sensor_recovery_time_max if self._sensor_recovery_time_max is not None else math.nan,
+            *(self._session_statistics.get_state() if self._session_statistics is not None else SessionStatistics.EMPTY)
+        ))
+
+    def get_state(self) -> dict:
+        """Returns the state in the form of StateCheckpoint.read, see restore_state."""
+        with self._lock:
+            return {
+                'session_id' : self._session_id,
+                'mode' : self._mode,
+                'session_on' : self.event_session_on.is_set(),
+                'auto_setpoint' : self.event_auto_setpoint.is_set(),
+                'pressure_control' : self._pressure_control,
+                'shutdown_clean' : self._shutdown_clean,
+                'pressure_actual' : self._pressure_actual,
+                'pressure_setpoint' : self._pressure_setpoint,
+                'pressure_target' : self._pressure_target,
+                'pressure_target_tolerance_plus' : self._pressure_target_tolerance_plus,
+                'pressure_target_tolerance_minus' : self._pressure_target_tolerance_minus,
+                'pressure_min' : self._pressure_min,
+                'pressure_max' : self._pressure_max,
+                'mode_interval_peak_pressure' : self._mode_interval_peak_pressure,
+                'mode_interval_time' : self._mode_interval_time,
+                'mode_interval_dwell_time' : self._mode_interval_dwell_time,
+                'mode_interval_ramp_time' : self._mode_interval_ramp_time,
+                'mode_pulsating_pump_time' : self._mode_pulsating_pump_time,
+                'mode_pulsating_release_time' : self._mode_pulsating_release_time,
+                'time_utc_session_start' : self._utc_timestamp(self._time_utc_session_start),
+                'pressure_target_base' : self._pressure_target_base[0] if self._pressure_target_base is not None else math.nan,
+                'pressure_target_tolerance_plus_base' : self._pressure_target_base[1] if self._pressure_target_base is not None else math.nan
+            }
+
+    def restore_state(self, state: dict):
+        """
+        Restores the state of a checkpoint read by StateCheckpoint.read, an
+        active session is resumed without starting a new one. Target and
+        tolerance plus overridden by an interval are restored to their base,
+        SessionControl starts the interval over from it.
+        """
+        with self._lock:
+            self._session_id = state['session_id']
+            self._mode = state['mode']
+            self._pressure_control = state['pressure_control']
+            self._pressure_setpoint = state['pressure_setpoint']
+            self._pressure_target = state['pressure_target']
+            self._pressure_target_tolerance_plus = state['pressure_target_tolerance_plus']
+            if not math.isnan(state.get('pressure_target_base', math.nan)):
+                self._pressure_target = state['pressure_target_base']
+                self._pressure_target_tolerance_plus = state['pressure_target_tolerance_plus_base']
+            self._pressure_target_base = None
+            self._pressure_target_tolerance_minus = state['pressure_target_tolerance_minus']
+            self._pressure_min = state['pressure_min']
+            self._pressure_max = state['pressure_max']
+            self._mode_interval_peak_pressure = state['mode_interval_peak_pressure']
+            self._mode_interval_time = state['mode_interval_time']
+            self._mode_interval_dwell_time = state['mode_interval_dwell_time']
+            self._mode_interval_ramp_time = state['mode_interval_ramp_time']
+            self._mode_pulsating_pump_time = state['mode_pulsating_pump_time']
+            self._mode_pulsating_release_time = state['mode_pulsating_release_time']
+            self._time_utc_session_start = None
+            if not math.isnan(state['time_utc_session_start']):
+                self._time_utc_session_start = datetime.datetime.utcfromtimestamp(state['time_utc_session_start'])
+            # the statistics of a resumed session start over
+            self._session_statistics = None
+            if state['session_on']:
+                self._session_statistics = SessionStatistics(self._clock.monotonic_ns(), self.event_pump_state_on.is_set())
+        if state['auto_setpoint']:
+            self.event_auto_setpoint.set()
+        if state['session_on']:
+            self.event_session_on.set()
+        self.event_session_update.set()
+
+    # heartbeats
+    def heartbeat(self, name: str, period: float):
+        """
+        Called by the loop `name` once per cycle, announcing its next one
+        within `period` seconds.
+        """
+        time_ns = self._clock.monotonic_ns()
+        with self._lock:
+            self._heartbeats[name] = (time_ns, period)
+            trace_capture = self._trace_capture
+        if trace_capture is not None:
+            trace_capture.add_heartbeat(time_ns, name)
+
+    def get_heartbeats(self) -> dict:
+        """Returns the last heartbeat (time in ns, period) of every loop."""
+        with self._lock:
+            return dict(self._heartbeats)
+
+    # shutdown
+    def set_shutdown_clean(self):
+        """
+        Marks the checkpoint as written by an orderly shutdown, its session
+        is then not resumed on the next start.
+        """
+        with self._lock:
+            self._shutdown_clean = True
+            self._publish_state()
+
+    def stop(self):
+        """
+        Ends the loops: clears event_run and wakes every loop waiting for
+        its next cycle, in idle, for a deadline or for a sample, so that
+        each one exits right away instead of at the end of its wait.
+        """
+        self.event_run.clear()
+        self.event_stop.set()
+        self.event_active.set()
+        self.event_session_update.set()
+        with self._sample_condition:
+            self._sample_condition.notify_all()
+
+    # activity
+    def notify_activity(self):
+        """
+        Wakes the loops waiting in idle and keeps them at their full rate
+        until PressureSensor finds the system idle again.
+        """
+        self.event_active.set()
+
+    # actuators
+    def request_pump_on(self, cause: int=CAUSE_UNKNOWN):
+        with self._lock:
+            self._pump_cause = cause
+        self.event_pump_turn_off.clear()
+        self.event_pump_turn_on.set()
+        self.notify_activity()
+
+    def request_pump_off(self, cause: int=CAUSE_UNKNOWN):
+        with self._lock:
+            self._pump_cause = cause
+        self.event_pump_turn_on.clear()
+        self.event_pump_turn_off.set()
+        self.notify_activity()
+
+    def request_valve_open(self, cause: int=CAUSE_UNKNOWN):
+        with self._lock:
+            self._valve_cause = cause
+        self.event_valve_close.clear()
+        self.event_valve_open.set()
+        self.notify_activity()
+
+    def request_valve_close(self, cause: int=CAUSE_UNKNOWN):
+        with self._lock:
+            self._valve_cause = cause
+        self.event_valve_open.clear()
+        self.event_valve_close.set()
+        self.notify_activity()
+
+    def get_pump_cause(self) -> int:
+        with self._lock:
+            return self._pump_cause
+
+    def get_valve_cause(self) -> int:
+        with self._lock:
+            return self._valve_cause
+
+    def set_actuator_journal(self, actuator_journal):
+        with self._lock:
+            self._actuator_journal = actuator_journal
+
+    def get_actuator_journal(self):
+        with self._lock:
+            return self._actuator_journal
+
+    def set_session_recorder(self, session_recorder):
+        with self._lock:
+            self._session_recorder = session_recorder
+
+    def get_session_recorder(self):
+        with self._lock:
+            return self._session_recorder
+
+    def set_interlock(self, interlock):
+        with self._lock:
+            self._interlock = interlock
+
+    def get_interlock(self):
+        with self._lock:
+            return self._interlock
+
+    def set_pressure_sensor(self, pressure_sensor):
+        with self._lock:
+            self._pressure_sensor = pressure_sensor
+
+    def get_pressure_sensor(self):
+        with self._lock:
+            return self._pressure_sensor
+
+    def set_profiler(self, profiler):
+        with self._lock:
+            self._profiler = profiler
+
+    def get_profiler(self):
+        with self._lock:
+            return self._profiler
+
+    def set_supervisor(self, supervisor):
+        with self._lock:
+            self._supervisor = supervisor
+
+    def get_supervisor(self):
+        with self._lock:
+            return self._supervisor
+
+    def set_trace_capture(self, trace_capture):
+        with self._lock:
+            self._trace_capture = trace_capture
+
+    def get_trace_capture(self):
+        with self._lock:
+            return self._trace_capture
+
+    def add_actuator_edge(self, actuator: int, state: bool, cause: int=None):
+        """
+        Records an actuator edge in the journal, if one is attached. Without
+        an explicit cause the one of the last request for that actuator is
+        used.
+        """
+        with self._lock:
+            journal = self._actuator_journal
+            trace_capture = self._trace_capture
+            session_id = self._session_id
+            if cause is None:
+                if actuator == ControlData.ACTUATOR_PUMP:
+                    cause = self._pump_cause
+                elif actuator == ControlData.ACTUATOR_VALVE:
+                    cause = self._valve_cause
+                else:
+                    cause = ControlData.CAUSE_UNKNOWN
+            time_ns = self._clock.monotonic_ns()
+            if self._session_statistics is not None:
+                if actuator == ControlData.ACTUATOR_PUMP:
+                    self._session_statistics.set_pump(time_ns, state)
+                elif actuator == ControlData.ACTUATOR_VALVE and state:
+                    self._session_statistics.add_valve_open()
+        if journal is not None:
+            journal.append(time_ns, session_id, actuator, state, cause)
+        if trace_capture is not None:
+            trace_capture.add_edge(time_ns, actuator, state, cause)
 
     # pressure
     # pressure - actual
@@ -159,6 +661,57 @@ class ControlData:
     def set_pressure_actual(self, pressure_actual: float):
         with self._lock:
             self._pressure_actual = pressure_actual
+            sample = PressureSample(self._clock.monotonic_ns(), self._pressure_sample.sequence + 1, pressure_actual)
+            self._pressure_sample = sample
+            self._pressure_samples.append(sample)
+            self._sample_condition.notify_all()
+            if self._session_statistics is not None:
+                self._session_statistics.add_sample(sample.time_ns, pressure_actual, self._pressure_target,
+                                                    self._pressure_target_tolerance_plus,
+                                                    self._pressure_target_tolerance_minus)
+            if self._pressure_trigger is not None and pressure_actual <= self._pressure_trigger:
+                self._pressure_trigger = None
+                self.event_session_update.set()
+            self._publish_state()
+            trace_capture = self._trace_capture
+        if trace_capture is not None:
+            trace_capture.add_sample(sample)
+
+    def get_pressure_sample(self) -> PressureSample:
+        with self._lock:
+            return self._pressure_sample
+
+    def get_pressure_sample_age(self) -> float:
+        """Seconds since the latest sample, None before the first one."""
+        with self._lock:
+            if self._pressure_sample.sequence == 0:
+                return None
+            return (self._clock.monotonic_ns() - self._pressure_sample.time_ns) / 1e9
+
+    def set_pressure_trigger(self, threshold: float):
+        """
+        Sets event_session_update once with the first sample at or below
+        `threshold`, None removes the trigger.
+        """
+        with self._lock:
+            self._pressure_trigger = threshold
+
+    def wait_for_sample(self, after_seq: int, timeout: float=None) -> PressureSample:
+        """
+        Returns the sample following sequence number `after_seq`, waiting up
+        to `timeout` seconds for it to be published. Consumers passing the
+        sequence of the last sample they processed see every sample exactly
+        once, as long as they stay within SAMPLE_BUFFER_SIZE samples.
+        Returns None on timeout and once stop was called.
+        """
+        with self._sample_condition:
+            self._sample_condition.wait_for(lambda: self._pressure_sample.sequence > after_seq or self.event_stop.is_set(), timeout)
+            if self._pressure_sample.sequence <= after_seq:
+                return None
+            oldest = self._pressure_samples[0].sequence
+            if after_seq < oldest:
+                return self._pressure_samples[0]
+            return self._pressure_samples[after_seq - oldest + 1]
 
     # pressure - setpoint
     def get_pressure_setpoint(self) -> float:
@@ -168,6 +721,7 @@ class ControlData:
     def set_pressure_setpoint(self, setpoint: float):
         with self._lock:
             self._pressure_setpoint = setpoint
+            self._publish_state()
 
     # pressure - target
     def get_pressure_target(self) -> float:
@@ -177,6 +731,36 @@ class ControlData:
     def set_pressure_target(self, pressure_target: float):
         with self._lock:
             self._pressure_target = pressure_target
+            self._publish_state()
+
+    # pressure - target - base
+    def get_pressure_target_base(self) -> tuple:
+        with self._lock:
+            return self._pressure_target_base
+
+    def set_pressure_target_base(self, base: tuple):
+        """
+        Marks target and tolerance plus as overridden by an interval of
+        SessionControl, `base` being the (target, tolerance plus) of the
+        session to return to, None once they are back. The checkpoint keeps
+        the base apart from the override.
+        """
+        with self._lock:
+            self._pressure_target_base = base
+            self._publish_state()
+
+    def set_session_tolerance_plus(self, tolerance_plus: float):
+        """
+        Sets the tolerance plus of the session: the base while an interval
+        overrides it, SessionControl restores it at the end of the interval,
+        the live one otherwise.
+        """
+        with self._lock:
+            if self._pressure_target_base is not None:
+                self._pressure_target_base = (self._pressure_target_base[0], abs(tolerance_plus))
+            else:
+                self._pressure_target_tolerance_plus = abs(tolerance_plus)
+            self._publish_state()
 
     # pressure - target - tolerance - minus
     def get_pressure_target_tolerance_minus(self) -> float:
@@ -186,6 +770,7 @@ class ControlData:
     def set_pressure_target_tolerance_minus(self, tolerance_minus: float):
         with self._lock:
             self._pressure_target_tolerance_minus = abs(tolerance_minus)
+            self._publish_state()
 
     # pressure - target - tolerance - plus
     def get_pressure_target_tolerance_plus(self) -> float:
@@ -195,6 +780,7 @@ class ControlData:
     def set_pressure_target_tolerance_plus(self, tolerance_plus: float):
         with self._lock:
             self._pressure_target_tolerance_plus = abs(tolerance_plus)
+            self._publish_state()
 
     # auto control pressure
     def get_pressure_control(self) -> bool:
@@ -204,6 +790,7 @@ class ControlData:
     def set_pressure_control(self, pressure_control: bool):
         with self._lock:
             self._pressure_control = pressure_control
+            self._publish_state()
 
     # pressure - max
     def get_pressure_max(self) -> float:
@@ -213,6 +800,7 @@ class ControlData:
     def set_pressure_max(self, max_pressure: float):
         with self._lock:
             self._pressure_max = abs(max_pressure)
+            self._publish_state()
 
     # pressure - min
     def get_pressure_min(self) -> float:
@@ -222,6 +810,28 @@ class ControlData:
     def set_pressure_min(self, min_pressure: float):
         with self._lock:
             self._pressure_min = abs(min_pressure)
+            self._publish_state()
+
+    # sensor recovery
+    def add_sensor_recovery(self, recovery_time: float):
+        with self._lock:
+            self._sensor_recovery_count += 1
+            self._sensor_recovery_time_last = recovery_time
+            if self._sensor_recovery_time_max is None or recovery_time > self._sensor_recovery_time_max:
+                self._sensor_recovery_time_max = recovery_time
+            self._publish_state()
+
+    def get_sensor_recovery_count(self) -> int:
+        with self._lock:
+            return self._sensor_recovery_count
+
+    def get_sensor_recovery_time_last(self) -> float:
+        with self._lock:
+            return self._sensor_recovery_time_last
+
+    def get_sensor_recovery_time_max(self) -> float:
+        with self._lock:
+            return self._sensor_recovery_time_max
 
     # mode interval
     def get_mode_interval_peak_pressure(self) -> float:
@@ -231,6 +841,7 @@ class ControlData:
     def set_mode_interval_peak_pressure(self, peak_pressure: float):
         with self._lock:
             self._mode_interval_peak_pressure = peak_pressure
+            self._publish_state()
 
     def get_mode_interval_time(self) -> float:
         with self._lock:
@@ -239,6 +850,25 @@ class ControlData:
     def set_mode_interval_time(self, interval_time: float):
         with self._lock:
             self._mode_interval_time = interval_time
+            self._publish_state()
+
+    def get_mode_interval_dwell_time(self) -> float:
+        with self._lock:
+            return self._mode_interval_dwell_time
+
+    def set_mode_interval_dwell_time(self, dwell_time: float):
+        with self._lock:
+            self._mode_interval_dwell_time = dwell_time
+            self._publish_state()
+
+    def get_mode_interval_ramp_time(self) -> float:
+        with self._lock:
+            return self._mode_interval_ramp_time
+
+    def set_mode_interval_ramp_time(self, ramp_time: float):
+        with self._lock:
+            self._mode_interval_ramp_time = ramp_time
+            self._publish_state()
 
     # mode pulsating
     def get_mode_pulsating_pump_time(self) -> float:
@@ -248,6 +878,7 @@ class ControlData:
     def set_mode_pulsating_pump_time(self, pump_time: float):
         with self._lock:
             self._mode_pulsating_pump_time = pump_time
+            self._publish_state()
 
     def get_mode_pulsating_release_time(self) -> float:
         with self._lock:
@@ -256,4 +887,4 @@ class ControlData:
     def set_mode_pulsating_release_time(self, release_time: float):
         with self._lock:
             self._mode_pulsating_release_time = release_time
-
+            self._publish_state()
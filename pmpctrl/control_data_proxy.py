@@ -0,0 +1,304 @@
+import datetime
+import logging
+import math
+import pmpctrl.logging_config
+
+from multiprocessing.connection import Client
+from pmpctrl.command_server import CommandServer
+from pmpctrl.control_data import ControlData
+from pmpctrl.control_data import PressureSample
+from pmpctrl.session_statistics import SessionStatistics
+from pmpctrl.state_snapshot import StateSnapshot
+from threading import Lock
+from time import monotonic_ns
+
+
+class ProxyEvent:
+    """Read-only view of a ControlData event, set and clear are commands."""
+    def __init__(self, proxy, name: str):
+        self._proxy = proxy
+        self._name = name
+
+    def is_set(self) -> bool:
+        return self._proxy._get(self._name)
+
+    def set(self):
+        self._proxy._command(f'event_{self._name}.set')
+
+    def clear(self):
+        self._proxy._command(f'event_{self._name}.clear')
+
+
+class ProxyObject:
+    """
+    Object registered on ControlData of the control process, e.g. the
+    Interlock, every call of one of `methods` is a command.
+    """
+    def __init__(self, proxy, name: str, methods: tuple):
+        self._proxy = proxy
+        self._name = name
+        self._methods = methods
+
+    def __getattr__(self, method: str):
+        if method not in self._methods:
+            raise AttributeError(f'{self._name} has no method {method}')
+        return lambda *args: self._proxy._command(f'{self._name}.{method}', *args)
+
+
+class ControlDataProxy:
+    """
+    Stands in for ControlData in an API process. Getters read the shared
+    memory StateSnapshot of the control process, setters and requests are
+    sent to its CommandServer and return once they were applied.
+
+    Only the part of the ControlData interface used by PmpctrlAPI is
+    provided. The actuator journal and the session recorder are opened
+    read-only from their files. The profiler, if enabled, profiles the
+    control process.
+    """
+    _logger: logging.Logger
+    _snapshot: StateSnapshot
+    _connection: object
+    _connection_lock: Lock
+    _log_level: int
+    _time_utc_now: datetime.datetime
+
+    def __init__(self,
+                 snapshot_name: str,
+                 command_address: str,
+                 authkey: bytes,
+                 log_level: int=logging.WARNING,
+                 journal_file: str=None,
+                 recorder_directory: str=None,
+                 profiler: bool=False):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(log_level)
+        self._log_level = log_level
+        self._snapshot = StateSnapshot(snapshot_name)
+        self._connection = Client(command_address, family='AF_UNIX', authkey=authkey)
+        self._connection_lock = Lock()
+        self._time_utc_now = datetime.datetime.utcnow()
+
+        self.event_session_on = ProxyEvent(self, 'session_on')
+        self.event_auto_setpoint = ProxyEvent(self, 'auto_setpoint')
+        self.event_set_setpoint = ProxyEvent(self, 'set_setpoint')
+        self.event_pressure_stale = ProxyEvent(self, 'pressure_stale')
+        self.event_pump_state_on = ProxyEvent(self, 'pump_state_on')
+        self.event_valve_state_closed = ProxyEvent(self, 'valve_state_closed')
+        self.event_interlock_tripped = ProxyEvent(self, 'interlock_tripped')
+        self._interlock = ProxyObject(self, 'interlock', CommandServer.OBJECTS['interlock'])
+        self._pressure_sensor = ProxyObject(self, 'pressure_sensor', CommandServer.OBJECTS['pressure_sensor'])
+        self._supervisor = ProxyObject(self, 'supervisor', CommandServer.OBJECTS['supervisor'])
+        self._profiler = ProxyObject(self, 'profiler', CommandServer.OBJECTS['profiler']) if profiler else None
+
+        self._actuator_journal = None
+        if journal_file:
+            from pmpctrl.actuator_journal import ActuatorJournal
+            self._actuator_journal = ActuatorJournal(journal_file, read_only=True)
+        self._session_recorder = None
+        if recorder_directory:
+            from pmpctrl.session_recorder import SessionRecorder
+            self._session_recorder = SessionRecorder(control_data=self, directory=recorder_directory)
+
+    def _state(self) -> dict:
+        state = self._snapshot.read()
+        if state is None:
+            raise RuntimeError('control process has not published its state yet')
+        return state
+
+    def _get(self, name: str):
+        return self._state()[name]
+
+    @staticmethod
+    def _optional(value: float) -> float:
+        return None if math.isnan(value) else value
+
+    @staticmethod
+    def _datetime(timestamp: float) -> datetime.datetime:
+        if math.isnan(timestamp):
+            return None
+        return datetime.datetime.utcfromtimestamp(timestamp)
+
+    def _command(self, command: str, *args):
+        with self._connection_lock:
+            self._connection.send((command, args))
+            status, result = self._connection.recv()
+        if status != 'ok':
+            raise RuntimeError(f'command {command} failed in the control process: {result}')
+        return result
+
+    def close(self):
+        with self._connection_lock:
+            self._connection.close()
+        self._snapshot.close()
+
+    # log level, from the API process settings
+    def get_log_level(self) -> int:
+        return self._log_level
+
+    # mode
+    def get_mode(self) -> int:
+        return self._get('mode')
+
+    def set_mode(self, mode: int):
+        self._command('set_mode', mode)
+
+    # time / duration, now is the time of the API process
+    def get_time_utc_now(self) -> datetime.datetime:
+        return self._time_utc_now
+
+    def set_time_utc_now(self):
+        self._time_utc_now = datetime.datetime.utcnow()
+
+    def get_time_utc_session_start(self) -> datetime.datetime:
+        return self._datetime(self._get('time_utc_session_start'))
+
+    def get_last_session_duration(self) -> int:
+        duration = self._optional(self._get('last_session_duration'))
+        return int(duration) if duration is not None else None
+
+    # session
+    def get_session_id(self) -> int:
+        return self._get('session_id')
+
+    def get_session_statistics(self) -> dict:
+        state = self._state()
+        statistics = tuple(state[f'statistics_{field}'] for field in SessionStatistics.FIELDS)
+        return SessionStatistics.summarize(statistics, monotonic_ns())
+
+    def start_session(self, cause: int=ControlData.CAUSE_UNKNOWN):
+        self._command('start_session', cause)
+
+    def stop_session(self, cause: int=ControlData.CAUSE_UNKNOWN):
+        self._command('stop_session', cause)
+
+    # actuators
+    def request_pump_on(self, cause: int=ControlData.CAUSE_UNKNOWN):
+        self._command('request_pump_on', cause)
+
+    def request_pump_off(self, cause: int=ControlData.CAUSE_UNKNOWN):
+        self._command('request_pump_off', cause)
+
+    def request_valve_open(self, cause: int=ControlData.CAUSE_UNKNOWN):
+        self._command('request_valve_open', cause)
+
+    def request_valve_close(self, cause: int=ControlData.CAUSE_UNKNOWN):
+        self._command('request_valve_close', cause)
+
+    def get_actuator_journal(self):
+        return self._actuator_journal
+
+    def get_session_recorder(self):
+        return self._session_recorder
+
+    def get_interlock(self):
+        return self._interlock
+
+    def get_pressure_sensor(self):
+        return self._pressure_sensor
+
+    def get_profiler(self):
+        return self._profiler
+
+    def get_supervisor(self):
+        return self._supervisor
+
+    # pressure - actual
+    def get_pressure_actual(self) -> float:
+        return self._get('pressure_actual')
+
+    def get_pressure_sample(self) -> PressureSample:
+        state = self._state()
+        return PressureSample(state['sample_time_ns'], state['sample_sequence'], state['pressure_actual'])
+
+    def get_pressure_sample_age(self) -> float:
+        # CLOCK_MONOTONIC is shared by all processes
+        state = self._state()
+        if state['sample_sequence'] == 0:
+            return None
+        return (monotonic_ns() - state['sample_time_ns']) / 1e9
+
+    # pressure - setpoint
+    def get_pressure_setpoint(self) -> float:
+        return self._get('pressure_setpoint')
+
+    def set_pressure_setpoint(self, setpoint: float):
+        self._command('set_pressure_setpoint', setpoint)
+
+    # pressure - target
+    def get_pressure_target(self) -> float:
+        return self._get('pressure_target')
+
+    def set_pressure_target(self, pressure_target: float):
+        self._command('set_pressure_target', pressure_target)
+
+    def get_pressure_target_tolerance_minus(self) -> float:
+        return self._get('pressure_target_tolerance_minus')
+
+    def set_pressure_target_tolerance_minus(self, tolerance_minus: float):
+        self._command('set_pressure_target_tolerance_minus', tolerance_minus)
+
+    def get_pressure_target_tolerance_plus(self) -> float:
+        return self._get('pressure_target_tolerance_plus')
+
+    def set_pressure_target_tolerance_plus(self, tolerance_plus: float):
+        self._command('set_pressure_target_tolerance_plus', tolerance_plus)
+
+    # pressure - min / max
+    def get_pressure_max(self) -> float:
+        return self._get('pressure_max')
+
+    def get_pressure_min(self) -> float:
+        return self._get('pressure_min')
+
+    # sensor recovery
+    def get_sensor_recovery_count(self) -> int:
+        return self._get('sensor_recovery_count')
+
+    def get_sensor_recovery_time_last(self) -> float:
+        return self._optional(self._get('sensor_recovery_time_last'))
+
+    def get_sensor_recovery_time_max(self) -> float:
+        return self._optional(self._get('sensor_recovery_time_max'))
+
+    # mode - interval
+    def get_mode_interval_peak_pressure(self) -> float:
+        return self._get('mode_interval_peak_pressure')
+
+    def set_mode_interval_peak_pressure(self, peak_pressure: float):
+        self._command('set_mode_interval_peak_pressure', peak_pressure)
+
+    def get_mode_interval_time(self) -> float:
+        return self._get('mode_interval_time')
+
+    def set_mode_interval_time(self, interval_time: float):
+        self._command('set_mode_interval_time', interval_time)
+
+    def get_mode_interval_dwell_time(self) -> float:
+        return self._get('mode_interval_dwell_time')
+
+    def set_mode_interval_dwell_time(self, dwell_time: float):
+        self._command('set_mode_interval_dwell_time', dwell_time)
+
+    def get_mode_interval_ramp_time(self) -> float:
+        return self._get('mode_interval_ramp_time')
+
+    def set_mode_interval_ramp_time(self, ramp_time: float):
+        self._command('set_mode_interval_ramp_time', ramp_time)
+
+    # mode - pulsating
+    def get_mode_pulsating_pump_time(self) -> float:
+        return self._get('mode_pulsating_pump_time')
+
+    def set_mode_pulsating_pump_time(self, pump_time: float):
+        self._command('set_mode_pulsating_pump_time', pump_time)
+
+    def get_mode_pulsating_release_time(self) -> float:
+        return self._get('mode_pulsating_release_time')
+
+    def set_mode_pulsating_release_time(self, release_time: float):
+        self._command('set_mode_pulsating_release_time', release_time)
+
+    # config
+    def config_reload(self) -> dict:
+        return self._command('config_reload')
@@ -0,0 +1,171 @@
+import logging
+import pmpctrl.logging_config
+
+from collections import deque
+from pmpctrl.clock import Clock
+from pmpctrl.control_data import ControlData
+from pmpctrl.control_data import PressureSample
+from pmpctrl.pump_control import PumpControl
+from pmpctrl.valve_control import ValveControl
+from threading import Lock
+
+
+class Interlock:
+    """
+    Safety interlock evaluated inline by PressureSensor on every new
+    sample, before any control loop sees it.
+
+    Trips on a pressure outside pressure_min / pressure_max of ControlData,
+    on a pressure falling faster than `rate_fall_max` or, with the valve
+    closed, rising faster than `rate_rise_max` (mbar/s over `rate_window`
+    seconds), and on the pump running against the closed valve longer than
+    `pump_on_time_max` seconds at a stretch. The pulsating mode runs the
+    pump through its release phases, opening the valve restarts the
+    stretch. A limit of 0 disables it.
+
+    A trip stops the session and drives the pump off and the valve open
+    directly in the sensor cycle, without waiting for the actuator loops.
+    It is latched: until `reset`, the pump stays off and the valve open.
+    The trip latency is measured from the sample (or the moment the pump
+    on-time ran out) until both pins are driven.
+    """
+    REASON_PRESSURE_MIN = 'pressure_min'
+    REASON_PRESSURE_MAX = 'pressure_max'
+    REASON_RATE_FALL = 'rate_fall'
+    REASON_RATE_RISE = 'rate_rise'
+    REASON_PUMP_ON_TIME = 'pump_on_time'
+
+    _logger: logging.Logger
+    _control_data: ControlData
+    _clock: Clock
+    _pump_control: PumpControl
+    _valve_control: ValveControl
+    _lock: Lock
+    _samples: deque
+
+    def __init__(self,
+                 control_data: ControlData,
+                 pump_control: PumpControl,
+                 valve_control: ValveControl,
+                 rate_fall_max: float=200.0,
+                 rate_rise_max: float=50.0,
+                 rate_window: float=0.2,
+                 pump_on_time_max: float=120.0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._clock = control_data.get_clock()
+        self._pump_control = pump_control
+        self._valve_control = valve_control
+        self._rate_fall_max = rate_fall_max
+        self._rate_rise_max = rate_rise_max
+        self._rate_window_ns = int(rate_window * 1e9)
+        self._pump_on_time_max = pump_on_time_max
+        self._lock = Lock()
+        self._samples = deque()
+        self._valve_closed = None
+        self._time_pump_on_ns = None
+        self._reason = None
+        self._trip_pressure = None
+        self._trip_count = 0
+        self._latency_last = None
+        self._latency_max = None
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def _rate(self, sample: PressureSample) -> float:
+        # mbar/s over the window, None until the window is covered
+        valve_closed = self._control_data.event_valve_state_closed.is_set()
+        if valve_closed != self._valve_closed:
+            # venting before the valve closed is no leak afterwards
+            self._valve_closed = valve_closed
+            self._samples.clear()
+        self._samples.append(sample)
+        while len(self._samples) > 2 and sample.time_ns - self._samples[1].time_ns >= self._rate_window_ns:
+            self._samples.popleft()
+        oldest = self._samples[0]
+        if sample.time_ns - oldest.time_ns < self._rate_window_ns:
+            return None
+        return (sample.value - oldest.value) * 1e9 / (sample.time_ns - oldest.time_ns)
+
+    def _violation(self, sample: PressureSample) -> tuple:
+        """Returns the reason and the time in ns it occured, None if there is none."""
+        if sample.value < self._control_data.get_pressure_min():
+            return self.REASON_PRESSURE_MIN, sample.time_ns
+        if sample.value > self._control_data.get_pressure_max():
+            return self.REASON_PRESSURE_MAX, sample.time_ns
+        rate = self._rate(sample)
+        if rate is not None:
+            if self._rate_fall_max and -rate > self._rate_fall_max:
+                return self.REASON_RATE_FALL, sample.time_ns
+            if self._rate_rise_max and self._valve_closed and rate > self._rate_rise_max:
+                return self.REASON_RATE_RISE, sample.time_ns
+        if self._control_data.event_pump_state_on.is_set() and self._control_data.event_valve_state_closed.is_set():
+            if self._time_pump_on_ns is None:
+                self._time_pump_on_ns = sample.time_ns
+            time_limit_ns = self._time_pump_on_ns + int(self._pump_on_time_max * 1e9)
+            if self._pump_on_time_max and sample.time_ns >= time_limit_ns:
+                return self.REASON_PUMP_ON_TIME, time_limit_ns
+        else:
+            self._time_pump_on_ns = None
+        return None
+
+    def _trip(self, reason: str, time_ns: int, pressure: float):
+        self._control_data.event_interlock_tripped.set()
+        self._pump_control.force_off(ControlData.CAUSE_FAILSAFE)
+        self._valve_control.force_open(ControlData.CAUSE_FAILSAFE)
+        latency = (self._clock.monotonic_ns() - time_ns) / 1e9
+        self._reason = reason
+        self._trip_pressure = pressure
+        self._trip_count += 1
+        self._latency_last = latency
+        self._latency_max = latency if self._latency_max is None else max(self._latency_max, latency)
+        self._time_pump_on_ns = None
+        if self._control_data.event_session_on.is_set():
+            self._control_data.stop_session(ControlData.CAUSE_FAILSAFE)
+        self._control_data.publish_state()
+        self._logger.error(f'Interlock tripped by {reason} at {pressure:.2f} mbar, pins driven after {latency * 1e3:.3f}ms')
+
+    def check(self, sample: PressureSample):
+        """Evaluates a new sample, called by PressureSensor right after publishing it."""
+        with self._lock:
+            violation = self._violation(sample)
+            if violation is not None and not self._control_data.event_interlock_tripped.is_set():
+                self._trip(*violation, sample.value)
+
+    def reset(self) -> bool:
+        """
+        Clears a trip, refused while the pressure is still outside its
+        limits. Returns True if the interlock is armed again.
+        """
+        with self._lock:
+            pressure = self._control_data.get_pressure_actual()
+            if not self._control_data.get_pressure_min() <= pressure <= self._control_data.get_pressure_max():
+                return False
+            if self._control_data.event_interlock_tripped.is_set():
+                self._logger.warning(f'Interlock reset after trip by {self._reason}')
+            self._samples.clear()
+            self._time_pump_on_ns = None
+            self._control_data.event_interlock_tripped.clear()
+            self._control_data.publish_state()
+            return True
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                'tripped' : self._control_data.event_interlock_tripped.is_set(),
+                'reason' : self._reason,
+                'trip_pressure' : self._trip_pressure,
+                'trip_count' : self._trip_count,
+                'latency_last' : self._latency_last,
+                'latency_max' : self._latency_max,
+                'limits' : {
+                    'pressure_min' : self._control_data.get_pressure_min(),
+                    'pressure_max' : self._control_data.get_pressure_max(),
+                    'rate_fall_max' : self._rate_fall_max,
+                    'rate_rise_max' : self._rate_rise_max,
+                    'rate_window' : self._rate_window_ns / 1e9,
+                    'pump_on_time_max' : self._pump_on_time_max
+                }
+            }
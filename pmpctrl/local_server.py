@@ -0,0 +1,308 @@
+import logging
+import math
+import os
+import pmpctrl.logging_config
+import socket
+import struct
+
+from pmpctrl.control_data import ControlData
+from threading import Thread
+from typing import NamedTuple
+
+
+class Telemetry(NamedTuple):
+    sequence: int
+    time_ns: int
+    session_id: int
+    mode: int
+    session_on: bool
+    pump_on: bool
+    valve_closed: bool
+    pressure_stale: bool
+    auto_setpoint: bool
+    interlock_tripped: bool
+    pressure_actual: float
+    pressure_target: float
+    pressure_setpoint: float
+    tolerance_plus: float
+    tolerance_minus: float
+
+
+# request: command, argument
+REQUEST = struct.Struct('<Bd')
+# reply: status, then the telemetry frame of the state after the command:
+# sample sequence, sample time (CLOCK_MONOTONIC ns), session id, mode,
+# flags, pressure actual, target, setpoint, tolerance plus and minus
+REPLY = struct.Struct('<BQqIHBdddff')
+
+COMMAND_TELEMETRY = 0
+COMMAND_SUBSCRIBE = 1
+COMMAND_PUMP_ON = 2
+COMMAND_PUMP_OFF = 3
+COMMAND_VALVE_OPEN = 4
+COMMAND_VALVE_CLOSE = 5
+COMMAND_SESSION_START = 6
+COMMAND_SESSION_STOP = 7
+COMMAND_SET_TARGET = 8
+COMMAND_SET_TOLERANCE_MINUS = 9
+COMMAND_SET_TOLERANCE_PLUS = 10
+COMMAND_SET_MODE = 11
+
+STATUS_OK = 0
+STATUS_CONFLICT = 1
+STATUS_INVALID = 2
+STATUS_UNKNOWN = 3
+
+FLAG_SESSION_ON = 0x01
+FLAG_PUMP_ON = 0x02
+FLAG_VALVE_CLOSED = 0x04
+FLAG_PRESSURE_STALE = 0x08
+FLAG_AUTO_SETPOINT = 0x10
+FLAG_INTERLOCK_TRIPPED = 0x20
+
+
+class LocalServer:
+    """
+    Serves local consumers, e.g. a display or a data logger on the same
+    Pi, over a Unix domain socket next to the HTTP API.
+
+    Every request is a fixed REQUEST of command and argument, answered with
+    a fixed REPLY of status and the telemetry frame after the command. A
+    COMMAND_SUBSCRIBE connection instead receives a frame for every new
+    pressure sample, at most one every `argument` seconds, until the client
+    closes it. Commands are checked like their HTTP counterparts, an
+    argument that is not finite is STATUS_INVALID for every command.
+    """
+    POLL_TIMEOUT = 0.5
+
+    _logger: logging.Logger
+    _control_data: ControlData
+    _path: str
+    _socket: socket.socket
+    _running: bool
+    _threads: list
+
+    def __init__(self, control_data: ControlData, path: str, mode: int=0o660):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._path = path
+        # a stale socket of a previous run blocks the bind
+        if os.path.exists(path):
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        os.chmod(path, mode)
+        self._socket.listen()
+        self._socket.settimeout(self.POLL_TIMEOUT)
+        self._running = False
+        self._threads = []
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def _reply(self, status: int) -> bytes:
+        control_data = self._control_data
+        sample = control_data.get_pressure_sample()
+        flags = ((FLAG_SESSION_ON if control_data.event_session_on.is_set() else 0)
+                 | (FLAG_PUMP_ON if control_data.event_pump_state_on.is_set() else 0)
+                 | (FLAG_VALVE_CLOSED if control_data.event_valve_state_closed.is_set() else 0)
+                 | (FLAG_PRESSURE_STALE if control_data.event_pressure_stale.is_set() else 0)
+                 | (FLAG_AUTO_SETPOINT if control_data.event_auto_setpoint.is_set() else 0)
+                 | (FLAG_INTERLOCK_TRIPPED if control_data.event_interlock_tripped.is_set() else 0))
+        return REPLY.pack(status,
+                          sample.sequence,
+                          sample.time_ns,
+                          control_data.get_session_id(),
+                          control_data.get_mode(),
+                          flags,
+                          sample.value,
+                          control_data.get_pressure_target(),
+                          control_data.get_pressure_setpoint(),
+                          control_data.get_pressure_target_tolerance_plus(),
+                          control_data.get_pressure_target_tolerance_minus())
+
+    def _apply(self, command: int, argument: float) -> int:
+        control_data = self._control_data
+        session_on = control_data.event_session_on.is_set()
+        interlock_tripped = control_data.event_interlock_tripped.is_set()
+        if command == COMMAND_TELEMETRY:
+            return STATUS_OK
+        # NaN would pass every range check below
+        elif not math.isfinite(argument):
+            return STATUS_INVALID
+        elif command in (COMMAND_PUMP_ON, COMMAND_PUMP_OFF, COMMAND_VALVE_OPEN, COMMAND_VALVE_CLOSE):
+            pump_on = control_data.event_pump_state_on.is_set()
+            valve_closed = control_data.event_valve_state_closed.is_set()
+            if session_on:
+                return STATUS_CONFLICT
+            if command == COMMAND_PUMP_ON:
+                if pump_on or interlock_tripped:
+                    return STATUS_CONFLICT
+                control_data.request_pump_on(ControlData.CAUSE_API)
+            elif command == COMMAND_PUMP_OFF:
+                if not pump_on:
+                    return STATUS_CONFLICT
+                control_data.request_pump_off(ControlData.CAUSE_API)
+            elif command == COMMAND_VALVE_OPEN:
+                if not valve_closed:
+                    return STATUS_CONFLICT
+                control_data.request_valve_open(ControlData.CAUSE_API)
+            else:
+                if valve_closed or interlock_tripped:
+                    return STATUS_CONFLICT
+                control_data.request_valve_close(ControlData.CAUSE_API)
+        elif command == COMMAND_SESSION_START:
+            if session_on or interlock_tripped:
+                return STATUS_CONFLICT
+            control_data.start_session(ControlData.CAUSE_API)
+        elif command == COMMAND_SESSION_STOP:
+            if not session_on:
+                return STATUS_CONFLICT
+            control_data.stop_session(ControlData.CAUSE_API)
+        elif command == COMMAND_SET_TARGET:
+            if not control_data.get_pressure_min() <= argument <= control_data.get_pressure_max():
+                return STATUS_INVALID
+            control_data.set_pressure_target(argument)
+        elif command in (COMMAND_SET_TOLERANCE_MINUS, COMMAND_SET_TOLERANCE_PLUS):
+            if argument < 0:
+                return STATUS_INVALID
+            if command == COMMAND_SET_TOLERANCE_MINUS:
+                control_data.set_pressure_target_tolerance_minus(argument)
+            else:
+                control_data.set_pressure_target_tolerance_plus(argument)
+        elif command == COMMAND_SET_MODE:
+            mode = int(argument)
+            if mode not in (ControlData.MODE_PRESSURE_HOLD, ControlData.MODE_INTERVAL, ControlData.MODE_PULSATING):
+                return STATUS_INVALID
+            control_data.set_mode(mode)
+        else:
+            return STATUS_UNKNOWN
+        return STATUS_OK
+
+    @staticmethod
+    def _receive(connection: socket.socket, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = connection.recv(size - len(data))
+            except socket.timeout:
+                # only give up between requests
+                if data:
+                    continue
+                raise
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _subscribe(self, connection: socket.socket, interval: float):
+        clock = self._control_data.get_clock()
+        sequence = self._control_data.get_pressure_sample().sequence
+        time_last = None
+        connection.sendall(self._reply(STATUS_OK))
+        while self._running:
+            sample = self._control_data.wait_for_sample(sequence, timeout=self.POLL_TIMEOUT)
+            if sample is None:
+                continue
+            sequence = self._control_data.get_pressure_sample().sequence
+            now = clock.monotonic()
+            if time_last is not None and now - time_last < interval:
+                continue
+            time_last = now
+            connection.sendall(self._reply(STATUS_OK))
+
+    def _serve(self, connection: socket.socket):
+        connection.settimeout(self.POLL_TIMEOUT)
+        try:
+            while self._running:
+                try:
+                    request = self._receive(connection, REQUEST.size)
+                except socket.timeout:
+                    continue
+                if request is None:
+                    break
+                command, argument = REQUEST.unpack(request)
+                if command == COMMAND_SUBSCRIBE:
+                    if not math.isfinite(argument):
+                        connection.sendall(self._reply(STATUS_INVALID))
+                        continue
+                    self._subscribe(connection, argument)
+                    break
+                try:
+                    status = self._apply(command, argument)
+                except Exception as e:
+                    # a bad request must not drop the connection
+                    self._logger.error(f'Local command {command} with {argument} failed: {e}', exc_info=True)
+                    status = STATUS_INVALID
+                connection.sendall(self._reply(status))
+        except OSError as e:
+            self._logger.info(f'Local client disconnected: {e}')
+        finally:
+            connection.close()
+
+    def run(self):
+        self._running = True
+        while self._running and self._control_data.event_run.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self._running:
+                    self._logger.warning(f'Could not accept local connection: {e}')
+                continue
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            thread = Thread(target=self._serve, args=(connection,), name='LocalServer-connection')
+            thread.start()
+            self._threads.append(thread)
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._socket.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def stop(self):
+        self._running = False
+
+
+class LocalClient:
+    """Client of LocalServer, for local consumers written in Python."""
+    def __init__(self, path: str, timeout: float=5.0):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+
+    def close(self):
+        self._socket.close()
+
+    def _read_reply(self) -> tuple:
+        reply = LocalServer._receive(self._socket, REPLY.size)
+        if reply is None:
+            raise ConnectionError('local server closed the connection')
+        status, sequence, time_ns, session_id, mode, flags, *values = REPLY.unpack(reply)
+        return status, Telemetry(sequence, time_ns, session_id, mode,
+                                 bool(flags & FLAG_SESSION_ON),
+                                 bool(flags & FLAG_PUMP_ON),
+                                 bool(flags & FLAG_VALVE_CLOSED),
+                                 bool(flags & FLAG_PRESSURE_STALE),
+                                 bool(flags & FLAG_AUTO_SETPOINT),
+                                 bool(flags & FLAG_INTERLOCK_TRIPPED),
+                                 *values)
+
+    def command(self, command: int, argument: float=0.0) -> tuple:
+        """Returns the status and the Telemetry after the command."""
+        self._socket.sendall(REQUEST.pack(command, argument))
+        return self._read_reply()
+
+    def telemetry(self) -> Telemetry:
+        return self.command(COMMAND_TELEMETRY)[1]
+
+    def subscribe(self, interval: float=0.0):
+        """Yields Telemetry for new samples, the connection serves nothing else afterwards."""
+        self._socket.sendall(REQUEST.pack(COMMAND_SUBSCRIBE, interval))
+        while True:
+            yield self._read_reply()[1]
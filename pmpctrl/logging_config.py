@@ -1,10 +1,89 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 
+from threading import Lock
 from time import gmtime
+from time import monotonic
+
+LOG_FORMAT = '%(asctime)s.%(msecs)03dZ | %(levelname)-8s | %(name)-16s | %(funcName)-16s | %(message)s'
+LOG_DATEFMT = '%Y-%m-%dT%H:%M:%S'
+LOG_QUEUE_SIZE = 10000
 
 logging.Formatter.converter = gmtime
 
-logging.basicConfig(
-    format = '%(asctime)s.%(msecs)03dZ | %(levelname)-8s | %(name)-16s | %(funcName)-16s | %(message)s',
-    datefmt = '%Y-%m-%dT%H:%M:%S'
-)
\ No newline at end of file
+
+class RepeatFilter(logging.Filter):
+    """
+    Suppresses identical messages (same logger, level, message and
+    arguments) repeated within `interval` seconds. The next message that
+    passes reports how many repeats were dropped.
+    """
+    def __init__(self, interval: float=1.0, keys_max: int=1024):
+        super().__init__()
+        self._interval = interval
+        self._keys_max = keys_max
+        self._lock = Lock()
+        self._last = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, record.msg, record.args)
+        try:
+            hash(key)
+        except TypeError:
+            key = (record.name, record.levelno, record.getMessage())
+
+        now = monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last[0] < self._interval:
+                last[1] += 1
+                return False
+            if last is None and len(self._last) >= self._keys_max:
+                self._last.clear()
+            suppressed = last[1] if last is not None else 0
+            self._last[key] = [now, 0]
+
+        if suppressed:
+            record.msg = f'{record.getMessage()} ({suppressed} repeats suppressed)'
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread without formatting them, so that
+    neither formatting nor I/O happen on the control threads. Records are
+    dropped instead of blocking when the queue is full.
+    """
+    dropped: int
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatted by the listener, hot path arguments are immutable values
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT))
+
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.addFilter(RepeatFilter())
+
+queue_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+logging.basicConfig(handlers=[queue_handler])
+queue_listener.start()
+atexit.register(queue_listener.stop)
@@ -1,9 +1,18 @@
 from fastapi import APIRouter
 from fastapi import FastAPI
 from fastapi import HTTPException
+from fastapi import Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
+from pmpctrl.admission_control import AdmissionControl
+from pmpctrl.admission_control import AdmissionMiddleware
 from pmpctrl.control_data import ControlData
 from pydantic import BaseModel
+from time import monotonic_ns
+from time import sleep
+from typing import Callable
 from typing import Literal
 
 
@@ -27,6 +36,8 @@ class Mode(BaseModel):
 class ModeInterval(BaseModel):
     peak_pressure: float
     interval_time: float
+    dwell_time: float | None = None
+    ramp_time: float | None = None
 
 class ModePulsating(BaseModel):
     pump_time: float
@@ -46,13 +57,29 @@ class ApiErrorSessionOn(ApiError):
         )
         super().__init__(error_msg)
 
+class ApiErrorInterlockTripped(ApiError):
+    def __init__(self):
+        error_msg = ErrorMessage(
+            status=409,
+            title='Interlock tripped',
+            detail='Reset the interlock first to perform this operation'
+        )
+        super().__init__(error_msg)
+
 class PmpctrlAPI(FastAPI):
     _control_data: ControlData
     _router: APIRouter()
+    _config_reload: Callable
+    _admission_control: AdmissionControl
 
-    def __init__(self, control_data: ControlData):
+    def __init__(self, control_data: ControlData, config_reload: Callable=None, admission_control: AdmissionControl=None):
         super().__init__()
         self._control_data = control_data
+        self._config_reload = config_reload
+        self._admission_control = admission_control if admission_control is not None else AdmissionControl()
+
+        # inside CORS, so that rejections carry the CORS headers too
+        self.add_middleware(AdmissionMiddleware, admission_control=self._admission_control)
 
         # CORS
         origins = ['*']
@@ -73,11 +100,17 @@ class PmpctrlAPI(FastAPI):
         self._router.add_api_route('/pressure/target', self.put_pressure_target, tags=['pressure'], methods=['PUT'])
         self._router.add_api_route('/pressure/setpoint', self.get_pressure_setpoint, tags=['pressure'], methods=['GET'])
         self._router.add_api_route('/pressure/setpoint', self.put_pressure_setpoint, tags=['pressure'], methods=['PUT'])
+        self._router.add_api_route('/pressure/sensor', self.get_pressure_sensor, tags=['pressure'], methods=['GET'])
         
         self._router.add_api_route('/session', self.get_session, tags=['session'], methods=['GET'])
         self._router.add_api_route('/session/start', self.put_session_start, tags=['session'], methods=['PUT'])
         self._router.add_api_route('/session/stop', self.put_session_stop, tags=['session'], methods=['PUT'])
 
+        self._router.add_api_route('/sessions', self.get_sessions, tags=['session'], methods=['GET'])
+        self._router.add_api_route('/sessions/{session_id}/actuators', self.get_session_actuators, tags=['session'], methods=['GET'])
+        self._router.add_api_route('/sessions/{session_id}/stats', self.get_session_stats, tags=['session'], methods=['GET'])
+        self._router.add_api_route('/sessions/{session_id}/export', self.get_session_export, tags=['session'], methods=['GET'])
+
         self._router.add_api_route('/pump', self.get_pump, tags=['pump'], methods=['GET'])
         self._router.add_api_route('/pump/on', self.put_pump_on, tags=['pump'], methods=['PUT'])
         self._router.add_api_route('/pump/off', self.put_pump_off, tags=['pump'], methods=['PUT'])
@@ -91,6 +124,18 @@ class PmpctrlAPI(FastAPI):
         self._router.add_api_route('/mode/interval', self.put_mode_interval, tags=['mode'], methods=['PUT'])
         self._router.add_api_route('/mode/pulsating', self.put_mode_pulsating, tags=['mode'], methods=['PUT'])
         
+        self._router.add_api_route('/config/reload', self.put_config_reload, tags=['config'], methods=['PUT'])
+
+        self._router.add_api_route('/admission', self.get_admission, tags=['api'], methods=['GET'])
+
+        self._router.add_api_route('/interlock', self.get_interlock, tags=['interlock'], methods=['GET'])
+        self._router.add_api_route('/interlock/reset', self.put_interlock_reset, tags=['interlock'], methods=['PUT'])
+
+        self._router.add_api_route('/health', self.get_health, tags=['health'], methods=['GET'])
+
+        self._router.add_api_route('/debug/profile', self.post_debug_profile, tags=['debug'], methods=['POST'],
+                                   response_class=PlainTextResponse)
+
         self.include_router(self._router)
         
     def _get_session_state(self) -> str:
@@ -102,9 +147,15 @@ class PmpctrlAPI(FastAPI):
     def _get_valve_state(self) -> str:
         return 'closed' if self._control_data.event_valve_state_closed.is_set() else 'open'
 
+    def _get_interlock_state(self) -> str:
+        return 'tripped' if self._control_data.event_interlock_tripped.is_set() else 'armed'
+
     def _get_auto_setpoint(self) -> bool:
         return True if self._control_data.event_auto_setpoint.is_set() else False
 
+    def _get_pressure_stale(self) -> bool:
+        return True if self._control_data.event_pressure_stale.is_set() else False
+
     def _get_active_mode(self) -> str:
         mode = self._control_data.get_mode()
         mode_str = 'unknown'
@@ -128,11 +179,14 @@ class PmpctrlAPI(FastAPI):
             'session' : self._get_session_state(),
             'pump' : self._get_pump_state(),
             'valve' : self._get_valve_state(),
+            'interlock' : self._get_interlock_state(),
             'time_utc_now' : self._control_data.get_time_utc_now().isoformat(),
             'time_utc_session_start' : startSession,
             'last_session_duration' : lastSessionDuration,
             'pressure': {
                 'actual' : self._control_data.get_pressure_actual(),
+                'age' : self._control_data.get_pressure_sample_age(),
+                'stale' : self._get_pressure_stale(),
                 'setpoint' : self._control_data.get_pressure_setpoint(),
                 'auto_setpoint' : self._get_auto_setpoint(),
                 'min' : self._control_data.get_pressure_min(),
@@ -146,6 +200,8 @@ class PmpctrlAPI(FastAPI):
         return {
             'pressure': {
                 'actual' : self._control_data.get_pressure_actual(),
+                'age' : self._control_data.get_pressure_sample_age(),
+                'stale' : self._get_pressure_stale(),
                 'setpoint' : self._control_data.get_pressure_setpoint(),
                 'auto_setpoint' : self._get_auto_setpoint(),
                 'min' : self._control_data.get_pressure_min(),
@@ -155,7 +211,24 @@ class PmpctrlAPI(FastAPI):
         }
 
     def get_pressure_actual(self) -> dict:
-        return { 'actual' : self._control_data.get_pressure_actual() }
+        sample = self._control_data.get_pressure_sample()
+        return {
+            'actual' : sample.value,
+            'sequence' : sample.sequence,
+            'age' : self._control_data.get_pressure_sample_age()
+        }
+
+    def get_pressure_sensor(self) -> dict:
+        sensor = {
+            'stale' : self._get_pressure_stale(),
+            'recovery_count' : self._control_data.get_sensor_recovery_count(),
+            'recovery_time_last' : self._control_data.get_sensor_recovery_time_last(),
+            'recovery_time_max' : self._control_data.get_sensor_recovery_time_max()
+        }
+        pressure_sensor = self._control_data.get_pressure_sensor()
+        if pressure_sensor is not None:
+            sensor.update(pressure_sensor.get_status())
+        return sensor
 
     def get_pressure_target(self) -> dict:
         return {
@@ -220,13 +293,17 @@ class PmpctrlAPI(FastAPI):
                 self._control_data.set_pressure_setpoint(setpoint.setpoint)
 
     def get_session(self) -> dict:
-        return { 'session' : self._get_session_state() }
+        return {
+            'session' : self._get_session_state(),
+            'statistics' : self._control_data.get_session_statistics()
+        }
         
     def put_session_start(self) -> dict:
         if self._control_data.event_session_on.is_set():
             raise ApiErrorSessionOn()
-        self._control_data.event_session_on.set()
-        self._control_data.set_time_utc_session_start()
+        elif self._control_data.event_interlock_tripped.is_set():
+            raise ApiErrorInterlockTripped()
+        self._control_data.start_session(ControlData.CAUSE_API)
         return self.get_session()
 
     def put_session_stop(self) -> dict:
@@ -237,15 +314,88 @@ class PmpctrlAPI(FastAPI):
                 detail = 'Start a session first to stop it'
             )
             raise ApiError(error)
-        self._control_data.event_session_on.clear()
-        self._control_data.set_last_session_duration()
-        # TODO: put in own function in ControlData to keep API clear of logic
-        if self._control_data.event_pump_state_on.is_set():
-            self._control_data.event_pump_turn_off.set()
-        if not self._control_data.event_valve_state_closed.is_set():
-            self._control_data.event_valve_close.set()
+        self._control_data.stop_session(ControlData.CAUSE_API)
         return self.get_session()
 
+    def _get_actuator_journal(self):
+        actuator_journal = self._control_data.get_actuator_journal()
+        if actuator_journal is None:
+            error = ErrorMessage(
+                status = 503,
+                title = 'Actuator journal not available',
+                detail = 'Configure [journal] actuator_file to record actuator edges'
+            )
+            raise ApiError(error)
+        return actuator_journal
+
+    def get_sessions(self) -> dict:
+        return {
+            'sessions' : self._get_actuator_journal().get_session_ids(),
+            'active' : self._control_data.get_session_id() if self._control_data.event_session_on.is_set() else None
+        }
+
+    def get_session_actuators(self, session_id: int) -> dict:
+        statistics = self._get_actuator_journal().get_session_statistics(session_id, monotonic_ns())
+        if statistics is None:
+            error = ErrorMessage(
+                status = 404,
+                title = 'Session not found',
+                detail = f'No session with id {session_id} in the actuator journal'
+            )
+            raise ApiError(error)
+        return statistics
+
+    def _get_session_recorder(self):
+        session_recorder = self._control_data.get_session_recorder()
+        if session_recorder is None:
+            error = ErrorMessage(
+                status = 503,
+                title = 'Session recorder not available',
+                detail = 'Configure [recorder] directory to record sessions'
+            )
+            raise ApiError(error)
+        return session_recorder
+
+    def get_session_stats(self, session_id: int) -> dict:
+        statistics = self._get_session_recorder().get_session_statistics(session_id)
+        if statistics is None:
+            error = ErrorMessage(
+                status = 404,
+                title = 'Session not found',
+                detail = f'No recording of session {session_id}'
+            )
+            raise ApiError(error)
+        return statistics
+
+    def get_session_export(self, session_id: int, format: Literal['csv', 'parquet']='csv') -> StreamingResponse:
+        session_recorder = self._get_session_recorder()
+        # samples recorded after this point are not part of the export
+        length = session_recorder.get_session_length(session_id)
+        if length is None:
+            error = ErrorMessage(
+                status = 404,
+                title = 'Session not found',
+                detail = f'No recording of session {session_id}'
+            )
+            raise ApiError(error)
+        if format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                error = ErrorMessage(
+                    status = 501,
+                    title = 'Parquet export not available',
+                    detail = 'Install pyarrow to export sessions as Parquet'
+                )
+                raise ApiError(error)
+            content = session_recorder.export_parquet(session_id, length)
+            media_type = 'application/vnd.apache.parquet'
+        else:
+            content = session_recorder.export_csv(session_id, length)
+            media_type = 'text/csv'
+        headers = { 'Content-Disposition' : f'attachment; filename="session_{session_id}.{format}"' }
+        return StreamingResponse(content, media_type=media_type, headers=headers)
+
     def get_valve(self) -> dict:
         return { 'valve' : self._get_valve_state() }
 
@@ -259,13 +409,15 @@ class PmpctrlAPI(FastAPI):
                 detail = 'Close valve first to open it'
             )
             raise ApiError(error)
-        self._control_data.event_valve_open.set()
+        self._control_data.request_valve_open(ControlData.CAUSE_API)
         # TODO: race condition -> either return nothing or wait until state change
         #return self.get_valve()
 
     def put_valve_close(self):
         if self._control_data.event_session_on.is_set():
             raise ApiErrorSessionOn()
+        elif self._control_data.event_interlock_tripped.is_set():
+            raise ApiErrorInterlockTripped()
         elif self._control_data.event_valve_state_closed.is_set():
             error = ErrorMessage(
                 status = 409,
@@ -273,7 +425,7 @@ class PmpctrlAPI(FastAPI):
                 detail = 'Open valve first to close it'
             )
             raise ApiError(error)
-        self._control_data.event_valve_close.set()
+        self._control_data.request_valve_close(ControlData.CAUSE_API)
         # TODO: race condition -> either return nothing or wait until state change
         #return self.get_valve()
 
@@ -283,6 +435,8 @@ class PmpctrlAPI(FastAPI):
     def put_pump_on(self):
         if self._control_data.event_session_on.is_set():
             raise ApiErrorSessionOn()
+        elif self._control_data.event_interlock_tripped.is_set():
+            raise ApiErrorInterlockTripped()
         elif self._control_data.event_pump_state_on.is_set():
             error = ErrorMessage(
                 status = 409,
@@ -290,8 +444,7 @@ class PmpctrlAPI(FastAPI):
                 detail = 'Turn pump off first'
             )
             raise ApiError(error)
-        self._control_data.event_pump_turn_off.clear()
-        self._control_data.event_pump_turn_on.set()
+        self._control_data.request_pump_on(ControlData.CAUSE_API)
         # TODO: race condition -> either return nothing or wait until state change
         #return self.get_pump()
 
@@ -305,8 +458,7 @@ class PmpctrlAPI(FastAPI):
                 detail = 'Turn pump on first'
             )
             raise ApiError(error)
-        self._control_data.event_pump_turn_on.clear()
-        self._control_data.event_pump_turn_off.set()
+        self._control_data.request_pump_off(ControlData.CAUSE_API)
         # TODO: race condition -> either return nothing or wait until state change
         #return self.get_pump()
 
@@ -317,7 +469,9 @@ class PmpctrlAPI(FastAPI):
             'available' : available_modes,
             'interval': {
                 'peak_pressure' : self._control_data.get_mode_interval_peak_pressure(),
-                'interval_time' : self._control_data.get_mode_interval_time()
+                'interval_time' : self._control_data.get_mode_interval_time(),
+                'dwell_time' : self._control_data.get_mode_interval_dwell_time(),
+                'ramp_time' : self._control_data.get_mode_interval_ramp_time()
             },
             'pulsating': {
                 'pump_time' : self._control_data.get_mode_pulsating_pump_time(),
@@ -336,7 +490,107 @@ class PmpctrlAPI(FastAPI):
     def put_mode_interval(self, settings: ModeInterval):
         self._control_data.set_mode_interval_peak_pressure(settings.peak_pressure)
         self._control_data.set_mode_interval_time(settings.interval_time)
+        if settings.dwell_time is not None:
+            self._control_data.set_mode_interval_dwell_time(settings.dwell_time)
+        if settings.ramp_time is not None:
+            self._control_data.set_mode_interval_ramp_time(settings.ramp_time)
 
     def put_mode_pulsating(self, settings: ModePulsating):
         self._control_data.set_mode_pulsating_pump_time(settings.pump_time)
-        self._control_data.set_mode_pulsating_release_time(settings.release_time)
\ No newline at end of file
+        self._control_data.set_mode_pulsating_release_time(settings.release_time)
+
+    def put_config_reload(self) -> dict:
+        if self._config_reload is None:
+            error = ErrorMessage(
+                status = 503,
+                title = 'Config reload not available',
+                detail = 'The service was started without a config file'
+            )
+            raise ApiError(error)
+        result = self._config_reload()
+        if result['status'] == 'refused':
+            error = ErrorMessage(
+                status = 409,
+                title = 'Config reload refused',
+                detail = f'Restart the service to change {", ".join(result["refused"])}'
+            )
+            raise ApiError(error)
+        elif result['status'] == 'failed':
+            error = ErrorMessage(
+                status = 400,
+                title = 'Config reload failed',
+                detail = result['error']
+            )
+            raise ApiError(error)
+        return result
+
+    def get_admission(self) -> dict:
+        return self._admission_control.get_statistics()
+
+    def _get_interlock(self):
+        interlock = self._control_data.get_interlock()
+        if interlock is None:
+            error = ErrorMessage(
+                status = 503,
+                title = 'Interlock not available',
+                detail = 'Enable [interlock] to enforce the pressure limits'
+            )
+            raise ApiError(error)
+        return interlock
+
+    def get_interlock(self) -> dict:
+        return self._get_interlock().get_status()
+
+    def put_interlock_reset(self) -> dict:
+        if not self._get_interlock().reset():
+            error = ErrorMessage(
+                status = 409,
+                title = 'Pressure out of limits',
+                detail = f'Wait until the pressure is within min={self._control_data.get_pressure_min()} to max={self._control_data.get_pressure_max()}'
+            )
+            raise ApiError(error)
+        return self.get_interlock()
+
+    def get_health(self) -> JSONResponse:
+        supervisor = self._control_data.get_supervisor()
+        if supervisor is None:
+            error = ErrorMessage(
+                status = 503,
+                title = 'Supervisor not running',
+                detail = 'The health of the loops is only known to the service'
+            )
+            raise ApiError(error)
+        health = supervisor.get_status()
+        # monitors only look at the status code
+        return JSONResponse(health, status_code=503 if health['status'] == 'failed' else 200)
+
+    def _get_profiler(self):
+        profiler = self._control_data.get_profiler()
+        if profiler is None:
+            error = ErrorMessage(
+                status = 404,
+                title = 'Profiler not enabled',
+                detail = 'Set profiler = true in [debug] to profile the service'
+            )
+            raise ApiError(error)
+        return profiler
+
+    def post_debug_profile(self, seconds: float = Query(default=10.0, gt=0, le=60)) -> PlainTextResponse:
+        profiler = self._get_profiler()
+        if not profiler.start(seconds):
+            error = ErrorMessage(
+                status = 409,
+                title = 'Profile running',
+                detail = 'Wait for the running profile to finish'
+            )
+            raise ApiError(error)
+        sleep(seconds)
+        result = profiler.get_result()
+        while result['running']:
+            sleep(0.05)
+            result = profiler.get_result()
+        headers = {
+            'X-Profile-Samples' : str(result['samples']),
+            'X-Profile-Overhead' : f"{result['overhead']:.6f}"
+        }
+        return PlainTextResponse(result['stacks'], headers=headers)
@@ -2,86 +2,121 @@ import logging
 import pmpctrl.logging_config
 
 from pmpctrl.control_data import ControlData
-from time import sleep
 
 class PressureControl:
     _logger: logging.Logger
     _control_data: ControlData
     _cycle_time: float
+    _idle_cycle_time: float
+    _sample_age_max: float
+    _sequence: int
 
-    def __init__(self, control_data: ControlData, cycle_time: float=0.1):
+    def __init__(self,
+                 control_data: ControlData,
+                 cycle_time: float=0.1,
+                 sample_age_max: float=0.5,
+                 idle_cycle_time: float=0.5):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(control_data.get_log_level())
         self._control_data = control_data
+        # runs once per new sample, cycle_time is the longest wait for one
         self._cycle_time = cycle_time
+        self._idle_cycle_time = idle_cycle_time
+        self._sample_age_max = sample_age_max
+        self._sequence = 0
 
-    def _pump_on(self):
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def set_cycle_time(self, cycle_time: float):
+        self._cycle_time = cycle_time
+
+    def _pump_on(self, cause: int=ControlData.CAUSE_PRESSURE_CONTROL):
         if not self._control_data.event_pump_state_on.is_set():
-            self._control_data.event_pump_turn_on.set()
-            self._control_data.event_pump_turn_off.clear()
+            self._control_data.request_pump_on(cause)
 
-    def _pump_off(self):
+    def _pump_off(self, cause: int=ControlData.CAUSE_PRESSURE_CONTROL):
         if self._control_data.event_pump_state_on.is_set():
-            self._control_data.event_pump_turn_on.clear()
-            self._control_data.event_pump_turn_off.set()
+            self._control_data.request_pump_off(cause)
 
-    def _open_valve(self):
+    def _open_valve(self, cause: int=ControlData.CAUSE_PRESSURE_CONTROL):
         if self._control_data.event_valve_state_closed.is_set():
-            self._control_data.event_valve_open.set()
-            self._control_data.event_valve_close.clear()
+            self._control_data.request_valve_open(cause)
 
-    def _close_valve(self):
+    def _close_valve(self, cause: int=ControlData.CAUSE_PRESSURE_CONTROL):
         if not self._control_data.event_valve_state_closed.is_set():
-            self._control_data.event_valve_open.clear()
-            self._control_data.event_valve_close.set()
+            self._control_data.request_valve_close(cause)
+
 
+    def _fail_safe(self):
+        """
+        Without a valid reading the pump is switched off and the chamber is
+        vented until the sensor has recovered.
+        """
+        self._pump_off(ControlData.CAUSE_FAILSAFE)
+        self._open_valve(ControlData.CAUSE_FAILSAFE)
 
-    def _pressure_hold(self):
-        pressure_is = self._control_data.get_pressure_actual()
+
+    def _is_stale(self) -> bool:
+        if self._control_data.event_pressure_stale.is_set():
+            return True
+        # a hanging sensor thread does not flag the reading itself
+        sample_age = self._control_data.get_pressure_sample_age()
+        return sample_age is None or sample_age > self._sample_age_max
+
+
+    def _pressure_hold(self, pressure_is: float):
         pressure_target = self._control_data.get_pressure_target()
         pressure_tolerance_minus = self._control_data.get_pressure_target_tolerance_minus()
         pressure_tolerance_plus = self._control_data.get_pressure_target_tolerance_plus()
 
-        self._logger.debug(f'pressure is {pressure_is} and should be {pressure_target} +{pressure_tolerance_plus}/-{pressure_tolerance_minus}')
+        self._logger.debug('pressure is %s and should be %s +%s/-%s', pressure_is, pressure_target, pressure_tolerance_plus, pressure_tolerance_minus)
 
         if pressure_is < pressure_target - pressure_tolerance_minus:
             self._logger.debug('Pressure to LOW')
             if self._control_data.event_pump_state_on.is_set():
-                self._logger.debug(f'Pressure to LOW and pump is ON -> signaling to turn power OFF')
-                self._control_data.event_pump_turn_on.clear()
-                self._control_data.event_pump_turn_off.set()
+                self._logger.debug('Pressure to LOW and pump is ON -> signaling to turn power OFF')
+                self._control_data.request_pump_off(ControlData.CAUSE_PRESSURE_CONTROL)
             if self._control_data.event_valve_state_closed.is_set():
-                self._logger.debug(f'Pressure to LOW and valve is CLOSED -> signaling to OPEN valve')
-                self._control_data.event_valve_close.clear()
-                self._control_data.event_valve_open.set()
+                self._logger.debug('Pressure to LOW and valve is CLOSED -> signaling to OPEN valve')
+                self._control_data.request_valve_open(ControlData.CAUSE_PRESSURE_CONTROL)
         elif pressure_is > pressure_target + pressure_tolerance_plus:
             self._logger.debug('Pressure to HIGH')
             if not self._control_data.event_pump_state_on.is_set():
                 self._logger.debug('Pressure to HIGH and pump is OFF -> signaling to turn power ON')
-                self._control_data.event_pump_turn_on.set()
-                self._control_data.event_pump_turn_off.clear()
+                self._control_data.request_pump_on(ControlData.CAUSE_PRESSURE_CONTROL)
             if not self._control_data.event_valve_state_closed.is_set():
                 self._logger.debug('Pressure to HIGH and valve is OPEN -> signaling to CLOSE valve')
-                self._control_data.event_valve_open.clear()
-                self._control_data.event_valve_close.set()
+                self._control_data.request_valve_close(ControlData.CAUSE_PRESSURE_CONTROL)
         else:
             self._logger.debug('Pressure is GOOD')
             if self._control_data.event_pump_state_on.is_set():
                 self._logger.debug('Pressure is GOOD and pump is ON -> signaling to turn power OFF')
-                self._control_data.event_pump_turn_on.clear()
-                self._control_data.event_pump_turn_off.set()
+                self._control_data.request_pump_off(ControlData.CAUSE_PRESSURE_CONTROL)
             if not self._control_data.event_valve_state_closed.is_set():
                 self._logger.debug('Pressure is GOOD and valve is OPEN -> signaling to CLOSE valve')
-                self._control_data.event_valve_open.clear()
-                self._control_data.event_valve_close.set()
+                self._control_data.request_valve_close(ControlData.CAUSE_PRESSURE_CONTROL)
         
+    def step(self, timeout: float=0.0):
+        """
+        Evaluates the next sample, waiting up to `timeout` seconds for it.
+        """
+        sample = self._control_data.wait_for_sample(self._sequence, timeout=timeout)
+        if sample is not None:
+            self._sequence = sample.sequence
+        if self._control_data.event_session_on.is_set():
+            if self._is_stale():
+                self._fail_safe()
+            elif sample is not None and self._control_data.get_pressure_control():
+                self._pressure_hold(sample.value)
+
     def run(self):
         try:
             while self._control_data.event_run.is_set():
-                if self._control_data.event_session_on.is_set() and self._control_data.get_pressure_control():
-                    self._pressure_hold()
-                sleep(self._cycle_time)
+                timeout = self._cycle_time if self._control_data.event_active.is_set() else self._idle_cycle_time
+                self._control_data.heartbeat(self.__class__.__name__, timeout)
+                self.step(timeout=timeout)
             self._logger.info('run event is FALSE -> Exiting')
         except KeyboardInterrupt:
             self._logger.info('Program stopped by user through keyboard interrupt.')
-            self._control_data.event_run.clear()
\ No newline at end of file
+            self._control_data.stop()
\ No newline at end of file
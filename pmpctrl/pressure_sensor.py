@@ -1,95 +1,502 @@
 import logging
+import math
 import pmpctrl.logging_config
 
-from bmp280 import BMP280
+from pmpctrl.clock import Clock
 from pmpctrl.control_data import ControlData
-from smbus2 import SMBus
-from statistics import fmean
-from time import sleep
+from pmpctrl.setpoint_calibration import SetpointCalibration
+from pmpctrl.setpoint_calibration import SetpointStore
+from statistics import median
+from threading import Lock
+
+class SensorChannel:
+    """
+    One BMP280 read by PressureSensor, with its own bus handle and its own
+    recovery: a failing channel backs off and re-initializes while the
+    other channels keep being read.
+    """
+    STATE_OK = 0
+    STATE_RECOVERING = 1
+
+    # weight of a new residual in the running noise estimate
+    NOISE_ALPHA = 0.01
+    # residuals before the noise estimate is used for weighting
+    NOISE_SAMPLES_MIN = 50
+
+    _logger: logging.Logger
+    _clock: Clock
+    _bus: object
+    _bmp280: object
+    _smbus_factory: type
+    _bmp280_factory: type
+    _state: int
+    _time_fault: float
+    _time_retry: float
+    _backoff: float
+
+    def __init__(self,
+                 clock: Clock,
+                 bus_nr: int,
+                 i2c_addr: int,
+                 backoff_min: float,
+                 backoff_max: float,
+                 smbus_factory: type,
+                 bmp280_factory: type,
+                 logger: logging.Logger):
+        self._logger = logger
+        self._clock = clock
+        self.bus_nr = bus_nr
+        self.i2c_addr = i2c_addr
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+        self._smbus_factory = smbus_factory
+        self._bmp280_factory = bmp280_factory
+        self._state = SensorChannel.STATE_OK
+        self._time_fault = None
+        self._time_retry = None
+        self._backoff = backoff_min
+        self._bus = None
+        self._bmp280 = None
+        self.value = None
+        self.excluded = False
+        self.failures = 0
+        self.exclusions = 0
+        self.variance = None
+        self.residuals = 0
+        self.weight = None
+
+    @property
+    def name(self) -> str:
+        return f'{self.bus_nr}:{self.i2c_addr:#04x}'
+
+    def is_ok(self) -> bool:
+        return self._state == SensorChannel.STATE_OK
+
+    def setup(self):
+        self._bus = self._smbus_factory(self.bus_nr)
+        self._bmp280 = self._bmp280_factory(i2c_dev=self._bus, i2c_addr=self.i2c_addr)
+        self._bmp280.setup(mode="forced")
+
+
+    def bus_close(self):
+        if self._bus is None:
+            return
+        try:
+            self._bus.close()
+        except Exception as e:
+            self._logger.debug(f'Closing I2C bus of sensor {self.name} failed: {e}')
+        self._bus = None
+
+
+    def fault(self, error: Exception):
+        """
+        Enters the recovery state, the first re-initialization is attempted
+        after `backoff_min` seconds.
+        """
+        if self._state == SensorChannel.STATE_OK:
+            self._logger.warning(f'Could not read pressure sensor {self.name}, re-initializing I2C: {error}')
+            self._state = SensorChannel.STATE_RECOVERING
+            self._time_fault = self._clock.monotonic()
+            self._backoff = self._backoff_min
+            self.failures += 1
+        else:
+            self._backoff = min(self._backoff * 2, self._backoff_max)
+            self._logger.debug('Recovery attempt of sensor %s failed, next one in %ss: %s', self.name, self._backoff, error)
+        self._time_retry = self._clock.monotonic() + self._backoff
+
+
+    def _recover(self) -> bool:
+        """
+        Reopens the SMBus and re-initializes the sensor, once the backoff has
+        elapsed. Returns True if the sensor is ready to be read again.
+        """
+        if self._clock.monotonic() < self._time_retry:
+            return False
+        self.bus_close()
+        try:
+            self.setup()
+        except Exception as e:
+            self.fault(e)
+            return False
+        return True
+
+
+    def read(self) -> tuple:
+        """
+        Returns the pressure, None without a reading, and the recovery time
+        in seconds if the channel has just recovered.
+        """
+        self.value = None
+        if self._state == SensorChannel.STATE_RECOVERING and not self._recover():
+            return None, None
+        try:
+            pressure = self._bmp280.get_pressure()
+        except Exception as e:
+            self.fault(e)
+            return None, None
+        if pressure is None:
+            return None, None
+        self._logger.debug('pressure reading of sensor %s: %s', self.name, pressure)
+        self.value = pressure
+        recovery_time = None
+        if self._state == SensorChannel.STATE_RECOVERING:
+            recovery_time = self._clock.monotonic() - self._time_fault
+            self._state = SensorChannel.STATE_OK
+            self._time_fault = None
+            self._time_retry = None
+            self._logger.warning(f'Pressure sensor {self.name} recovered after {recovery_time:.3f}s')
+        return pressure, recovery_time
+
+
+    def add_residual(self, residual_variance: float):
+        if self.variance is None:
+            self.variance = residual_variance
+        else:
+            self.variance += SensorChannel.NOISE_ALPHA * (residual_variance - self.variance)
+        self.residuals += 1
+
+
+    def get_noise(self) -> float:
+        """Estimated standard deviation of the readings, None before enough residuals."""
+        if self.residuals < SensorChannel.NOISE_SAMPLES_MIN:
+            return None
+        return math.sqrt(self.variance)
+
+
+    def get_status(self) -> dict:
+        if not self.is_ok():
+            state = 'recovering'
+        elif self.excluded:
+            state = 'excluded'
+        else:
+            state = 'ok'
+        return {
+            'bus' : self.bus_nr,
+            'address' : f'{self.i2c_addr:#04x}',
+            'state' : state,
+            'value' : self.value,
+            'noise' : self.get_noise(),
+            'weight' : self.weight,
+            'failures' : self.failures,
+            'exclusions' : self.exclusions
+        }
+
 
 class PressureSensor:
+    """
+    Reads one or more BMP280 (`channels` of (bus, I2C address), by default
+    the one at `smbus_nr` / `i2c_addr`) in every cycle and publishes their
+    fusion as the pressure sample.
+
+    `fusion` is FUSION_MEAN, a mean weighted by the inverse of the noise
+    estimated per channel, or FUSION_MEDIAN. With three or more readings a
+    channel further than `disagreement_max` mbar from their median is
+    excluded from the fusion until it agrees again; of two disagreeing
+    readings the one further from the last sample is excluded. A failing
+    channel recovers on its own, the reading only goes stale when no
+    channel delivers.
+
+    With `idle_delay` set, the sensor clears `event_active` of ControlData
+    after that many seconds without a session, a calibration, a running
+    pump, an actuator request or a pressure change of more than
+    `idle_pressure_delta` mbar, and then only samples every
+    `idle_cycle_time` seconds. Any of them sets it again and wakes the
+    loops waiting on it right away.
+    """
+    FUSION_MEAN = 'mean'
+    FUSION_MEDIAN = 'median'
+
     _logger: logging.Logger
     _control_data: ControlData
+    _clock: Clock
     _cycle_time: float
-    _bus_nr: int
-    _bus: SMBus
-    _i2c_addr: int
-    _bmp280: BMP280
+    _channels: list
+    _fusion: str
+    _disagreement_max: float
+    _setpoint_store: SetpointStore
+    _calibration: SetpointCalibration
+    _calibration_stderr: float
+    _calibration_samples_max: int
+    _interlock: object
+    _status_lock: Lock
+    _stale: bool
+    _pressure_last: float
+    _idle: bool
+    _time_active: float
+    _pressure_idle: float
 
     def __init__(self,
                  control_data: ControlData,
                  cycle_time: float=0.01,
                  smbus_nr: int=1,
-                 i2c_addr: int=0x76):
+                 i2c_addr: int=0x76,
+                 setpoint_store: SetpointStore=None,
+                 calibration_stderr: float=0.01,
+                 calibration_samples_max: int=1000,
+                 backoff_min: float=0.01,
+                 backoff_max: float=1.0,
+                 smbus_factory: type=None,
+                 bmp280_factory: type=None,
+                 interlock=None,
+                 channels: list=None,
+                 fusion: str=FUSION_MEAN,
+                 disagreement_max: float=2.0,
+                 idle_delay: float=0.0,
+                 idle_cycle_time: float=0.5,
+                 idle_pressure_delta: float=1.0):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(control_data.get_log_level())
         self._control_data = control_data
+        self._clock = control_data.get_clock()
         self._cycle_time = cycle_time
-        self._bus_nr = smbus_nr
-        self._i2c_addr = i2c_addr
+        self._setpoint_store = setpoint_store
+        self._calibration = None
+        self._calibration_stderr = calibration_stderr
+        self._calibration_samples_max = calibration_samples_max
+        if fusion not in (PressureSensor.FUSION_MEAN, PressureSensor.FUSION_MEDIAN):
+            raise ValueError(f'unknown sensor fusion {fusion}')
+        self._fusion = fusion
+        self._disagreement_max = disagreement_max
+        # the hardware libraries are only needed without simulated hardware
+        if smbus_factory is None:
+            from smbus2 import SMBus as smbus_factory
+        if bmp280_factory is None:
+            from bmp280 import BMP280 as bmp280_factory
+        self._interlock = interlock
+        self._status_lock = Lock()
+        self._stale = False
+        self._pressure_last = None
+        self._idle_delay = idle_delay
+        self._idle_cycle_time = idle_cycle_time
+        self._idle_pressure_delta = idle_pressure_delta
+        self._idle = False
+        self._time_active = self._clock.monotonic()
+        self._pressure_idle = None
+        self._channels = [SensorChannel(clock=self._clock,
+                                        bus_nr=bus_nr,
+                                        i2c_addr=channel_addr,
+                                        backoff_min=backoff_min,
+                                        backoff_max=backoff_max,
+                                        smbus_factory=smbus_factory,
+                                        bmp280_factory=bmp280_factory,
+                                        logger=self._logger)
+                          for bus_nr, channel_addr in (channels or [(smbus_nr, i2c_addr)])]
         self._bmp280_setup()
 
         
-    def _bmp280_setup(self):
-        try:
-            self._bus = SMBus(self._bus_nr)
-            self._bmp280 = BMP280(i2c_dev=self._bus, i2c_addr=self._i2c_addr)
-            self._bmp280.setup(mode="forced")
-        except Exception as e:
-            self._logger.error(f'Failed to setup I2C sensor: {e}')
-            raise
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
 
+    def set_cycle_time(self, cycle_time: float):
+        self._cycle_time = cycle_time
 
-    def _read(self, retries_max: int=3) -> float:
-        for retry in range(retries_max):
+    def _bmp280_setup(self):
+        for channel in self._channels:
             try:
-                pressure = self._bmp280.get_pressure()
-                if pressure is not None:
-                    self._logger.debug(f'pressure reading: {self._control_data.get_pressure_actual()}')
-                    self._control_data.set_pressure_actual(pressure)
-                    return pressure
+                channel.setup()
             except Exception as e:
-                self._logger.warning(f'Could not read pressure, re-initalizing I2C, retry={retry}')
-                self._bus.close()
-                self._bmp280.setup()
-                sleep(1)
-                continue
-        self._logger.error('Retries for reading pressure exceeded -> STOPPING')
-        self._control_data.event_session_on.clear()
-        self._control_data.event_run.clear()
-        self._control_data.event_error.set()
-        return None
-
-
-    def _set_setpoint(self,
-                      sample_count: int=10,
-                      wait_between_samples: float=1.0):
+                self._logger.error(f'Failed to setup I2C sensor {channel.name}: {e}')
+                channel.fault(e)
+        # absent or glitching at boot, the channels recover like after a
+        # fault while PressureControl fails safe on the stale reading
+        if not any(channel.is_ok() for channel in self._channels):
+            self._mark_stale('No pressure sensor could be set up, marking reading stale')
+
+
+    def _bus_close(self):
+        for channel in self._channels:
+            channel.bus_close()
+
+
+    def _exclude(self, readings: list):
+        """Marks the channels disagreeing with the others as excluded."""
+        disagreeing = set()
+        if len(readings) >= 3:
+            center = median(value for _, value in readings)
+            disagreeing = { channel for channel, value in readings if abs(value - center) > self._disagreement_max }
+        elif len(readings) == 2 and self._pressure_last is not None:
+            (channel_a, value_a), (channel_b, value_b) = readings
+            if abs(value_a - value_b) > self._disagreement_max:
+                further = channel_a if abs(value_a - self._pressure_last) > abs(value_b - self._pressure_last) else channel_b
+                disagreeing = { further }
+        for channel, value in readings:
+            excluded = channel in disagreeing
+            if excluded and not channel.excluded:
+                channel.exclusions += 1
+                self._logger.warning(f'Pressure sensor {channel.name} disagrees with {value:.2f} mbar -> excluded')
+            elif channel.excluded and not excluded:
+                self._logger.warning(f'Pressure sensor {channel.name} agrees again -> included')
+            channel.excluded = excluded
+
+
+    def _fuse(self, readings: list) -> float:
+        values = [value for _, value in readings]
+        if len(readings) >= 2:
+            # residual against the mean of the others, for equal noise its
+            # variance is n/(n-1) times the one of the channel
+            n = len(readings)
+            total = sum(values)
+            for channel, value in readings:
+                residual = value - (total - value) / (n - 1)
+                channel.add_residual(residual * residual * (n - 1) / n)
+        if self._fusion == PressureSensor.FUSION_MEDIAN:
+            for channel, _ in readings:
+                channel.weight = None
+            return median(values)
+        noises = [channel.get_noise() for channel, _ in readings]
+        if None in noises or 0.0 in noises:
+            weights = [1.0] * len(readings)
+        else:
+            weights = [1.0 / (noise * noise) for noise in noises]
+        weight_total = sum(weights)
+        for (channel, _), weight in zip(readings, weights):
+            channel.weight = weight / weight_total
+        return sum(weight * value for weight, value in zip(weights, values)) / weight_total
+
+
+    def _mark_stale(self, message: str):
+        self._logger.warning(message)
+        self._control_data.event_pressure_stale.set()
+        trace_capture = self._control_data.get_trace_capture()
+        if trace_capture is not None:
+            trace_capture.add_stale()
+        self._stale = True
+
+
+    def _read(self) -> float:
+        readings = []
+        with self._status_lock:
+            for channel in self._channels:
+                pressure, recovery_time = channel.read()
+                if recovery_time is not None:
+                    self._control_data.add_sensor_recovery(recovery_time)
+                if pressure is not None:
+                    readings.append((channel, pressure))
+            self._exclude(readings)
+            readings = [(channel, value) for channel, value in readings if not channel.excluded]
+            for channel in self._channels:
+                channel.weight = None
+            pressure = self._fuse(readings) if readings else None
+        if pressure is None:
+            if not self._stale:
+                self._mark_stale('No pressure sensor delivers, marking reading stale')
+            return None
+
+        self._logger.debug('pressure reading: %s', pressure)
+        self._pressure_last = pressure
+        self._control_data.set_pressure_actual(pressure)
+        if self._interlock is not None:
+            # before any control loop acts on the sample
+            self._interlock.check(self._control_data.get_pressure_sample())
+        if self._stale:
+            self._logger.warning('Pressure reading is valid again')
+            self._stale = False
+        self._control_data.event_pressure_stale.clear()
+        return pressure
+
+
+    def get_status(self) -> dict:
+        """Health of every channel and the noise reduction of the fusion."""
+        with self._status_lock:
+            channels = [channel.get_status() for channel in self._channels]
+            noises = [channel.get_noise() for channel in self._channels
+                      if channel.is_ok() and not channel.excluded and channel.value is not None]
+        noise_channel = None
+        noise_fused = None
+        if noises and None not in noises and 0.0 not in noises:
+            noise_channel = sum(noises) / len(noises)
+            if self._fusion == PressureSensor.FUSION_MEDIAN and len(noises) >= 3:
+                # variance of the median of n normal readings, exact for 3
+                factor = 0.4487 if len(noises) == 3 else math.pi / (2 * len(noises))
+                noise_fused = noise_channel * math.sqrt(factor)
+            else:
+                noise_fused = 1.0 / math.sqrt(sum(1.0 / (noise * noise) for noise in noises))
+        return {
+            'fusion' : self._fusion,
+            'disagreement_max' : self._disagreement_max,
+            'channels' : channels,
+            'noise_channel' : noise_channel,
+            'noise_fused' : noise_fused,
+            'noise_reduction' : noise_channel / noise_fused if noise_fused else None
+        }
+
+
+    def _calibration_start(self):
         self._logger.info('Getting pressure zero point...')
-        samples = []
-        for i in range(0, sample_count):
-            sample = self._read()
-            if sample is not None:
-                samples.append(sample)
-                self._logger.debug(f'sample {i} = {sample}')
-            sleep(wait_between_samples)
-        
-        zero_point = fmean(samples)
-        self._logger.info(f'New zero point is  {zero_point}')
+        self._calibration = SetpointCalibration(stderr_max=self._calibration_stderr,
+                                                samples_max=self._calibration_samples_max)
+
+
+    def _calibration_add_sample(self, sample: float):
+        if not self._calibration.add_sample(sample):
+            return
+
+        zero_point = self._calibration.get_setpoint()
+        stderr = self._calibration.get_stderr()
+        sample_count = self._calibration.get_sample_count()
+        if self._calibration.is_converged():
+            self._logger.info(f'New zero point is {zero_point} (stderr={stderr:.4f}, samples={sample_count})')
+        else:
+            self._logger.warning(f'Zero point did not converge, using {zero_point} (stderr={stderr:.4f}, samples={sample_count})')
         self._control_data.set_pressure_setpoint(zero_point)
+        self._control_data.event_set_setpoint.clear()
+        self._calibration = None
+        if self._setpoint_store is not None:
+            self._setpoint_store.save(zero_point)
+
+
+    def _is_active(self, pressure: float) -> bool:
+        control_data = self._control_data
+        if pressure is not None and (self._pressure_idle is None
+                                     or abs(pressure - self._pressure_idle) > self._idle_pressure_delta):
+            self._pressure_idle = pressure
+            return True
+        return (control_data.event_session_on.is_set()
+                or control_data.event_set_setpoint.is_set()
+                or control_data.event_pump_state_on.is_set()
+                or self._calibration is not None
+                or self._stale)
+
+
+    def _update_activity(self, pressure: float):
+        now = self._clock.monotonic()
+        # while idle, a set event_active was set by notify_activity
+        if self._is_active(pressure) or (self._idle and self._control_data.event_active.is_set()):
+            self._time_active = now
+            if self._idle:
+                self._logger.info('Activity -> sampling at full rate')
+                self._idle = False
+            self._control_data.event_active.set()
+        elif not self._idle and now - self._time_active >= self._idle_delay:
+            self._logger.info(f'Idle for {self._idle_delay}s -> sampling every {self._idle_cycle_time}s')
+            self._idle = True
+            self._control_data.event_active.clear()
+
+
+    def step(self):
+        # calibration runs alongside the normal acquisition
+        if self._control_data.event_set_setpoint.is_set() and self._calibration is None:
+            self._calibration_start()
+        pressure = self._read()
+        if pressure is not None and self._calibration is not None:
+            self._calibration_add_sample(pressure)
+        if self._idle_delay > 0:
+            self._update_activity(pressure)
 
 
     def run(self):
         try:
             while self._control_data.event_run.is_set():
-                if self._control_data.event_set_setpoint.is_set():
-                    self._set_setpoint()
-                    self._control_data.event_set_setpoint.clear()
+                self.step()
+                if self._control_data.event_active.is_set():
+                    self._control_data.heartbeat(self.__class__.__name__, self._cycle_time)
+                    self._clock.wait(self._control_data.event_stop, self._cycle_time)
                 else:
-                    self._read()
-                    sleep(self._cycle_time)
+                    self._control_data.heartbeat(self.__class__.__name__, self._idle_cycle_time)
+                    self._clock.wait(self._control_data.event_active, self._idle_cycle_time)
             self._logger.info('run event is FALSE -> Exiting')
         except KeyboardInterrupt:
             self._logger.info('Program stopped by user through keyboard interrupt.')
-            self._control_data.event_run.clear()
+            self._control_data.stop()
         finally:
-            self._bus.close()
\ No newline at end of file
+            self._bus_close()
\ No newline at end of file
@@ -0,0 +1,118 @@
+import logging
+import os
+import pmpctrl.logging_config
+import sys
+import threading
+
+from pmpctrl.clock import Clock
+from pmpctrl.control_data import ControlData
+from threading import Lock
+from threading import Thread
+from time import thread_time
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads of the process every `interval`
+    seconds from a thread of its own, for profiling the running service
+    without a debugger.
+
+    `start` returns right away, the profile is collected in the background
+    and fetched with `get_result` once it is done. The stacks are
+    aggregated per thread in the collapsed format of flamegraph.pl and
+    speedscope, one `thread;outer;...;inner count` line per stack. The
+    sampling thread only reads the frames, it never stops the sampled
+    threads beyond the GIL it holds while copying them.
+    """
+    _logger: logging.Logger
+    _control_data: ControlData
+    _clock: Clock
+    _lock: Lock
+    _thread: Thread
+    _stacks: dict
+    _labels: dict
+
+    def __init__(self, control_data: ControlData, interval: float=0.01):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._clock = control_data.get_clock()
+        self._interval = interval
+        self._lock = Lock()
+        self._thread = None
+        self._stacks = {}
+        self._labels = {}
+        self._seconds = None
+        self._samples = 0
+        self._overhead = None
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f'{os.path.basename(code.co_filename)}:{code.co_qualname}'
+            self._labels[code] = label
+        return label
+
+    def _sample(self, own_ident: int):
+        names = { thread.ident : thread.name for thread in threading.enumerate() }
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f'thread-{ident}'))
+            key = ';'.join(reversed(stack))
+            self._stacks[key] = self._stacks.get(key, 0) + 1
+
+    def _run(self, seconds: float):
+        own_ident = threading.get_ident()
+        time_end = self._clock.monotonic() + seconds
+        time_cpu = thread_time()
+        samples = 0
+        while self._clock.monotonic() < time_end and self._control_data.event_run.is_set():
+            self._sample(own_ident)
+            samples += 1
+            self._clock.wait(self._control_data.event_stop, self._interval)
+        with self._lock:
+            self._samples = samples
+            # CPU time of the sampling thread per second profiled
+            self._overhead = (thread_time() - time_cpu) / seconds
+        self._logger.info(f'Profiled {samples} samples in {seconds}s, overhead {self._overhead * 100:.2f}% of a CPU')
+
+    def start(self, seconds: float) -> bool:
+        """Starts a profile of `seconds`, returns False while one is running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stacks = {}
+            self._seconds = seconds
+            self._samples = 0
+            self._overhead = None
+            self._thread = Thread(target=self._run, args=(seconds,), name='SamplingProfiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def is_running(self) -> bool:
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def get_result(self) -> dict:
+        """Returns the last profile, with `stacks` None while it is running."""
+        running = self.is_running()
+        with self._lock:
+            stacks = None
+            if not running:
+                stacks = ''.join(f'{stack} {count}\n' for stack, count in sorted(self._stacks.items()))
+            return {
+                'running' : running,
+                'seconds' : self._seconds,
+                'interval' : self._interval,
+                'samples' : self._samples,
+                'overhead' : self._overhead,
+                'stacks' : stacks
+            }
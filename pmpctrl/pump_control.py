@@ -1,10 +1,9 @@
 import logging
 import pmpctrl.logging_config
-import RPi.GPIO as GPIO
 
+from pmpctrl.clock import Clock
 from pmpctrl.control_data import ControlData
-from threading import Event
-from time import sleep
+from threading import Lock
 
 
 class PumpControl:
@@ -22,6 +21,9 @@ class PumpControl:
         cycle_time (float, optional):
             The time in seconds between checking for events.
             Defaults to 0.1 seconds.
+        gpio (module, optional):
+            The GPIO module to drive the pin with, e.g. a simulated one.
+            Defaults to RPi.GPIO.
 
     Methods:
         _power_on(): Sets the specified GPIO pin to HIGH, turning the pump on,
@@ -29,33 +31,62 @@ class PumpControl:
         
         _power_off(): Sets the specified GPIO pin to LOW, turning the pump
             off, and updates the control_data events accordingly.
+
+        force_off(cause, timeout): Turns the pump off right away from
+            another thread, used by the Interlock and the Supervisor.
+
+        shutdown(timeout): Turns the pump off for good and releases the
+            pin, called once the loop exited.
         
         run(): The main loop that runs as long as the 'event_run' in
             control_data is set. This method checks for events to turn the
-            pump on or off, adjusts the pump state according to the events,
-            and waits for the given cycle_time before checking again.
-            On KeyboardInterrupt exception, the pump is turned off,
-            the 'event_run' flag is cleared and GPIO resources are cleaned up.
+            pump on or off by calling step(), and waits for the given
+            cycle_time or 'event_stop' before checking again.
+            On KeyboardInterrupt exception, the service is stopped.
     """
     _logger: logging.Logger
     _control_data: ControlData
     _cycle_time: float
     _pin_number: int
+    _clock: Clock
+    _lock: Lock
 
 
     def __init__(self,
                  control_data: ControlData,
                  pin_number: int,
-                 cycle_time: float=0.1):
+                 cycle_time: float=0.1,
+                 gpio=None):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(control_data.get_log_level())
         self._cycle_time = cycle_time
         self._control_data = control_data
         self._pin_number = pin_number
+        self._clock = control_data.get_clock()
+        # a forced turn off must not interleave with a step turning on
+        self._lock = Lock()
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self._gpio = gpio
+
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setup(self._pin_number, self._gpio.OUT)
+        self._gpio.output(self._pin_number, self._gpio.LOW)
+
+
+    def set_log_level(self, log_level: int):
+        """
+        Sets the level of the class logger, used for live config reloads.
+        """
+        self._logger.setLevel(log_level)
+
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self._pin_number, GPIO.OUT)
-        GPIO.output(self._pin_number, GPIO.LOW)
+    def set_cycle_time(self, cycle_time: float):
+        """
+        Sets the time in seconds between checking for events, used for live
+        config reloads.
+        """
+        self._cycle_time = cycle_time
 
 
     def _power_on(self):
@@ -67,12 +98,15 @@ class PumpControl:
             - Sets the GPIO output at `_pin_number` to GPIO.HIGH.
             - Sets the `event_pump_state_on` in `_control_data`.
             - Clears the `event_pump_turn_on` in `_control_data`.
+            - Records the edge in the actuator journal.
 
         Returns:
             None
         """
-        self._logger.debug(f'setting pin {self._pin_number} to HIGH')
-        GPIO.output(self._pin_number, GPIO.HIGH)
+        self._logger.debug('setting pin %s to HIGH', self._pin_number)
+        self._gpio.output(self._pin_number, self._gpio.HIGH)
+        if not self._control_data.event_pump_state_on.is_set():
+            self._control_data.add_actuator_edge(ControlData.ACTUATOR_PUMP, True)
         self._control_data.event_pump_state_on.set()
         self._control_data.event_pump_turn_on.clear()
 
@@ -86,50 +120,127 @@ class PumpControl:
             - Sets the GPIO output at `_pin_number` to GPIO.LOW.
             - Clears the `event_pump_state_on` in `_control_data`.
             - Clears the `event_pump_turn_off` in `_control_data`.
+            - Records the edge in the actuator journal.
 
         Returns:
             None
         """
-        self._logger.debug(f'setting pin {self._pin_number} to LOW')
-        GPIO.output(self._pin_number, GPIO.LOW)
+        self._logger.debug('setting pin %s to LOW', self._pin_number)
+        self._gpio.output(self._pin_number, self._gpio.LOW)
+        if self._control_data.event_pump_state_on.is_set():
+            self._control_data.add_actuator_edge(ControlData.ACTUATOR_PUMP, False)
         self._control_data.event_pump_state_on.clear()
         self._control_data.event_pump_turn_off.clear()
 
 
-    def run(self):
+    def force_off(self, cause: int, timeout: float=0.1):
         """
-        The main loop that runs until the `event_run` in `_control_data` is
-        cleared.
+        Turns the pump off right away, called from the thread of the
+        Interlock or the Supervisor instead of waiting for the next step.
+
+        Parameters:
+            cause (int): The cause recorded in the actuator journal.
+            timeout (float): Seconds to wait for a step in progress. A loop
+                stuck within its step does not block the caller, the pin
+                is then driven LOW regardless and the step in progress
+                turns the pump off once it returns.
+
+        Returns:
+            None
+        """
+        self._control_data.request_pump_off(cause)
+        if not self._lock.acquire(timeout=timeout):
+            self._logger.error('Pump loop is stuck within a step -> setting pin LOW regardless')
+            self._gpio.output(self._pin_number, self._gpio.LOW)
+            return
+        try:
+            self._power_off()
+        finally:
+            self._lock.release()
+
 
-        This method continuously monitors the following events:
+    def shutdown(self, timeout: float=1.0):
+        """
+        Turns the pump off for good and releases the pin, called by the
+        shutdown of the service once the loop exited, before the valve is
+        made safe.
+
+        Parameters:
+            timeout (float): Seconds to wait for a step in progress. A loop
+                stuck within its step does not keep the pump on, the pin
+                is then driven LOW regardless.
+
+        Returns:
+            None
+        """
+        if not self._lock.acquire(timeout=timeout):
+            self._logger.error('Pump loop is stuck within a step -> setting pin LOW regardless')
+            self._gpio.output(self._pin_number, self._gpio.LOW)
+            return
+        try:
+            self._control_data.request_pump_off(ControlData.CAUSE_SHUTDOWN)
+            self._power_off()
+            self._gpio.cleanup(self._pin_number)
+        finally:
+            self._lock.release()
+
+
+    def step(self):
+        """
+        Checks the pump events once.
+
+        This method monitors the following events:
             - If `event_pump_turn_on` is set and `event_pump_state_on`
-              is not set, it calls `_power_on()`.
+              is not set, it calls `_power_on()`. While
+              `event_interlock_tripped` is set the request is dropped
+              instead.
             - If `event_pump_turn_off` is set, it calls `_power_off()`.
 
-        Sleeps for the duration specified in `_cycle_time` between each
-        iteration.
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._control_data.event_pump_turn_on.is_set():
+                self._logger.debug('EVENT_PUMP_TURN_ON was set')
+                if self._control_data.event_interlock_tripped.is_set():
+                    self._logger.warning('Interlock is tripped -> ignoring request to turn power ON')
+                    self._control_data.event_pump_turn_on.clear()
+                elif not self._control_data.event_pump_state_on.is_set():
+                    self._logger.debug('EVENT_PUMP_STATE_ON is not set -> turning power ON')
+                    self._power_on()
+            elif self._control_data.event_pump_turn_off.is_set():
+                self._logger.debug('EVENT_PUMP_TURN_OFF is set -> Turning PUMP OFF')
+                self._power_off()
 
-        In case of a `KeyboardInterrupt`, the pump is turned off,
-        the `event_run` flag is cleared, and GPIO resources are cleaned up.
+
+    def run(self):
+        """
+        The main loop that runs until the `event_run` in `_control_data` is
+        cleared.
+
+        Calls `step()` and waits for the duration specified in `_cycle_time`
+        on the clock of `_control_data` between each iteration, woken early
+        by `event_stop`.
+
+        In case of a `KeyboardInterrupt`, the service is stopped. The pump
+        is left to `shutdown()`, so that the shutdown of the service turns
+        it off before anything else. On any other exception the pump is
+        turned off right away, but the pin stays set up for the
+        `Supervisor` to restart the loop.
 
         Returns:
             None
         """
         try:
             while self._control_data.event_run.is_set():
-                if self._control_data.event_pump_turn_on.is_set():
-                    self._logger.debug('EVENT_PUMP_TURN_ON was set')
-                    if not self._control_data.event_pump_state_on.is_set():
-                        self._logger.debug('EVENT_PUMP_STATE_ON is not set -> turning power ON')
-                        self._power_on()
-                elif self._control_data.event_pump_turn_off.is_set():
-                    self._logger.debug('EVENT_PUMP_TURN_OFF is set -> Turning PUMP OFF')
-                    self._power_off()
-                sleep(self._cycle_time)
+                self.step()
+                self._control_data.heartbeat(self.__class__.__name__, self._cycle_time)
+                self._clock.wait(self._control_data.event_stop, self._cycle_time)
             self._logger.info('EVENT_RUN is NOT set -> Exiting')
         except KeyboardInterrupt:
             self._logger.info('Program stopped by user through keyboard interrupt.')
-            self._control_data.event_run.clear()
+            self._control_data.stop()
         finally:
-            self._power_off()
-            GPIO.cleanup(self._pin_number)
\ No newline at end of file
+            if self._control_data.event_run.is_set():
+                # crashed, the Supervisor restarts the loop on the same pin
+                self.force_off(ControlData.CAUSE_FAILSAFE)
\ No newline at end of file
@@ -1,91 +1,220 @@
 import logging
 import pmpctrl.logging_config
 
+from pmpctrl.clock import Clock
 from pmpctrl.control_data import ControlData
-from time import sleep
 
 class SessionControl:
+    """
+    Runs the interval and pulsating modes of a session as a state machine
+    advanced by `step`. Between two steps `run` sleeps on
+    event_session_update of ControlData until the next phase deadline, so
+    waiting costs no CPU: the event is set on changes of the session and
+    the mode and, through the pressure trigger, by the first sample reaching
+    the peak pressure. Only the ramps step the target, every `cycle_time`
+    at most and no finer than the tolerance band.
+
+    In interval mode the target is held for the interval time (WAIT),
+    ramped to the peak pressure over the ramp time (RAMP), held until the
+    pressure reached it (PEAK) and for the dwell time after (DWELL), then
+    ramped back to the target of the session (RETURN). From RAMP to RETURN
+    the target of the session is kept as the base of ControlData, a session
+    resumed from a checkpoint restarts the interval with WAIT from it.
+    """
+    PHASE_IDLE = 0
+    PHASE_INTERVAL_WAIT = 1
+    PHASE_INTERVAL_PEAK = 2
+    PHASE_PULSATING_PUMP = 3
+    PHASE_PULSATING_RELEASE = 4
+    PHASE_INTERVAL_RAMP = 5
+    PHASE_INTERVAL_DWELL = 6
+    PHASE_INTERVAL_RETURN = 7
+
     _logger: logging.Logger
     _control_data: ControlData
     _cycle_time: float
+    _idle_cycle_time: float
+    _clock: Clock
+    _mode_active: int
+    _phase: int
+    _phase_start: float
+    _phase_end: float
+    _base_pressure: float
+    _peak_pressure: float
+    _ramp_step: int
 
-    def __init__(self, control_data: ControlData, cycle_time: float=0.01):
+    def __init__(self, control_data: ControlData, cycle_time: float=0.01, idle_cycle_time: float=0.5):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(control_data.get_log_level())
         self._control_data = control_data
         self._cycle_time = cycle_time
+        # longest sleep between two steps, the period of the heartbeat
+        self._idle_cycle_time = idle_cycle_time
+        self._clock = control_data.get_clock()
+        self._mode_active = None
+        self._phase = self.PHASE_IDLE
+        self._phase_start = None
+        self._phase_end = None
+        self._ramp_step = None
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def set_cycle_time(self, cycle_time: float):
+        self._cycle_time = cycle_time
 
     def _pump_on(self):
+        # PressureControl keeps the pump off while the reading is stale
+        if self._control_data.event_pressure_stale.is_set():
+            return
         if not self._control_data.event_pump_state_on.is_set():
-            self._control_data.event_pump_turn_on.set()
-            self._control_data.event_pump_turn_off.clear()
+            self._control_data.request_pump_on(ControlData.CAUSE_SESSION_CONTROL)
 
     def _pump_off(self):
         if self._control_data.event_pump_state_on.is_set():
-            self._control_data.event_pump_turn_on.clear()
-            self._control_data.event_pump_turn_off.set()
+            self._control_data.request_pump_off(ControlData.CAUSE_SESSION_CONTROL)
 
     def _open_valve(self):
         if self._control_data.event_valve_state_closed.is_set():
-            self._control_data.event_valve_open.set()
-            self._control_data.event_valve_close.clear()
+            self._control_data.request_valve_open(ControlData.CAUSE_SESSION_CONTROL)
 
     def _close_valve(self):
         if not self._control_data.event_valve_state_closed.is_set():
-            self._control_data.event_valve_open.clear()
-            self._control_data.event_valve_close.set()
+            self._control_data.request_valve_close(ControlData.CAUSE_SESSION_CONTROL)
+
+    def _enter_phase(self, phase: int, now: float, duration: float):
+        self._ramp_step = None
+        self._phase = phase
+        self._phase_start = now
+        self._phase_end = now + max(duration, 0.0)
+
+    def _enter_mode(self, mode: int):
+        self._mode_active = mode
+        now = self._clock.monotonic()
+        if mode == ControlData.MODE_INTERVAL:
+            self._enter_phase(self.PHASE_INTERVAL_WAIT, now, self._control_data.get_mode_interval_time())
+        elif mode == ControlData.MODE_PULSATING:
+            self._pump_on()
+            self._enter_phase(self.PHASE_PULSATING_PUMP, now, self._control_data.get_mode_pulsating_pump_time())
+        else:
+            self._phase = self.PHASE_IDLE
+            self._phase_start = None
+            self._phase_end = None
+
+    def _leave_mode(self):
+        if self._phase in (self.PHASE_INTERVAL_RAMP, self.PHASE_INTERVAL_PEAK,
+                           self.PHASE_INTERVAL_DWELL, self.PHASE_INTERVAL_RETURN):
+            # reset to original values, the tolerance of the base may have
+            # been changed by a config reload in the meantime
+            self._control_data.set_pressure_trigger(None)
+            self._control_data.set_pressure_target(self._base_pressure)
+            base = self._control_data.get_pressure_target_base()
+            if base is not None:
+                self._control_data.set_pressure_target_tolerance_plus(base[1])
+            self._control_data.set_pressure_target_base(None)
+        self._phase = self.PHASE_IDLE
+        self._phase_start = None
+        self._phase_end = None
+
+    def _ramp(self, now: float, pressure_from: float, pressure_to: float) -> float:
+        # a step per cycle has PressureControl chase every step, opening the
+        # valve for a cycle each time, so the target steps no finer than the
+        # tolerance band, however often the mode is stepped
+        duration = self._phase_end - self._phase_start
+        band = (self._control_data.get_pressure_target_tolerance_minus()
+                + self._control_data.get_pressure_target_tolerance_plus())
+        rate = abs(pressure_to - pressure_from) / duration
+        period = max(self._cycle_time, band / rate) if rate > 0 else self._cycle_time
+        elapsed = now - self._phase_start
+        ramp_step = int(elapsed / period)
+        if ramp_step != self._ramp_step:
+            self._ramp_step = ramp_step
+            fraction = min(ramp_step * period / duration, 1.0)
+            self._control_data.set_pressure_target(pressure_from + (pressure_to - pressure_from) * fraction)
+        return min((ramp_step + 1) * period - elapsed, self._phase_end - now)
+
+    def _step_interval(self, now: float) -> float:
+        if self._phase == self.PHASE_INTERVAL_WAIT:
+            if now < self._phase_end:
+                return self._phase_end - now
+            # changes of the target while waiting make the new base
+            self._base_pressure = self._control_data.get_pressure_target()
+            self._peak_pressure = self._control_data.get_mode_interval_peak_pressure()
+            # checkpointed, a resumed session starts over from the base
+            self._control_data.set_pressure_target_base((self._base_pressure,
+                                                         self._control_data.get_pressure_target_tolerance_plus()))
+            self._control_data.set_pressure_target_tolerance_plus(0)
+            self._enter_phase(self.PHASE_INTERVAL_RAMP, now, self._control_data.get_mode_interval_ramp_time())
+        if self._phase == self.PHASE_INTERVAL_RAMP:
+            if now < self._phase_end:
+                return self._ramp(now, self._base_pressure, self._peak_pressure)
+            self._control_data.set_pressure_target(self._peak_pressure)
+            # armed before the check, a sample in between sets the event
+            self._control_data.set_pressure_trigger(self._peak_pressure)
+            self._phase = self.PHASE_INTERVAL_PEAK
+            self._phase_end = None
+        if self._phase == self.PHASE_INTERVAL_PEAK:
+            if self._control_data.get_pressure_actual() > self._peak_pressure:
+                return None
+            self._control_data.set_pressure_trigger(None)
+            self._enter_phase(self.PHASE_INTERVAL_DWELL, now, self._control_data.get_mode_interval_dwell_time())
+        if self._phase == self.PHASE_INTERVAL_DWELL:
+            if now < self._phase_end:
+                return self._phase_end - now
+            # the band of the session back first, a zero tolerance above the
+            # rising target would toggle pump and valve on every step
+            base = self._control_data.get_pressure_target_base()
+            if base is not None:
+                self._control_data.set_pressure_target_tolerance_plus(base[1])
+            self._enter_phase(self.PHASE_INTERVAL_RETURN, now, self._control_data.get_mode_interval_ramp_time())
+        if now < self._phase_end:
+            return self._ramp(now, self._peak_pressure, self._base_pressure)
+        self._leave_mode()
+        self._enter_mode(ControlData.MODE_INTERVAL)
+        return self._phase_end - now
+
+    def _step_pulsating(self, now: float) -> float:
+        if now >= self._phase_end:
+            if self._phase == self.PHASE_PULSATING_PUMP:
+                self._open_valve()
+                self._enter_phase(self.PHASE_PULSATING_RELEASE, now,
+                                  self._control_data.get_mode_pulsating_release_time())
+            else:
+                self._close_valve()
+                self._enter_mode(ControlData.MODE_PULSATING)
+        return self._phase_end - now
+
+    def step(self) -> float:
+        """
+        Advances the interval and pulsating modes. Phase ends are deadlines
+        on the clock of ControlData. Returns the seconds until the next
+        deadline, None if only event_session_update can advance the mode.
+        """
+        mode = None
+        if self._control_data.event_session_on.is_set():
+            mode = self._control_data.get_mode()
+        if mode != self._mode_active:
+            self._leave_mode()
+            self._enter_mode(mode)
+        if mode == ControlData.MODE_INTERVAL:
+            return self._step_interval(self._clock.monotonic())
+        elif mode == ControlData.MODE_PULSATING:
+            return self._step_pulsating(self._clock.monotonic())
+        return None
 
     def run(self):
         try:
             while self._control_data.event_run.is_set():
-                if self._control_data.event_session_on.is_set():
-                    mode = self._control_data.get_mode()
-                    # MODE_PRESSURE_HOLD
-                    if mode == ControlData.MODE_PRESSURE_HOLD:
-                        pass
-                    # MODE_INTERVAL
-                    elif mode == ControlData.MODE_INTERVAL:
-                        interval = self._control_data.get_mode_interval_time()
-                        base_pressure = self._control_data.get_pressure_target()
-                        tolerance_plus = self._control_data.get_pressure_target_tolerance_plus()
-                        while self._control_data.event_session_on.is_set() and self._control_data.get_mode() == ControlData.MODE_INTERVAL:
-                            if interval >= 0:
-                                sleep(self._cycle_time)
-                                interval -= self._cycle_time
-                                if base_pressure != self._control_data.get_pressure_target():
-                                    base_pressure = self._control_data.get_pressure_target()
-                                continue
-                            else:
-                                peak_target = self._control_data.get_mode_interval_peak_pressure()
-                                self._control_data.set_pressure_target(peak_target)
-                                self._control_data.set_pressure_target_tolerance_plus(0)
-                                if self._control_data.get_pressure_actual() <= peak_target:
-                                    break
-                        # reset to original values
-                        self._control_data.set_pressure_target(base_pressure)
-                        self._control_data.set_pressure_target_tolerance_plus(tolerance_plus)
-                    # MODE_PULSATING
-                    elif mode == ControlData.MODE_PULSATING:
-                        if not self._control_data.event_pump_state_on.is_set():
-                            self._pump_on()
-                        pump_time = self._control_data.get_mode_pulsating_pump_time()
-                        release_time = self._control_data.get_mode_pulsating_release_time()
-                        while self._control_data.event_session_on.is_set() and self._control_data.get_mode() == ControlData.MODE_PULSATING:
-                            if pump_time >= 0:
-                                sleep(self._cycle_time)
-                                pump_time -= self._cycle_time
-                                continue
-                            else:
-                                self._open_valve()
-                                if release_time >= 0:
-                                    sleep(self._cycle_time)
-                                    release_time -= self._cycle_time
-                                    continue
-                                self._close_valve()
-                                break
-                    sleep(self._cycle_time)
-                
+                # cleared before the step, no update during it is lost
+                self._control_data.event_session_update.clear()
+                timeout = self.step()
+                if timeout is None or timeout > self._idle_cycle_time:
+                    timeout = self._idle_cycle_time
+                self._control_data.heartbeat(self.__class__.__name__, timeout)
+                self._clock.wait(self._control_data.event_session_update, timeout)
             self._logger.info('run event is FALSE -> Exiting')
         except KeyboardInterrupt:
             self._logger.info('Program stopped by user through keyboard interrupt.')
-            self._control_data.event_run.clear()
\ No newline at end of file
+            self._control_data.stop()
+        finally:
+            self._leave_mode()
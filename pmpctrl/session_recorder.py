@@ -1,30 +1,408 @@
+import csv
+import io
+import json
 import logging
+import os
 import pmpctrl.logging_config
-import pandas as pd
-import datetime
 
+from array import array
 from pmpctrl.control_data import ControlData
-from time import sleep
+from threading import Lock
+
+class SessionRecorder:
+    """
+    Records every pressure sample of a session together with the target,
+    tolerances and actuator states into one binary file per column in
+    `directory`/<session id>/. The files are plain arrays of native machine
+    values, so the analysis reads them with numpy.fromfile without
+    parsing. The session parameters are stored in session.json.
+    """
+    # column name, array typecode and the matching numpy dtype
+    COLUMNS = (('time_ns', 'q', 'int64'),
+               ('pressure', 'd', 'float64'),
+               ('target', 'd', 'float64'),
+               ('tolerance_plus', 'f', 'float32'),
+               ('tolerance_minus', 'f', 'float32'),
+               ('pump', 'B', 'uint8'),
+               ('valve', 'B', 'uint8'))
+    FLUSH_SAMPLES = 100
+    EXPORT_BLOCK_SAMPLES = 16384
 
-class SessionRecoder:
     _logger: logging.Logger
+    _control_data: ControlData
     _cycle_time: float
+    _directory: str
+    _lock: Lock
+    _sequence: int
+    _session_id: int
+    _buffers: dict
+    _statistics_cache: dict
 
-    def __init__(self, control_data: ControlData, cycle_time=1.0):
+    def __init__(self, control_data: ControlData, directory: str, cycle_time: float=0.5):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(control_data.get_log_level())
         self._control_data = control_data
         self._cycle_time = cycle_time
-        
-        self._session_data = []
-        self._column_names = ['timestamp', 'pressure_mbar', 'setpoint_mbar', 'pressure_target_mbar']
+        self._directory = directory
+        self._lock = Lock()
+        self._sequence = 0
+        self._session_id = None
+        self._buffers = None
+        self._statistics_cache = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def set_cycle_time(self, cycle_time: float):
+        self._cycle_time = cycle_time
+
+    def _session_path(self, session_id: int) -> str:
+        return os.path.join(self._directory, str(session_id))
+
+    def _open(self, session_id: int):
+        path = self._session_path(session_id)
+        os.makedirs(path, exist_ok=True)
+        control_data = self._control_data
+        time_utc_session_start = control_data.get_time_utc_session_start()
+        session = {
+            'session_id' : session_id,
+            'mode' : control_data.get_mode(),
+            'time_utc_session_start' : time_utc_session_start.isoformat() if time_utc_session_start else None,
+            'setpoint' : control_data.get_pressure_setpoint(),
+            'mode_interval_peak_pressure' : control_data.get_mode_interval_peak_pressure(),
+            'mode_interval_time' : control_data.get_mode_interval_time(),
+            'mode_interval_dwell_time' : control_data.get_mode_interval_dwell_time(),
+            'mode_interval_ramp_time' : control_data.get_mode_interval_ramp_time(),
+            'mode_pulsating_pump_time' : control_data.get_mode_pulsating_pump_time(),
+            'mode_pulsating_release_time' : control_data.get_mode_pulsating_release_time(),
+        }
+        with open(os.path.join(path, 'session.json'), 'w') as f:
+            json.dump(session, f)
+        with self._lock:
+            self._session_id = session_id
+            self._buffers = { name : array(typecode) for name, typecode, _ in self.COLUMNS }
+        self._logger.info(f'recording session {session_id} to {path}')
+
+    def _flush(self):
+        path = self._session_path(self._session_id)
+        for name, _, _ in self.COLUMNS:
+            buffer = self._buffers[name]
+            try:
+                with open(os.path.join(path, f'{name}.bin'), 'ab') as f:
+                    buffer.tofile(f)
+            except OSError as e:
+                self._logger.error(f'Could not write column {name} of session {self._session_id}: {e}')
+            del buffer[:]
+
+    def _close(self):
+        self._flush()
+        with self._lock:
+            self._session_id = None
+            self._buffers = None
+
+    def _append(self, sample):
+        control_data = self._control_data
+        buffers = self._buffers
+        buffers['time_ns'].append(sample.time_ns)
+        buffers['pressure'].append(sample.value)
+        buffers['target'].append(control_data.get_pressure_target())
+        buffers['tolerance_plus'].append(control_data.get_pressure_target_tolerance_plus())
+        buffers['tolerance_minus'].append(control_data.get_pressure_target_tolerance_minus())
+        buffers['pump'].append(control_data.event_pump_state_on.is_set())
+        buffers['valve'].append(not control_data.event_valve_state_closed.is_set())
+        if len(buffers['time_ns']) >= self.FLUSH_SAMPLES:
+            self._flush()
+
+    def step(self, timeout: float=0.0):
+        """
+        Records the next sample, waiting up to `timeout` seconds for it.
+        """
+        sample = self._control_data.wait_for_sample(self._sequence, timeout=timeout)
+        if sample is not None:
+            self._sequence = sample.sequence
+        session_id = None
+        if self._control_data.event_session_on.is_set():
+            session_id = self._control_data.get_session_id()
+        if self._session_id is not None and self._session_id != session_id:
+            self._close()
+        if session_id is not None and self._session_id is None:
+            self._open(session_id)
+        if sample is not None and self._session_id is not None:
+            self._append(sample)
 
     def run(self) -> None:
-        while self._control_data.event_run.is_set():
-            while self._control_data.event_session_on.is_set():
-                timestamp = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat()
-                pressure = self._control_data.get_pressure_actual()
-                setpoint = self._control_data.get_pressure_setpoint()
-                pressure_target = self._control_data.get_pressure_target()
-                self._session_data.append([timestamp, pressure, setpoint, pressure_target])
-        self._logger.info('run event and session is FALSE -> Exiting')
\ No newline at end of file
+        try:
+            while self._control_data.event_run.is_set():
+                self._control_data.heartbeat(self.__class__.__name__, self._cycle_time)
+                self.step(timeout=self._cycle_time)
+            self._logger.info('run event is FALSE -> Exiting')
+        except KeyboardInterrupt:
+            self._logger.info('Program stopped by user through keyboard interrupt.')
+            self._control_data.stop()
+        finally:
+            if self._session_id is not None:
+                self._close()
+
+    def get_session_ids(self) -> list:
+        return sorted(int(name) for name in os.listdir(self._directory) if name.isdigit())
+
+    def get_session_columns(self, session_id: int) -> dict:
+        """
+        Returns the recorded columns of a session as numpy arrays, None if
+        the session was not recorded. Samples still buffered for a running
+        session are not included.
+        """
+        import numpy as np
+
+        path = self._session_path(session_id)
+        if not os.path.isdir(path):
+            return None
+        columns = {}
+        for name, _, dtype in self.COLUMNS:
+            file_name = os.path.join(path, f'{name}.bin')
+            columns[name] = np.fromfile(file_name, dtype=dtype) if os.path.exists(file_name) else np.empty(0, dtype=dtype)
+        # a column may be ahead of the others after a crash while flushing
+        length = min(len(column) for column in columns.values())
+        return { name : column[:length] for name, column in columns.items() }
+
+    def get_session_length(self, session_id: int) -> int:
+        """
+        Returns the number of samples on disk for a session, None if the
+        session was not recorded.
+        """
+        path = self._session_path(session_id)
+        if not os.path.isdir(path):
+            return None
+        length = None
+        for name, typecode, _ in self.COLUMNS:
+            file_name = os.path.join(path, f'{name}.bin')
+            size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+            count = size // array(typecode).itemsize
+            length = count if length is None else min(length, count)
+        return length
+
+    def iter_session_blocks(self, session_id: int, length: int, block_samples: int=EXPORT_BLOCK_SAMPLES):
+        """
+        Yields the first `length` samples of a session as dicts of numpy
+        column arrays of at most `block_samples` samples each.
+        """
+        import numpy as np
+
+        # the files are created by the first flush, until then the length
+        # of get_session_length is 0
+        if length <= 0:
+            return
+        path = self._session_path(session_id)
+        files = {}
+        try:
+            for name, _, _ in self.COLUMNS:
+                files[name] = open(os.path.join(path, f'{name}.bin'), 'rb')
+            position = 0
+            while position < length:
+                count = min(block_samples, length - position)
+                yield { name : np.fromfile(files[name], dtype=dtype, count=count) for name, _, dtype in self.COLUMNS }
+                position += count
+        finally:
+            for f in files.values():
+                f.close()
+
+    def export_csv(self, session_id: int, length: int):
+        """Yields the session as CSV, one encoded chunk per block."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(name for name, _, _ in self.COLUMNS)
+        yield buffer.getvalue().encode()
+        for block in self.iter_session_blocks(session_id, length):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(zip(*(block[name].tolist() for name, _, _ in self.COLUMNS)))
+            yield buffer.getvalue().encode()
+
+    def export_parquet(self, session_id: int, length: int):
+        """
+        Yields the session as Parquet, one row group per block. Requires
+        pyarrow, the bytes of each row group are handed out as soon as it is
+        written.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        sink = _ChunkSink()
+        schema = pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, _, dtype in self.COLUMNS])
+        with pq.ParquetWriter(sink, schema) as writer:
+            for block in self.iter_session_blocks(session_id, length):
+                writer.write_table(pa.table(block, schema=schema))
+                yield sink.drain()
+        yield sink.drain()
+
+    def get_session_parameters(self, session_id: int) -> dict:
+        try:
+            with open(os.path.join(self._session_path(session_id), 'session.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_session_dataframe(self, session_id: int):
+        # pandas is heavy to import, only pull it in when analytics are requested
+        import pandas as pd
+        columns = self.get_session_columns(session_id)
+        if columns is None:
+            return None
+        return pd.DataFrame(columns)
+
+    def get_session_statistics(self, session_id: int) -> dict:
+        """
+        Computes the statistics of a recorded session, see `analyse`. The
+        result of a finished session is cached.
+        """
+        # asked through ControlData, the recorder may run in another process
+        recording = (self._control_data.event_session_on.is_set()
+                     and self._control_data.get_session_id() == session_id)
+        with self._lock:
+            statistics = self._statistics_cache.get(session_id)
+        if statistics is not None:
+            return statistics
+        columns = self.get_session_columns(session_id)
+        if columns is None:
+            return None
+        statistics = self.analyse(columns, self.get_session_parameters(session_id))
+        statistics['session_id'] = session_id
+        statistics['running'] = recording
+        if not recording:
+            with self._lock:
+                self._statistics_cache[session_id] = statistics
+        return statistics
+
+    @staticmethod
+    def analyse(columns: dict, parameters: dict) -> dict:
+        """
+        Statistics of the recorded columns of a session, every pass is a
+        vectorized numpy operation over all samples:
+            - time within the tolerance band and the largest excursion
+              above and below it
+            - settling time into the band after the session start and after
+              every interval peak, from the end of the ramp raising the
+              target back to the base target
+            - pressure drop rate while only the pump runs and rise rate
+              while the valve is open
+            - pulse fidelity, the actual pump and release phase durations
+              against the configured ones, and the pressure swing per pulse
+        Durations are time weighted with the interval to the next sample.
+        """
+        import numpy as np
+
+        time = columns['time_ns'].astype(np.float64) / 1e9
+        count = len(time)
+        statistics = { 'samples' : count }
+        if count < 2:
+            return statistics
+
+        pressure = columns['pressure']
+        target = columns['target']
+        pump = columns['pump'].astype(bool)
+        valve = columns['valve'].astype(bool)
+        lower = target - columns['tolerance_minus']
+        upper = target + columns['tolerance_plus']
+        dt = np.diff(time)
+        dp = np.diff(pressure)
+        duration = time[-1] - time[0]
+
+        statistics['duration'] = float(duration)
+        statistics['pressure'] = {
+            'min' : float(pressure.min()),
+            'max' : float(pressure.max()),
+            'mean' : float(np.average(pressure[:-1], weights=dt)) if duration > 0 else float(pressure.mean()),
+            'std' : float(pressure.std()),
+        }
+
+        # tolerance band
+        in_band = (pressure >= lower) & (pressure <= upper)
+        statistics['band'] = {
+            'time_in_band' : float(dt[in_band[:-1]].sum()),
+            'fraction_in_band' : float(dt[in_band[:-1]].sum() / duration) if duration > 0 else None,
+            'overshoot_below' : float(np.maximum(lower - pressure, 0).max()),
+            'overshoot_above' : float(np.maximum(pressure - upper, 0).max()),
+        }
+
+        # settling, from the start and from every return to a higher target:
+        # a ramp raises the target in steps, the last rise before the next
+        # fall or the end of the session ends the return
+        in_band_index = np.flatnonzero(in_band)
+        changes = np.flatnonzero(np.diff(target))
+        direction = np.sign(np.diff(target)[changes])
+        returned = (direction > 0) & (np.append(direction[1:], -1) < 0)
+        starts = np.concatenate(([0], changes[returned] + 1))
+        position = np.searchsorted(in_band_index, starts)
+        settled = position < len(in_band_index)
+        settling = time[in_band_index[position[settled]]] - time[starts[settled]]
+        statistics['settling'] = {
+            'initial' : float(settling[0]) if settled[0] else None,
+            'after_peak' : [float(value) for value in settling[1:]],
+            'after_peak_mean' : float(settling[1:].mean()) if len(settling) > 1 else None,
+            'after_peak_max' : float(settling[1:].max()) if len(settling) > 1 else None,
+            'unsettled' : int((~settled).sum()),
+        }
+
+        # rates
+        pumping = pump[:-1] & ~valve[:-1]
+        venting = valve[:-1]
+        statistics['rates'] = {
+            'pressure_drop_rate' : float(-dp[pumping].sum() / dt[pumping].sum()) if pumping.any() else None,
+            'pressure_rise_rate' : float(dp[venting].sum() / dt[venting].sum()) if venting.any() else None,
+        }
+
+        # pulses, a pulse runs from one valve opening to the next
+        valve_edges = np.diff(valve.astype(np.int8))
+        opens = np.flatnonzero(valve_edges == 1) + 1
+        closes = np.flatnonzero(valve_edges == -1) + 1
+        if len(opens) and len(closes):
+            closes = closes[closes > opens[0]]
+            release = time[closes] - time[opens[:len(closes)]]
+            pump_phase = time[opens[1:]] - time[closes[:len(opens) - 1]]
+            swing = np.maximum.reduceat(pressure, opens) - np.minimum.reduceat(pressure, opens)
+            pulses = {
+                'count' : int(len(opens)),
+                'release_time_mean' : float(release.mean()) if len(release) else None,
+                'release_time_std' : float(release.std()) if len(release) else None,
+                'pump_time_mean' : float(pump_phase.mean()) if len(pump_phase) else None,
+                'pump_time_std' : float(pump_phase.std()) if len(pump_phase) else None,
+                'pressure_swing_mean' : float(swing[:-1].mean()) if len(swing) > 1 else None,
+            }
+            # the configured phase durations only apply to pulsating sessions
+            if parameters.get('mode') == ControlData.MODE_PULSATING:
+                release_time = parameters.get('mode_pulsating_release_time')
+                pump_time = parameters.get('mode_pulsating_pump_time')
+                if release_time is not None and len(release):
+                    pulses['release_time_error_mean'] = float(np.abs(release - release_time).mean())
+                if pump_time is not None and len(pump_phase):
+                    pulses['pump_time_error_mean'] = float(np.abs(pump_phase - pump_time).mean())
+            statistics['pulses'] = pulses
+        else:
+            statistics['pulses'] = { 'count' : int(len(opens)) }
+
+        return statistics
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting the bytes written since the last drain."""
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,141 @@
+import math
+
+
+class SessionStatistics:
+    """
+    Statistics of the running session accumulated online, every sample and
+    actuator edge updates them in constant time and memory, so that they are
+    available live without storing or scanning the samples.
+
+    The pressure is in band while within the tolerances around the target of
+    the moment, a sample holds until the next one. The deviation is the
+    distance of a sample to its target. The pump duty cycle is the time the
+    pump was on per elapsed time of the session, timed by its edges.
+
+    `get_state` returns the accumulators as a flat tuple in the order of
+    FIELDS, as published in the StateSnapshot, `summarize` turns such a
+    tuple into the statistics at a given time. Times are monotonic ns, -1
+    if none.
+    """
+    FIELDS = ('time_start_ns', 'time_stop_ns', 'pump_on_since_ns',
+              'samples', 'pump_on_count', 'valve_open_count',
+              'pressure_min', 'pressure_max', 'pressure_mean',
+              'deviation_max', 'time_in_band', 'pump_on_time')
+    # no session yet
+    EMPTY = (-1, -1, -1, 0, 0, 0, math.nan, math.nan, math.nan, math.nan, 0.0, 0.0)
+
+    _time_start_ns: int
+    _time_stop_ns: int
+    _pump_on_since_ns: int
+    _samples: int
+    _pump_on_count: int
+    _valve_open_count: int
+    _pressure_min: float
+    _pressure_max: float
+    _pressure_mean: float
+    _deviation_max: float
+    _time_in_band: float
+    _pump_on_time: float
+    _sample_time_ns: int
+    _sample_in_band: bool
+
+    def __init__(self, time_ns: int, pump_on: bool=False):
+        self._time_start_ns = time_ns
+        self._time_stop_ns = -1
+        self._pump_on_since_ns = time_ns if pump_on else -1
+        self._samples = 0
+        self._pump_on_count = 0
+        self._valve_open_count = 0
+        self._pressure_min = math.inf
+        self._pressure_max = -math.inf
+        self._pressure_mean = 0.0
+        self._deviation_max = 0.0
+        self._time_in_band = 0.0
+        self._pump_on_time = 0.0
+        self._sample_time_ns = time_ns
+        self._sample_in_band = False
+
+    def _hold_sample(self, time_ns: int):
+        if self._sample_in_band and time_ns > self._sample_time_ns:
+            self._time_in_band += (time_ns - self._sample_time_ns) / 1e9
+
+    def add_sample(self, time_ns: int, pressure: float, target: float, tolerance_plus: float, tolerance_minus: float):
+        # called with every sample, so comparisons rather than min and max
+        if self._time_stop_ns >= 0:
+            return
+        self._hold_sample(time_ns)
+        self._sample_time_ns = time_ns
+        self._sample_in_band = target - tolerance_minus <= pressure <= target + tolerance_plus
+        self._samples += 1
+        if pressure < self._pressure_min:
+            self._pressure_min = pressure
+        if pressure > self._pressure_max:
+            self._pressure_max = pressure
+        self._pressure_mean += (pressure - self._pressure_mean) / self._samples
+        deviation = abs(pressure - target)
+        if deviation > self._deviation_max:
+            self._deviation_max = deviation
+
+    def set_pump(self, time_ns: int, on: bool):
+        if self._time_stop_ns >= 0:
+            return
+        if on and self._pump_on_since_ns < 0:
+            self._pump_on_count += 1
+            self._pump_on_since_ns = time_ns
+        elif not on and self._pump_on_since_ns >= 0:
+            self._pump_on_time += max(time_ns - self._pump_on_since_ns, 0) / 1e9
+            self._pump_on_since_ns = -1
+
+    def add_valve_open(self):
+        if self._time_stop_ns < 0:
+            self._valve_open_count += 1
+
+    def stop(self, time_ns: int):
+        """Ends the session at `time_ns`, later updates are ignored."""
+        if self._time_stop_ns >= 0:
+            return
+        self._hold_sample(time_ns)
+        self.set_pump(time_ns, False)
+        self._time_stop_ns = time_ns
+
+    def get_state(self) -> tuple:
+        if self._samples == 0:
+            pressure = (math.nan, math.nan, math.nan, math.nan)
+        else:
+            pressure = (self._pressure_min, self._pressure_max, self._pressure_mean, self._deviation_max)
+        return (self._time_start_ns, self._time_stop_ns, self._pump_on_since_ns,
+                self._samples, self._pump_on_count, self._valve_open_count,
+                *pressure, self._time_in_band, self._pump_on_time)
+
+    @staticmethod
+    def summarize(state: tuple, time_ns: int) -> dict:
+        """
+        Returns the statistics of `state` at monotonic `time_ns`, the end of
+        a stopped session, None before the first session.
+        """
+        (time_start_ns, time_stop_ns, pump_on_since_ns,
+         samples, pump_on_count, valve_open_count,
+         pressure_min, pressure_max, pressure_mean,
+         deviation_max, time_in_band, pump_on_time) = state
+        if time_start_ns < 0:
+            return None
+        time_end_ns = time_stop_ns if time_stop_ns >= 0 else time_ns
+        elapsed = max(time_end_ns - time_start_ns, 0) / 1e9
+        if pump_on_since_ns >= 0:
+            pump_on_time += max(time_end_ns - pump_on_since_ns, 0) / 1e9
+        optional = lambda value: None if math.isnan(value) else value
+        return {
+            'running' : time_stop_ns < 0,
+            'elapsed' : elapsed,
+            'samples' : samples,
+            'pressure_min' : optional(pressure_min),
+            'pressure_max' : optional(pressure_max),
+            'pressure_mean' : optional(pressure_mean),
+            'deviation_max' : optional(deviation_max),
+            'time_in_band' : time_in_band,
+            'time_in_band_ratio' : time_in_band / elapsed if elapsed > 0 else None,
+            'pump_on_time' : pump_on_time,
+            'pump_duty_cycle' : pump_on_time / elapsed if elapsed > 0 else None,
+            'pump_on_count' : pump_on_count,
+            'valve_open_count' : valve_open_count
+        }
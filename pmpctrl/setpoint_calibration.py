@@ -0,0 +1,111 @@
+import datetime
+import json
+import logging
+import os
+import pmpctrl.logging_config
+
+from math import sqrt
+
+
+class SetpointCalibration:
+    """
+    Online estimation of the pressure zero point from the live sample stream.
+
+    Samples are accumulated with Welford's algorithm, the calibration is
+    finished as soon as the standard error of the mean falls below
+    `stderr_max` (after at least `samples_min` samples) or `samples_max`
+    samples have been taken.
+    """
+    _samples_min: int
+    _samples_max: int
+    _stderr_max: float
+    _count: int
+    _mean: float
+    _m2: float
+
+    def __init__(self,
+                 stderr_max: float=0.01,
+                 samples_min: int=10,
+                 samples_max: int=1000):
+        self._stderr_max = stderr_max
+        self._samples_min = max(samples_min, 2)
+        self._samples_max = max(samples_max, self._samples_min)
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add_sample(self, sample: float) -> bool:
+        """Adds a sample and returns True once the calibration is finished."""
+        self._count += 1
+        delta = sample - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (sample - self._mean)
+        return self.is_finished()
+
+    def is_converged(self) -> bool:
+        return self._count >= self._samples_min and self.get_stderr() <= self._stderr_max
+
+    def is_finished(self) -> bool:
+        return self.is_converged() or self._count >= self._samples_max
+
+    def get_sample_count(self) -> int:
+        return self._count
+
+    def get_setpoint(self) -> float:
+        return self._mean
+
+    def get_stderr(self) -> float:
+        if self._count < 2:
+            return float('inf')
+        return sqrt(self._m2 / (self._count - 1) / self._count)
+
+
+class SetpointStore:
+    """
+    Persists the last calibrated setpoint and its timestamp, so a restarted
+    service can warm start instead of recalibrating.
+    """
+    _logger: logging.Logger
+    _path: str
+
+    def __init__(self, path: str):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = path
+
+    def save(self, setpoint: float):
+        data = {
+            'setpoint' : setpoint,
+            'time_utc' : datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+        path_tmp = f'{self._path}.tmp'
+        try:
+            with open(path_tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(path_tmp, self._path)
+        except OSError as e:
+            self._logger.warning(f'Could not persist setpoint to {self._path}: {e}')
+
+    def load(self, age_max: float) -> tuple:
+        """
+        Returns (setpoint, time_utc) of the persisted setpoint, or None if
+        there is none or it is older than `age_max` seconds.
+        """
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            setpoint = float(data['setpoint'])
+            time_utc = datetime.datetime.fromisoformat(data['time_utc'])
+            # a timestamp without an offset was written in UTC
+            if time_utc.tzinfo is None:
+                time_utc = time_utc.replace(tzinfo=datetime.timezone.utc)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self._logger.warning(f'Ignoring unreadable setpoint file {self._path}: {e}')
+            return None
+
+        age = (datetime.datetime.now(datetime.timezone.utc) - time_utc).total_seconds()
+        if age > age_max:
+            self._logger.info(f'Persisted setpoint is {age:.0f}s old -> ignoring')
+            return None
+        return setpoint, time_utc
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import errno
+import heapq
+import json
+import pmpctrl.logging_config
+import sys
+
+from math import exp
+from pmpctrl.__main__ import Settings
+from pmpctrl.__main__ import apply_config
+from pmpctrl.__main__ import parse_sensor_channels
+from pmpctrl.__main__ import read_config
+from pmpctrl.auto_setpoint import AutoSetpoint
+from pmpctrl.clock import VirtualClock
+from pmpctrl.control_data import ControlData
+from pmpctrl.interlock import Interlock
+from pmpctrl.pressure_control import PressureControl
+from pmpctrl.pressure_sensor import PressureSensor
+from pmpctrl.pump_control import PumpControl
+from pmpctrl.session_control import SessionControl
+from pmpctrl.session_recorder import SessionRecorder
+from pmpctrl.valve_control import ValveControl
+from random import Random
+from threading import Lock
+from time import monotonic
+from time import perf_counter
+from typing import Callable
+from typing import NamedTuple
+
+
+class SimulatedChamber:
+    """
+    A first order model of the vacuum chamber used in place of the real
+    hardware. The pump draws the pressure towards `pressure_ultimate`, an
+    open valve and leakage vent it towards `pressure_ambient`.
+
+    `open_smbus` and `open_bmp280` can be passed to `PressureSensor` as
+    factories for the SMBus and the BMP280. I2C faults are injected with
+    `inject_fault`: while a fault is active every access fails, and a bus
+    opened before the fault keeps failing until it is reopened.
+    `inject_sensor_fault` fails only the accesses of one sensor, and
+    `set_sensor_offset` makes one sensor read off by a constant.
+    """
+    _lock: Lock
+    _random: Random
+    _time: float
+    _pressure: float
+    _pump_on: bool
+    _valve_open: bool
+    _fault_until: float
+    _bus_generation: int
+    _sensor_faults: dict
+    _sensor_offsets: dict
+
+    def __init__(self,
+                 pressure_ambient: float=962.9274,
+                 pressure_ultimate: float=100.0,
+                 rate_pump: float=0.05,
+                 rate_valve: float=2.0,
+                 rate_leak: float=0.002,
+                 noise: float=0.02,
+                 seed: int=None,
+                 time_func=monotonic):
+        self._lock = Lock()
+        self._random = Random(seed)
+        self._time_func = time_func
+        self.pressure_ambient = pressure_ambient
+        self.pressure_ultimate = pressure_ultimate
+        self.rate_pump = rate_pump
+        self.rate_valve = rate_valve
+        self.rate_leak = rate_leak
+        self.noise = noise
+        self._time = time_func()
+        self._pressure = pressure_ambient
+        self._pump_on = False
+        self._valve_open = False
+        self._fault_until = None
+        self._bus_generation = 0
+        self._sensor_faults = {}
+        self._sensor_offsets = {}
+
+    def _update(self):
+        now = self._time_func()
+        dt = now - self._time
+        self._time = now
+        if dt <= 0:
+            return
+        rate_pump = self.rate_pump if self._pump_on else 0.0
+        rate_vent = self.rate_leak + (self.rate_valve if self._valve_open else 0.0)
+        rate = rate_pump + rate_vent
+        pressure_final = (rate_pump * self.pressure_ultimate + rate_vent * self.pressure_ambient) / rate
+        self._pressure = pressure_final + (self._pressure - pressure_final) * exp(-rate * dt)
+
+    def get_pressure(self) -> float:
+        """Returns the true (noise free) chamber pressure."""
+        with self._lock:
+            self._update()
+            return self._pressure
+
+    def read_pressure(self, bus_nr: int=None, i2c_addr: int=None) -> float:
+        """Returns the chamber pressure as seen by a sensor."""
+        with self._lock:
+            self._update()
+            offset = self._sensor_offsets.get((bus_nr, i2c_addr), 0.0)
+            return self._pressure + offset + self._random.gauss(0.0, self.noise)
+
+    def set_pump(self, on: bool):
+        with self._lock:
+            self._update()
+            self._pump_on = on
+
+    def set_valve(self, open: bool):
+        with self._lock:
+            self._update()
+            self._valve_open = open
+
+    def get_pump(self) -> bool:
+        with self._lock:
+            return self._pump_on
+
+    def get_valve(self) -> bool:
+        with self._lock:
+            return self._valve_open
+
+    # I2C fault injection
+    def inject_fault(self, duration: float):
+        with self._lock:
+            self._fault_until = self._time_func() + duration
+            self._bus_generation += 1
+
+    def is_fault_active(self) -> bool:
+        with self._lock:
+            return self._fault_until is not None and self._time_func() < self._fault_until
+
+    def get_bus_generation(self) -> int:
+        with self._lock:
+            return self._bus_generation
+
+    def inject_sensor_fault(self, bus_nr: int, i2c_addr: int, duration: float):
+        with self._lock:
+            self._sensor_faults[(bus_nr, i2c_addr)] = self._time_func() + duration
+
+    def is_sensor_fault_active(self, bus_nr: int, i2c_addr: int) -> bool:
+        with self._lock:
+            fault_until = self._sensor_faults.get((bus_nr, i2c_addr))
+            return fault_until is not None and self._time_func() < fault_until
+
+    def set_sensor_offset(self, bus_nr: int, i2c_addr: int, offset: float):
+        with self._lock:
+            self._sensor_offsets[(bus_nr, i2c_addr)] = offset
+
+    def open_smbus(self, bus_nr: int):
+        return SimulatedSMBus(self, bus_nr)
+
+    def open_bmp280(self, i2c_dev, i2c_addr: int=0x76):
+        return SimulatedBMP280(self, i2c_dev, i2c_addr)
+
+
+class SimulatedSMBus:
+    def __init__(self, chamber: SimulatedChamber, bus_nr: int):
+        if chamber.is_fault_active():
+            raise OSError(errno.EREMOTEIO, f'simulated I2C fault opening bus {bus_nr}')
+        self._chamber = chamber
+        self.bus_nr = bus_nr
+        self._generation = chamber.get_bus_generation()
+        self.closed = False
+
+    def check(self):
+        if self.closed:
+            raise OSError(errno.EBADF, 'simulated I2C bus is closed')
+        if self._chamber.is_fault_active() or self._generation != self._chamber.get_bus_generation():
+            raise OSError(errno.EREMOTEIO, 'simulated I2C remote I/O error')
+
+    def close(self):
+        self.closed = True
+
+
+class SimulatedBMP280:
+    def __init__(self, chamber: SimulatedChamber, i2c_dev: SimulatedSMBus, i2c_addr: int=0x76):
+        self._chamber = chamber
+        self._i2c_dev = i2c_dev
+        self._i2c_addr = i2c_addr
+
+    def _check(self):
+        self._i2c_dev.check()
+        if self._chamber.is_sensor_fault_active(self._i2c_dev.bus_nr, self._i2c_addr):
+            raise OSError(errno.EREMOTEIO, f'simulated I2C fault of sensor {self._i2c_addr:#04x}')
+
+    def setup(self, mode: str='normal'):
+        self._check()
+
+    def get_pressure(self) -> float:
+        self._check()
+        return self._chamber.read_pressure(self._i2c_dev.bus_nr, self._i2c_addr)
+
+
+class SimulatedGPIO:
+    """
+    Stand-in for the RPi.GPIO module, passed as `gpio` to PumpControl and
+    ValveControl. Driving the pins switches the pump and the valve of the
+    chamber, rising edges are counted per pin.
+    """
+    BCM = 11
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, chamber: SimulatedChamber, pin_pump: int, pin_valve: int):
+        self._chamber = chamber
+        self._pin_pump = pin_pump
+        self._pin_valve = pin_valve
+        self._levels = {}
+        self.starts = {}
+
+    def setmode(self, mode: int):
+        pass
+
+    def setup(self, pin: int, direction: int):
+        self._levels.setdefault(pin, self.LOW)
+        self.starts.setdefault(pin, 0)
+
+    def output(self, pin: int, level: int):
+        if level and not self._levels.get(pin):
+            self.starts[pin] = self.starts.get(pin, 0) + 1
+        self._levels[pin] = level
+        if pin == self._pin_pump:
+            self._chamber.set_pump(bool(level))
+        elif pin == self._pin_valve:
+            self._chamber.set_valve(bool(level))
+
+    def cleanup(self, pin: int=None):
+        for cleanup_pin in ([pin] if pin is not None else list(self._levels)):
+            self.output(cleanup_pin, self.LOW)
+
+
+class TraceRecord(NamedTuple):
+    time: float
+    pressure: float
+    pressure_actual: float
+    pressure_target: float
+    pump_on: bool
+    valve_open: bool
+    session_on: bool
+
+
+class Simulation:
+    """
+    Deterministic single threaded simulation of the whole control path.
+
+    The workers of the service are created against a SimulatedChamber and
+    a VirtualClock and their `step` methods are called in order of their
+    next due time, each with the cycle time of the settings. Time jumps
+    from one due step to the next, so hours of session behaviour run in
+    seconds, and the same settings and seed give the same trace.
+
+    ControlData is a singleton, so only one simulation can exist per
+    process; creating one resets ControlData.
+    """
+    _clock: VirtualClock
+    _queue: list
+    _order: int
+    _trace: list
+
+    def __init__(self,
+                 settings: Settings=None,
+                 seed: int=0,
+                 trace_interval: float=1.0,
+                 chamber_parameters: dict=None,
+                 recorder_directory: str=None):
+        self.settings = settings if settings is not None else Settings()
+        ControlData.reset()
+        self._clock = VirtualClock()
+        self.control_data = ControlData()
+        self.control_data.set_clock(self._clock)
+        self.control_data.event_run.set()
+        apply_config(self.control_data, self.settings)
+
+        self.chamber = SimulatedChamber(seed=seed,
+                                        time_func=self._clock.monotonic,
+                                        **(chamber_parameters or {}))
+        self.gpio = SimulatedGPIO(self.chamber,
+                                  pin_pump=self.settings.PUMP_CONTROL_PIN_NUMBER,
+                                  pin_valve=self.settings.VALVE_CONTROL_PIN_NUMBER)
+        self.pump_control = PumpControl(control_data=self.control_data,
+                                        pin_number=self.settings.PUMP_CONTROL_PIN_NUMBER,
+                                        cycle_time=self.settings.PUMP_CONTROL_CYCLE_TIME,
+                                        gpio=self.gpio)
+        self.valve_control = ValveControl(control_data=self.control_data,
+                                          pin_number=self.settings.VALVE_CONTROL_PIN_NUMBER,
+                                          cycle_time=self.settings.VALVE_CONTROL_CYCLE_TIME,
+                                          gpio=self.gpio)
+        self.interlock = None
+        if self.settings.INTERLOCK_ENABLED:
+            self.interlock = Interlock(control_data=self.control_data,
+                                       pump_control=self.pump_control,
+                                       valve_control=self.valve_control,
+                                       rate_fall_max=self.settings.INTERLOCK_RATE_FALL_MAX,
+                                       rate_rise_max=self.settings.INTERLOCK_RATE_RISE_MAX,
+                                       rate_window=self.settings.INTERLOCK_RATE_WINDOW,
+                                       pump_on_time_max=self.settings.INTERLOCK_PUMP_ON_TIME_MAX)
+            self.control_data.set_interlock(self.interlock)
+        self.pressure_sensor = PressureSensor(control_data=self.control_data,
+                                              cycle_time=self.settings.PRESSURE_SENSOR_CYCLE_TIME,
+                                              smbus_nr=self.settings.PRESSURE_SENSOR_BUS_NR,
+                                              i2c_addr=self.settings.PRESSURE_SENSOR_I2C_ADR,
+                                              backoff_min=self.settings.PRESSURE_SENSOR_BACKOFF_MIN,
+                                              backoff_max=self.settings.PRESSURE_SENSOR_BACKOFF_MAX,
+                                              smbus_factory=self.chamber.open_smbus,
+                                              bmp280_factory=self.chamber.open_bmp280,
+                                              interlock=self.interlock,
+                                              channels=self.settings.PRESSURE_SENSOR_CHANNELS,
+                                              fusion=self.settings.PRESSURE_SENSOR_FUSION,
+                                              disagreement_max=self.settings.PRESSURE_SENSOR_DISAGREEMENT_MAX,
+                                              idle_delay=self.settings.IDLE_DELAY,
+                                              idle_cycle_time=self.settings.IDLE_CYCLE_TIME,
+                                              idle_pressure_delta=self.settings.IDLE_PRESSURE_DELTA)
+        self.control_data.set_pressure_sensor(self.pressure_sensor)
+        self.pressure_control = PressureControl(control_data=self.control_data,
+                                                cycle_time=self.settings.PRESSURE_CONTROL_CYCLE_TIME)
+        self.session_control = SessionControl(self.control_data)
+        self.auto_setpoint = AutoSetpoint(control_data=self.control_data)
+        self.session_recorder = None
+        if recorder_directory:
+            self.session_recorder = SessionRecorder(control_data=self.control_data,
+                                                    directory=recorder_directory)
+            self.control_data.set_session_recorder(self.session_recorder)
+
+        self._queue = []
+        self._order = 0
+        self._trace = []
+        # consumers of samples follow the sensor within the same instant
+        self.every(self.settings.PRESSURE_SENSOR_CYCLE_TIME, self._step_sensor)
+        self.every(self.settings.PUMP_CONTROL_CYCLE_TIME, self.pump_control.step)
+        self.every(self.settings.VALVE_CONTROL_CYCLE_TIME, self.valve_control.step)
+        self.every(self.session_control._cycle_time, self.session_control.step)
+        if trace_interval:
+            self.every(trace_interval, self._record)
+
+    def _schedule(self, time_ns: int, period_ns: int, action: Callable):
+        heapq.heappush(self._queue, (time_ns, self._order, period_ns, action))
+        self._order += 1
+
+    def _step_sensor(self):
+        self.pressure_sensor.step()
+        self.pressure_control.step()
+        self.auto_setpoint.step()
+        if self.session_recorder is not None:
+            self.session_recorder.step()
+
+    def _record(self):
+        self._trace.append(TraceRecord(time=self._clock.monotonic(),
+                                       pressure=self.chamber.get_pressure(),
+                                       pressure_actual=self.control_data.get_pressure_actual(),
+                                       pressure_target=self.control_data.get_pressure_target(),
+                                       pump_on=self.chamber.get_pump(),
+                                       valve_open=self.chamber.get_valve(),
+                                       session_on=self.control_data.event_session_on.is_set()))
+
+    def get_time(self) -> float:
+        return self._clock.monotonic()
+
+    def get_trace(self) -> list:
+        return self._trace
+
+    def every(self, period: float, action: Callable, start: float=None):
+        """Calls `action()` every `period` seconds of virtual time."""
+        period_ns = max(int(period * 1e9), 1)
+        start_ns = self._clock.monotonic_ns() if start is None else int(start * 1e9)
+        self._schedule(start_ns, period_ns, action)
+
+    def at(self, time: float, action: Callable):
+        """Calls `action()` once at `time` seconds of virtual time."""
+        self._schedule(int(time * 1e9), None, action)
+
+    def run(self, duration: float) -> list:
+        """Runs for `duration` seconds of virtual time, returns the trace."""
+        time_end_ns = self._clock.monotonic_ns() + int(duration * 1e9)
+        while self._queue and self._queue[0][0] <= time_end_ns and self.control_data.event_run.is_set():
+            time_ns, order, period_ns, action = heapq.heappop(self._queue)
+            self._clock.advance_to(time_ns)
+            action()
+            if period_ns is not None:
+                self._schedule(time_ns + period_ns, period_ns, action)
+        self._clock.advance_to(time_end_ns)
+        return self._trace
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Runs a session against a simulated chamber on virtual time.')
+    parser.add_argument('-c', '--config', help='config file, defaults to the built-in settings')
+    parser.add_argument('-m', '--mode', help='session mode', choices=['hold', 'interval', 'pulsating'], default='hold')
+    parser.add_argument('-d', '--duration', help='session duration in seconds', type=float, default=3600.0)
+    parser.add_argument('-s', '--seed', help='seed of the sensor noise', type=int, default=0)
+    parser.add_argument('-t', '--target', help='pressure target', type=float, default=None)
+    parser.add_argument('--trace-interval', help='seconds between trace records', type=float, default=1.0)
+    parser.add_argument('--fault', help='inject an I2C fault at TIME for DURATION seconds', type=float,
+                        nargs=2, metavar=('TIME', 'DURATION'), action='append', default=[])
+    parser.add_argument('--sensor-fault', help='fail only the sensor at BUS:ADDRESS at TIME for DURATION seconds',
+                        nargs=3, metavar=('SENSOR', 'TIME', 'DURATION'), action='append', default=[])
+    parser.add_argument('--sensor-offset', help='offset in mbar of the readings of the sensor at BUS:ADDRESS',
+                        nargs=2, metavar=('SENSOR', 'OFFSET'), action='append', default=[])
+    parser.add_argument('-o', '--output', help='CSV file for the trace, - for stdout')
+    parser.add_argument('-r', '--recorder', help='directory to record the session to')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    settings = read_config(args.config) if args.config else Settings()
+    modes = {
+        'hold' : ControlData.MODE_PRESSURE_HOLD,
+        'interval' : ControlData.MODE_INTERVAL,
+        'pulsating' : ControlData.MODE_PULSATING,
+    }
+
+    simulation = Simulation(settings=settings, seed=args.seed, trace_interval=args.trace_interval,
+                            recorder_directory=args.recorder)
+    control_data = simulation.control_data
+    control_data.set_mode(modes[args.mode])
+    if args.target is not None:
+        control_data.set_pressure_target(args.target)
+    # let the sensor settle before the session starts
+    simulation.at(1.0, control_data.start_session)
+    simulation.at(1.0 + args.duration, control_data.stop_session)
+    for time_fault, duration in args.fault:
+        simulation.at(time_fault, lambda duration=duration: simulation.chamber.inject_fault(duration))
+    for sensor, time_fault, duration in args.sensor_fault:
+        (bus_nr, i2c_addr), = parse_sensor_channels(sensor)
+        simulation.at(float(time_fault),
+                      lambda bus_nr=bus_nr, i2c_addr=i2c_addr, duration=float(duration):
+                          simulation.chamber.inject_sensor_fault(bus_nr, i2c_addr, duration))
+    for sensor, offset in args.sensor_offset:
+        (bus_nr, i2c_addr), = parse_sensor_channels(sensor)
+        simulation.chamber.set_sensor_offset(bus_nr, i2c_addr, float(offset))
+
+    time_start = perf_counter()
+    trace = simulation.run(args.duration + 2.0)
+    time_wall = perf_counter() - time_start
+
+    if args.output:
+        output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+        writer = csv.writer(output)
+        writer.writerow(TraceRecord._fields)
+        writer.writerows(trace)
+        if output is not sys.stdout:
+            output.close()
+
+    summary = {
+        'time_virtual' : simulation.get_time(),
+        'time_wall' : time_wall,
+        'speedup' : simulation.get_time() / time_wall if time_wall > 0 else None,
+        'pump_starts' : simulation.gpio.starts.get(settings.PUMP_CONTROL_PIN_NUMBER, 0),
+        'valve_starts' : simulation.gpio.starts.get(settings.VALVE_CONTROL_PIN_NUMBER, 0),
+        'sensor_recoveries' : control_data.get_sensor_recovery_count(),
+        'sensor' : simulation.pressure_sensor.get_status(),
+    }
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import logging
+import mmap
+import os
+import pmpctrl.logging_config
+import struct
+import zlib
+
+from time import time_ns
+
+
+class StateCheckpoint:
+    """
+    Fixed layout checkpoint of the ControlData state in a memory-mapped
+    file. A write is a single struct pack into the mapping, cheap enough to
+    be done on every state change and every pressure sample. The mapping
+    lives in the page cache, so the last checkpoint survives a crash of
+    the process.
+    """
+    MAGIC = b'PMPC'
+    VERSION = 4
+    # magic, version, wall clock time in ns, session id, mode, session on,
+    # auto setpoint, pressure control, clean shutdown, pressure actual,
+    # setpoint, target,
+    # tolerance plus, tolerance minus, min, max, interval peak pressure,
+    # interval time, dwell time and ramp time, pulsating pump time,
+    # pulsating release time, session start (UTC timestamp, NaN if none),
+    # base target and tolerance plus while an interval overrides them
+    # (NaN if none)
+    LAYOUT = struct.Struct('<4sHxxqIi????16d')
+    CRC = struct.Struct('<I')
+    FIELDS = ('session_id', 'mode', 'session_on', 'auto_setpoint', 'pressure_control', 'shutdown_clean',
+              'pressure_actual', 'pressure_setpoint', 'pressure_target',
+              'pressure_target_tolerance_plus', 'pressure_target_tolerance_minus',
+              'pressure_min', 'pressure_max',
+              'mode_interval_peak_pressure', 'mode_interval_time',
+              'mode_interval_dwell_time', 'mode_interval_ramp_time',
+              'mode_pulsating_pump_time', 'mode_pulsating_release_time',
+              'time_utc_session_start',
+              'pressure_target_base', 'pressure_target_tolerance_plus_base')
+
+    _logger: logging.Logger
+    _path: str
+    _mmap: mmap.mmap
+
+    def __init__(self, path: str):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = path
+        size = self.LAYOUT.size + self.CRC.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def write(self, state: tuple):
+        """Writes the state, a tuple of values in the order of FIELDS."""
+        data = self.LAYOUT.pack(self.MAGIC, self.VERSION, time_ns(), *state)
+        self._mmap[:] = data + self.CRC.pack(zlib.crc32(data))
+
+    def read(self) -> tuple:
+        """
+        Returns (age in seconds, state dict) of the last checkpoint, or None
+        if there is no valid one.
+        """
+        data = self._mmap[:self.LAYOUT.size]
+        crc, = self.CRC.unpack_from(self._mmap, self.LAYOUT.size)
+        values = self.LAYOUT.unpack(data)
+        if values[0] != self.MAGIC:
+            return None
+        if values[1] != self.VERSION or crc != zlib.crc32(data):
+            self._logger.warning(f'Ignoring invalid checkpoint in {self._path}')
+            return None
+        age = (time_ns() - values[2]) / 1e9
+        return age, dict(zip(self.FIELDS, values[3:]))
+
+    def close(self):
+        self._mmap.close()
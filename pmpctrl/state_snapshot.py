@@ -0,0 +1,109 @@
+import logging
+import pmpctrl.logging_config
+import struct
+
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+from pmpctrl.session_statistics import SessionStatistics
+from time import sleep
+
+
+class StateSnapshot:
+    """
+    Fixed layout snapshot of the ControlData state in shared memory, read
+    by API processes without taking any lock of the control process.
+
+    The snapshot is guarded by a sequence counter (seqlock): the writer
+    makes the counter odd, packs the state and makes it even again. A
+    reader copies the state and retries if the counter was odd or changed
+    meanwhile. There must be a single writer at a time, ControlData writes
+    with its lock held.
+    """
+    SEQUENCE = struct.Struct('<Q')
+    # session id, mode, sample sequence, sample time (monotonic ns), sensor
+    # recovery count, log level, session on, auto setpoint, pressure
+    # control, pressure stale, pump on, valve closed, set setpoint, interlock
+    # tripped, pressure actual, setpoint, target, tolerance plus, tolerance
+    # minus, min, max, interval peak pressure, interval time, dwell time and
+    # ramp time, pulsating pump time, pulsating release time, session start
+    # and now (UTC timestamps), last session duration, last and max sensor
+    # recovery time (NaN if none), the accumulators of SessionStatistics
+    LAYOUT = struct.Struct('<IiQqIi????????18dqqqIII6d')
+    FIELDS = ('session_id', 'mode', 'sample_sequence', 'sample_time_ns',
+              'sensor_recovery_count', 'log_level',
+              'session_on', 'auto_setpoint', 'pressure_control', 'pressure_stale',
+              'pump_state_on', 'valve_state_closed', 'set_setpoint', 'interlock_tripped',
+              'pressure_actual', 'pressure_setpoint', 'pressure_target',
+              'pressure_target_tolerance_plus', 'pressure_target_tolerance_minus',
+              'pressure_min', 'pressure_max',
+              'mode_interval_peak_pressure', 'mode_interval_time',
+              'mode_interval_dwell_time', 'mode_interval_ramp_time',
+              'mode_pulsating_pump_time', 'mode_pulsating_release_time',
+              'time_utc_session_start', 'time_utc_now', 'last_session_duration',
+              'sensor_recovery_time_last', 'sensor_recovery_time_max',
+              *(f'statistics_{field}' for field in SessionStatistics.FIELDS))
+    READ_RETRIES = 1000
+
+    _logger: logging.Logger
+    _shm: shared_memory.SharedMemory
+    _owner: bool
+    _sequence: int
+
+    def __init__(self, name: str=None):
+        """Creates a new snapshot, or attaches to the one called `name`."""
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._owner = name is None
+        size = self.SEQUENCE.size + self.LAYOUT.size
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._shm.buf[:size] = bytes(size)
+        else:
+            self._shm = self._attach(name)
+        self._sequence = 0
+
+    @staticmethod
+    def _attach(name: str) -> shared_memory.SharedMemory:
+        # only the creating process may unlink the memory, before Python 3.13
+        # an attaching process registers it for unlinking at its exit
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def write(self, state: tuple):
+        """Writes the state, a tuple of values in the order of FIELDS."""
+        buffer = self._shm.buf
+        self._sequence += 1
+        self.SEQUENCE.pack_into(buffer, 0, self._sequence)
+        self.LAYOUT.pack_into(buffer, self.SEQUENCE.size, *state)
+        self._sequence += 1
+        self.SEQUENCE.pack_into(buffer, 0, self._sequence)
+
+    def read(self) -> dict:
+        """
+        Returns a consistent copy of the state, None before the first write.
+        """
+        buffer = self._shm.buf
+        for attempt in range(self.READ_RETRIES):
+            sequence, = self.SEQUENCE.unpack_from(buffer, 0)
+            if sequence & 1:
+                # a write is in progress, let the writer finish
+                sleep(0)
+                continue
+            values = self.LAYOUT.unpack_from(buffer, self.SEQUENCE.size)
+            if self.SEQUENCE.unpack_from(buffer, 0)[0] == sequence:
+                if sequence == 0:
+                    return None
+                return dict(zip(self.FIELDS, values))
+        raise TimeoutError(f'state snapshot is not consistent after {self.READ_RETRIES} attempts')
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,229 @@
+import logging
+import pmpctrl.logging_config
+import threading
+
+from pmpctrl.clock import Clock
+from pmpctrl.control_data import ControlData
+from pmpctrl.pump_control import PumpControl
+from pmpctrl.valve_control import ValveControl
+from threading import Lock
+from threading import Thread
+from time import monotonic
+
+
+class SupervisedLoop:
+    STATE_OK = 'ok'
+    STATE_STALLED = 'stalled'
+    STATE_CRASHED = 'crashed'
+    STATE_STOPPED = 'stopped'
+
+    def __init__(self, name: str, worker, thread: Thread, critical: bool):
+        self.name = name
+        self.worker = worker
+        self.thread = thread
+        self.critical = critical
+        self.state = SupervisedLoop.STATE_OK
+        self.restarts = 0
+        self.stalls = 0
+        self.error = None
+        self.backoff = None
+        self.time_restart = None
+        self.time_started = None
+
+
+class Supervisor:
+    """
+    Watches the worker loops of the service by their thread and the
+    heartbeat each loop reports to ControlData once per cycle.
+
+    A loop whose thread died while `event_run` is set has crashed, it is
+    restarted after a backoff doubling from `backoff_min` up to
+    `backoff_max` with every crash in a row. A loop that is alive but
+    missed its heartbeat by more than `deadline_periods` of its announced
+    period has stalled. The heartbeats are checked every period of the
+    fastest critical loop, at most every `check_interval`, so a stall is
+    told within `deadline_periods` plus one of the loop's periods. When the
+    supervisor itself wakes that late, the whole process was held up, and
+    the deadlines of all loops start over from then. When a critical loop
+    crashes or stalls, the session is stopped and the pump
+    forced off and the valve open right away from the supervisor thread.
+    """
+    _logger: logging.Logger
+    _control_data: ControlData
+    _clock: Clock
+    _pump_control: PumpControl
+    _valve_control: ValveControl
+    _lock: Lock
+    _loops: dict
+
+    def __init__(self,
+                 control_data: ControlData,
+                 pump_control: PumpControl,
+                 valve_control: ValveControl,
+                 check_interval: float=0.1,
+                 deadline_periods: float=3.0,
+                 backoff_min: float=0.5,
+                 backoff_max: float=30.0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._clock = control_data.get_clock()
+        self._pump_control = pump_control
+        self._valve_control = valve_control
+        self._check_interval = check_interval
+        self._deadline_periods = deadline_periods
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+        self._lock = Lock()
+        self._loops = {}
+        self._errors = {}
+        self._interval = check_interval
+        self._time_check_ns = None
+        self._time_resumed_ns = 0
+        self._excepthook = threading.excepthook
+        # the exception of a crashed loop is only seen by the hook
+        threading.excepthook = self._record_exception
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def _record_exception(self, args):
+        self._logger.error(f'Thread {args.thread.name} crashed: {args.exc_type.__name__}: {args.exc_value}',
+                           exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
+        with self._lock:
+            self._errors[args.thread.name] = f'{args.exc_type.__name__}: {args.exc_value}'
+
+    def add(self, name: str, worker, thread: Thread, critical: bool):
+        """Supervises `worker` running in `thread`, named `name` like its heartbeat."""
+        with self._lock:
+            loop = SupervisedLoop(name, worker, thread, critical)
+            loop.time_started = self._clock.monotonic()
+            self._loops[name] = loop
+
+    def _make_safe(self, loop: SupervisedLoop):
+        self._logger.error(f'Critical loop {loop.name} {loop.state} -> stopping session, pump OFF, valve OPEN')
+        if self._control_data.event_session_on.is_set():
+            self._control_data.stop_session(ControlData.CAUSE_FAILSAFE)
+        # the actuators are driven directly, their loop may be the dead one
+        self._pump_control.force_off(ControlData.CAUSE_FAILSAFE)
+        self._valve_control.force_open(ControlData.CAUSE_FAILSAFE)
+        self._control_data.publish_state()
+
+    def _restart(self, loop: SupervisedLoop, now: float):
+        self._logger.warning(f'Restarting loop {loop.name} (restart {loop.restarts + 1})')
+        loop.thread = Thread(target=loop.worker.run, name=loop.thread.name)
+        loop.thread.start()
+        loop.restarts += 1
+        loop.time_restart = None
+        loop.time_started = now
+        loop.state = SupervisedLoop.STATE_OK
+
+    def _check_loop(self, loop: SupervisedLoop, heartbeats: dict, now: float, now_ns: int):
+        if loop.state == SupervisedLoop.STATE_CRASHED:
+            if now >= loop.time_restart:
+                self._restart(loop, now)
+            return
+        if not loop.thread.is_alive():
+            if not self._control_data.event_run.is_set():
+                loop.state = SupervisedLoop.STATE_STOPPED
+                return
+            loop.state = SupervisedLoop.STATE_CRASHED
+            loop.error = self._errors.pop(loop.thread.name, None)
+            # a loop that ran stable for backoff_max starts over at backoff_min
+            if loop.backoff is None or now - loop.time_started > self._backoff_max:
+                loop.backoff = self._backoff_min
+            else:
+                loop.backoff = min(loop.backoff * 2, self._backoff_max)
+            loop.time_restart = now + loop.backoff
+            self._logger.error(f'Loop {loop.name} crashed ({loop.error}), restart in {loop.backoff}s')
+            if loop.critical:
+                self._make_safe(loop)
+            return
+        heartbeat = heartbeats.get(loop.name)
+        if heartbeat is None:
+            return
+        time_ns, period = heartbeat
+        deadline = self._deadline_periods * period
+        late = (now_ns - time_ns) / 1e9 > deadline
+        if late and loop.state == SupervisedLoop.STATE_OK and (now_ns - self._time_resumed_ns) / 1e9 > deadline:
+            loop.state = SupervisedLoop.STATE_STALLED
+            loop.stalls += 1
+            self._logger.error(f'Loop {loop.name} missed its deadline, last heartbeat {(now_ns - time_ns) / 1e9:.3f}s ago')
+            if loop.critical:
+                self._make_safe(loop)
+        elif not late and loop.state == SupervisedLoop.STATE_STALLED:
+            loop.state = SupervisedLoop.STATE_OK
+            self._logger.warning(f'Loop {loop.name} is running again')
+
+    def check(self) -> float:
+        """Checks every loop once, returns the seconds until the next check."""
+        heartbeats = self._control_data.get_heartbeats()
+        now = self._clock.monotonic()
+        now_ns = self._clock.monotonic_ns()
+        interval = self._check_interval
+        with self._lock:
+            # a pause of the process holds up every loop, not one of them
+            if (self._time_check_ns is not None
+                    and (now_ns - self._time_check_ns) / 1e9 > self._deadline_periods * self._interval):
+                self._time_resumed_ns = now_ns
+            self._time_check_ns = now_ns
+            for loop in self._loops.values():
+                self._check_loop(loop, heartbeats, now, now_ns)
+                heartbeat = heartbeats.get(loop.name)
+                if loop.critical and heartbeat is not None and heartbeat[1] > 0:
+                    interval = min(interval, heartbeat[1])
+            self._interval = interval
+        return interval
+
+    def get_status(self) -> dict:
+        heartbeats = self._control_data.get_heartbeats()
+        now_ns = self._clock.monotonic_ns()
+        with self._lock:
+            loops = {}
+            for name, loop in self._loops.items():
+                heartbeat = heartbeats.get(name)
+                loops[name] = {
+                    'state' : loop.state,
+                    'critical' : loop.critical,
+                    'heartbeat_age' : (now_ns - heartbeat[0]) / 1e9 if heartbeat is not None else None,
+                    'period' : heartbeat[1] if heartbeat is not None else None,
+                    'restarts' : loop.restarts,
+                    'stalls' : loop.stalls,
+                    'error' : loop.error
+                }
+            down = [loop for loop in self._loops.values() if loop.state != SupervisedLoop.STATE_OK]
+            if any(loop.critical for loop in down):
+                status = 'failed'
+            elif down:
+                status = 'degraded'
+            else:
+                status = 'ok'
+            return {
+                'status' : status,
+                'loops' : loops
+            }
+
+    def join(self, names: tuple=None, timeout: float=None) -> list:
+        """
+        Joins the current thread of the loops `names`, of every loop by
+        default, within `timeout` seconds in all, after `event_run` was
+        cleared. Returns the names of the loops still running.
+        """
+        with self._lock:
+            loops = [loop for loop in self._loops.values() if names is None or loop.name in names]
+        deadline = None if timeout is None else monotonic() + timeout
+        for loop in loops:
+            loop.thread.join(None if deadline is None else max(deadline - monotonic(), 0.0))
+        return [loop.name for loop in loops if loop.thread.is_alive()]
+
+    def run(self):
+        try:
+            while self._control_data.event_run.is_set():
+                interval = self.check()
+                self._clock.wait(self._control_data.event_stop, interval)
+            self._logger.info('run event is FALSE -> Exiting')
+        except KeyboardInterrupt:
+            self._logger.info('Program stopped by user through keyboard interrupt.')
+            self._control_data.stop()
+        finally:
+            threading.excepthook = self._excepthook
@@ -0,0 +1,265 @@
+import glob
+import json
+import logging
+import math
+import os
+import pmpctrl.logging_config
+import struct
+
+from pmpctrl.clock import Clock
+from pmpctrl.command_server import CommandServer
+from pmpctrl.control_data import ControlData
+from pmpctrl.control_data import PressureSample
+from threading import Event
+from threading import Lock
+from time import gmtime
+from time import strftime
+
+
+class TraceCapture:
+    """
+    Captures the inputs and decisions of the control process into a
+    compact binary trace, for reproducing a session with TraceReplay.
+
+    A trace file starts with MAGIC, VERSION and the length of a JSON header
+    holding the settings, the names of the commands and the state of
+    ControlData when the file was started. It is followed by records of 20
+    bytes: monotonic timestamp in ns, kind, code, flags and a value.
+
+    KIND_SAMPLE is a pressure sample, KIND_STALE the sensor marking the
+    reading stale, KIND_COMMAND the command `code` of the header with its
+    argument, a method of ControlData, an event set or cleared or a method
+    of OBJECTS, KIND_EDGE a switch of actuator `code` to the state in flags
+    with the cause as value (see ControlData.ACTUATOR_* and CAUSE_*),
+    KIND_STEP a step of the loop `code` of LOOPS, told by its heartbeat.
+
+    A new file is started in `directory` with every start of the service
+    and whenever a file grows beyond `file_size_max` bytes, the oldest
+    files are deleted beyond `files_max`. Records are written one by one
+    like the actuator journal, so a crash of the process loses none.
+    """
+    MAGIC = b'PMPT'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHI')
+    RECORD = struct.Struct('<QBBBxd')
+    KIND_SAMPLE = 0
+    KIND_STALE = 1
+    KIND_COMMAND = 2
+    KIND_EDGE = 3
+    KIND_STEP = 4
+    FLAG_ARGUMENT = 0x01
+    FLAG_INTEGER = 0x02
+    # methods of the objects registered on ControlData that change the
+    # control path, resolved through get_<name>
+    OBJECTS = { 'interlock' : ('reset',) }
+    COMMANDS = (CommandServer.METHODS
+                + tuple(f'{event}.{action}' for event in CommandServer.EVENTS for action in ('set', 'clear'))
+                + tuple(f'{name}.{method}' for name, methods in OBJECTS.items() for method in methods))
+    # loops whose steps the replay follows
+    LOOPS = ('PumpControl', 'ValveControl')
+    # events of the state the replay starts from, besides get_state
+    EVENTS = ('event_pressure_stale',
+              'event_pump_state_on',
+              'event_valve_state_closed',
+              'event_interlock_tripped')
+
+    _logger: logging.Logger
+    _control_data: ControlData
+    _clock: Clock
+    _directory: str
+    _settings: dict
+    _lock: Lock
+    _fd: int
+    _path: str
+    _size: int
+    _files: int
+
+    def __init__(self,
+                 control_data: ControlData,
+                 directory: str,
+                 settings: dict=None,
+                 file_size_max: int=64 * 1024 * 1024,
+                 files_max: int=8):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._logger.setLevel(control_data.get_log_level())
+        self._control_data = control_data
+        self._clock = control_data.get_clock()
+        self._directory = directory
+        self._settings = settings if settings is not None else {}
+        self._file_size_max = file_size_max
+        self._files_max = files_max
+        self._lock = Lock()
+        self._fd = None
+        self._path = None
+        self._size = 0
+        self._files = 0
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._open()
+
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def _open(self):
+        # called with the lock held
+        if self._fd is not None:
+            os.close(self._fd)
+        self._files += 1
+        self._path = os.path.join(self._directory, f'trace-{strftime("%Y%m%dT%H%M%S", gmtime())}-{self._files:03d}.bin')
+        header = json.dumps({
+            'settings' : self._settings,
+            'commands' : self.COMMANDS,
+            'loops' : self.LOOPS,
+            'time_ns' : self._clock.monotonic_ns(),
+            'state' : self._control_data.get_state(),
+            'events' : { name : getattr(self._control_data, name).is_set() for name in self.EVENTS }
+        }).encode()
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o644)
+        data = self.HEADER.pack(self.MAGIC, self.VERSION, len(header)) + header
+        os.write(self._fd, data)
+        self._size = len(data)
+        self._logger.info(f'capturing trace to {self._path}')
+        paths = sorted(glob.glob(os.path.join(self._directory, 'trace-*.bin')))
+        for path in paths[:max(len(paths) - self._files_max, 0)]:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                self._logger.warning(f'Could not delete trace {path}: {e}')
+
+    def _append(self, time_ns: int, kind: int, code: int, flags: int, value: float):
+        record = self.RECORD.pack(time_ns, kind, code, flags, value)
+        with self._lock:
+            if self._fd is None:
+                return
+            if self._size >= self._file_size_max:
+                self._open()
+            try:
+                os.write(self._fd, record)
+            except OSError as e:
+                self._logger.error(f'Could not write trace: {e}')
+                return
+            self._size += self.RECORD.size
+
+    def add_sample(self, sample: PressureSample):
+        self._append(sample.time_ns, self.KIND_SAMPLE, 0, 0, sample.value)
+
+    def add_stale(self):
+        self._append(self._clock.monotonic_ns(), self.KIND_STALE, 0, 0, math.nan)
+
+    def add_command(self, command: str, args: tuple):
+        flags = 0
+        value = math.nan
+        if args:
+            flags = self.FLAG_ARGUMENT
+            if isinstance(args[0], int):
+                flags |= self.FLAG_INTEGER
+            value = float(args[0])
+        self._append(self._clock.monotonic_ns(), self.KIND_COMMAND, self.COMMANDS.index(command), flags, value)
+
+    def add_edge(self, time_ns: int, actuator: int, state: bool, cause: int):
+        self._append(time_ns, self.KIND_EDGE, actuator, int(state), cause)
+
+    def add_heartbeat(self, time_ns: int, name: str):
+        if name in self.LOOPS:
+            self._append(time_ns, self.KIND_STEP, self.LOOPS.index(name), 0, math.nan)
+
+    def get_path(self) -> str:
+        with self._lock:
+            return self._path
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    @classmethod
+    def read(cls, path: str) -> tuple:
+        """
+        Returns the header dict and the records (time_ns, kind, code, flags,
+        value) of a trace file, a partial record at the end is ignored.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, length = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f'{path} is no trace of version {cls.VERSION}')
+        offset = cls.HEADER.size + length
+        header = json.loads(data[cls.HEADER.size:offset])
+        end = len(data) - (len(data) - offset) % cls.RECORD.size
+        return header, list(cls.RECORD.iter_unpack(data[offset:end]))
+
+
+class CapturedEvent:
+    """Event of ControlData whose set and clear are captured as commands."""
+    def __init__(self, event: Event, trace_capture: TraceCapture, name: str):
+        self._event = event
+        self._trace_capture = trace_capture
+        self._name = name
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: float=None) -> bool:
+        return self._event.wait(timeout)
+
+    def set(self):
+        self._trace_capture.add_command(f'{self._name}.set', ())
+        self._event.set()
+
+    def clear(self):
+        self._trace_capture.add_command(f'{self._name}.clear', ())
+        self._event.clear()
+
+
+class CapturedObject:
+    """Object registered on ControlData whose calls of `methods` are captured as commands."""
+    def __init__(self, target, trace_capture: TraceCapture, name: str, methods: tuple):
+        self._target = target
+        self._trace_capture = trace_capture
+        self._name = name
+        self._methods = methods
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if name not in self._methods:
+            return attribute
+
+        def command(*args):
+            self._trace_capture.add_command(f'{self._name}.{name}', args)
+            return attribute(*args)
+        return command
+
+
+class CommandCapture:
+    """
+    Stands in for ControlData at the command interfaces, PmpctrlAPI,
+    CommandServer and LocalServer. Every call of CommandServer.METHODS,
+    every set or clear of CommandServer.EVENTS and every call of
+    TraceCapture.OBJECTS on the objects got from it is captured before it
+    is applied, everything else is passed through. The control loops keep
+    the ControlData itself, so their decisions are no commands.
+    """
+    def __init__(self, control_data: ControlData, trace_capture: TraceCapture):
+        self._control_data = control_data
+        self._trace_capture = trace_capture
+        for name in CommandServer.EVENTS:
+            setattr(self, name, CapturedEvent(getattr(control_data, name), trace_capture, name))
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._control_data, name)
+        getter, _, object_name = name.partition('get_')
+        if not getter and object_name in TraceCapture.OBJECTS:
+            def get_object():
+                target = attribute()
+                if target is None:
+                    return None
+                return CapturedObject(target, self._trace_capture, object_name, TraceCapture.OBJECTS[object_name])
+            return get_object
+        if name not in CommandServer.METHODS:
+            return attribute
+
+        def command(*args):
+            self._trace_capture.add_command(name, args)
+            return attribute(*args)
+        return command
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import json
+import logging
+import pmpctrl.logging_config
+import sys
+
+from pmpctrl.__main__ import Settings
+from pmpctrl.__main__ import apply_config
+from pmpctrl.__main__ import read_config
+from pmpctrl.auto_setpoint import AutoSetpoint
+from pmpctrl.clock import VirtualClock
+from pmpctrl.control_data import ControlData
+from pmpctrl.interlock import Interlock
+from pmpctrl.pressure_control import PressureControl
+from pmpctrl.pump_control import PumpControl
+from pmpctrl.session_control import SessionControl
+from pmpctrl.simulation import SimulatedChamber
+from pmpctrl.simulation import SimulatedGPIO
+from pmpctrl.trace_capture import TraceCapture
+from pmpctrl.valve_control import ValveControl
+from time import perf_counter
+from time import sleep
+from typing import Callable
+
+ACTUATORS = {
+    ControlData.ACTUATOR_PUMP : 'pump',
+    ControlData.ACTUATOR_VALVE : 'valve',
+    ControlData.ACTUATOR_SESSION : 'session',
+}
+
+
+class ReplayJournal:
+    """Collects the actuator edges of the replay in place of the ActuatorJournal."""
+    def __init__(self):
+        self.edges = []
+
+    def append(self, time_ns: int, session_id: int, actuator: int, state: bool, cause: int):
+        self.edges.append((time_ns, actuator, int(state), cause))
+
+
+class TraceReplay:
+    """
+    Feeds a trace of TraceCapture back into the control path on a
+    VirtualClock, to reproduce a session and to check changes of the
+    control logic against it.
+
+    ControlData starts from the state of the trace header. The recorded
+    samples, stale marks and commands, resets of the Interlock included,
+    are applied at their recorded times, each sample followed by the
+    Interlock, PressureControl and AutoSetpoint like in PressureSensor.
+    PumpControl and ValveControl step at the recorded steps of their loops,
+    driving a SimulatedGPIO, as the recorded samples follow the recorded
+    actuators: stepped on their own, the Interlock could see the chamber
+    vented with the valve still closed. SessionControl steps with its cycle
+    time. The actuator edges of the replay are then diffed against the
+    recorded ones.
+
+    The settings of the trace are used unless others are given. `speed`
+    paces the replay against the wall clock, 1.0 is real time, 0 runs as
+    fast as possible. A trace started within a session restarts its mode
+    at the beginning of the file.
+    """
+    _clock: VirtualClock
+    _queue: list
+    _order: int
+    _loops: tuple
+
+    def __init__(self, path: str, settings: Settings=None, speed: float=0.0, log_level: int=None):
+        self.header, self.records = TraceCapture.read(path)
+        self.records.sort(key=lambda record: record[0])
+        if settings is None:
+            settings = Settings()
+            for name, value in self.header['settings'].items():
+                if hasattr(Settings, name):
+                    setattr(settings, name, value)
+        if log_level is not None:
+            settings.LOG_LEVEL = log_level
+        self.settings = settings
+        self._speed = speed
+        self._commands = self.header['commands']
+
+        ControlData.reset()
+        self._clock = VirtualClock(start_ns=self.header['time_ns'])
+        self.control_data = ControlData()
+        self.control_data.set_clock(self._clock)
+        self.control_data.event_run.set()
+        apply_config(self.control_data, settings)
+        self.control_data.restore_state(self.header['state'])
+
+        self.chamber = SimulatedChamber(time_func=self._clock.monotonic)
+        self.gpio = SimulatedGPIO(self.chamber,
+                                  pin_pump=settings.PUMP_CONTROL_PIN_NUMBER,
+                                  pin_valve=settings.VALVE_CONTROL_PIN_NUMBER)
+        self.pump_control = PumpControl(control_data=self.control_data,
+                                        pin_number=settings.PUMP_CONTROL_PIN_NUMBER,
+                                        cycle_time=settings.PUMP_CONTROL_CYCLE_TIME,
+                                        gpio=self.gpio)
+        self.valve_control = ValveControl(control_data=self.control_data,
+                                          pin_number=settings.VALVE_CONTROL_PIN_NUMBER,
+                                          cycle_time=settings.VALVE_CONTROL_CYCLE_TIME,
+                                          gpio=self.gpio)
+        self.interlock = None
+        if settings.INTERLOCK_ENABLED:
+            self.interlock = Interlock(control_data=self.control_data,
+                                       pump_control=self.pump_control,
+                                       valve_control=self.valve_control,
+                                       rate_fall_max=settings.INTERLOCK_RATE_FALL_MAX,
+                                       rate_rise_max=settings.INTERLOCK_RATE_RISE_MAX,
+                                       rate_window=settings.INTERLOCK_RATE_WINDOW,
+                                       pump_on_time_max=settings.INTERLOCK_PUMP_ON_TIME_MAX)
+            self.control_data.set_interlock(self.interlock)
+        self.pressure_control = PressureControl(control_data=self.control_data,
+                                                cycle_time=settings.PRESSURE_CONTROL_CYCLE_TIME)
+        self.session_control = SessionControl(self.control_data)
+        self.auto_setpoint = AutoSetpoint(control_data=self.control_data)
+
+        # the actuators as they were when the trace was started
+        events = self.header['events']
+        if events['event_pump_state_on']:
+            self.control_data.request_pump_on()
+            self.pump_control.step()
+        if not events['event_valve_state_closed']:
+            self.control_data.request_valve_open()
+            self.valve_control.step()
+        if events['event_interlock_tripped']:
+            self.control_data.event_interlock_tripped.set()
+        self.journal = ReplayJournal()
+        self.control_data.set_actuator_journal(self.journal)
+
+        self._queue = []
+        self._order = 0
+        for record in self.records:
+            self._schedule(record[0], None, lambda record=record: self._apply(record))
+        workers = {
+            'PumpControl' : self.pump_control,
+            'ValveControl' : self.valve_control,
+        }
+        self._loops = tuple(workers[name] for name in self.header['loops'])
+        self._every(self.session_control._cycle_time, self.session_control.step)
+
+    def _schedule(self, time_ns: int, period_ns: int, action: Callable):
+        heapq.heappush(self._queue, (time_ns, self._order, period_ns, action))
+        self._order += 1
+
+    def _every(self, period: float, action: Callable):
+        period_ns = max(int(period * 1e9), 1)
+        self._schedule(self._clock.monotonic_ns(), period_ns, action)
+
+    def _apply(self, record: tuple):
+        _, kind, code, flags, value = record
+        control_data = self.control_data
+        if kind == TraceCapture.KIND_SAMPLE:
+            control_data.set_pressure_actual(value)
+            if self.interlock is not None:
+                self.interlock.check(control_data.get_pressure_sample())
+            control_data.event_pressure_stale.clear()
+            self.pressure_control.step()
+            self.auto_setpoint.step()
+        elif kind == TraceCapture.KIND_STALE:
+            control_data.event_pressure_stale.set()
+        elif kind == TraceCapture.KIND_COMMAND:
+            command = self._commands[code]
+            args = ()
+            if flags & TraceCapture.FLAG_ARGUMENT:
+                args = (int(value),) if flags & TraceCapture.FLAG_INTEGER else (value,)
+            event, _, action = command.rpartition('.')
+            if event in TraceCapture.OBJECTS:
+                # the Interlock of the replay, registered on its ControlData
+                target = getattr(control_data, f'get_{event}')()
+                if target is not None:
+                    getattr(target, action)(*args)
+            elif event:
+                getattr(getattr(control_data, event), action)()
+            else:
+                getattr(control_data, command)(*args)
+        elif kind == TraceCapture.KIND_STEP:
+            self._loops[code].step()
+
+    def run(self) -> list:
+        """Replays the whole trace, returns the edges (time_ns, actuator, state, cause) of the replay."""
+        time_end_ns = self.records[-1][0] if self.records else self._clock.monotonic_ns()
+        time_start_ns = self._clock.monotonic_ns()
+        wall_start = perf_counter()
+        while self._queue and self._queue[0][0] <= time_end_ns:
+            time_ns, order, period_ns, action = heapq.heappop(self._queue)
+            if self._speed:
+                delay = wall_start + (time_ns - time_start_ns) / 1e9 / self._speed - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            self._clock.advance_to(time_ns)
+            action()
+            if period_ns is not None:
+                self._schedule(time_ns + period_ns, period_ns, action)
+        return self.journal.edges
+
+    def get_recorded_edges(self) -> list:
+        return [(time_ns, code, flags, int(value)) for time_ns, kind, code, flags, value in self.records
+                if kind == TraceCapture.KIND_EDGE]
+
+    def diff(self, tolerance: float) -> dict:
+        """
+        Compares the edges of every actuator in order: an edge matches if
+        state and cause are equal and it happened within `tolerance`
+        seconds of the recorded one. Reports the earliest divergence.
+        """
+        recorded = self.get_recorded_edges()
+        replayed = self.journal.edges
+        time_start_ns = self.header['time_ns']
+        matched = 0
+        offset_max = 0.0
+        divergence = None
+
+        def edge(record: tuple) -> dict:
+            if record is None:
+                return None
+            time_ns, _, state, cause = record
+            return { 'time' : (time_ns - time_start_ns) / 1e9, 'state' : bool(state), 'cause' : cause }
+
+        for actuator, name in ACTUATORS.items():
+            edges_recorded = [record for record in recorded if record[1] == actuator]
+            edges_replayed = [record for record in replayed if record[1] == actuator]
+            for index in range(max(len(edges_recorded), len(edges_replayed))):
+                edge_recorded = edges_recorded[index] if index < len(edges_recorded) else None
+                edge_replayed = edges_replayed[index] if index < len(edges_replayed) else None
+                if edge_recorded is not None and edge_replayed is not None:
+                    offset = abs(edge_replayed[0] - edge_recorded[0]) / 1e9
+                    if edge_recorded[2:] == edge_replayed[2:] and offset <= tolerance:
+                        matched += 1
+                        offset_max = max(offset_max, offset)
+                        continue
+                time_ns = min(record[0] for record in (edge_recorded, edge_replayed) if record is not None)
+                if divergence is None or time_ns < divergence[0]:
+                    divergence = (time_ns, {
+                        'time' : (time_ns - time_start_ns) / 1e9,
+                        'actuator' : name,
+                        'index' : index,
+                        'recorded' : edge(edge_recorded),
+                        'replayed' : edge(edge_replayed)
+                    })
+                break
+        return {
+            'edges_recorded' : len(recorded),
+            'edges_replayed' : len(replayed),
+            'edges_matched' : matched,
+            'time_offset_max' : offset_max,
+            'tolerance' : tolerance,
+            'divergence' : divergence[1] if divergence is not None else None
+        }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Replays a captured trace and diffs the actuator decisions.')
+    parser.add_argument('trace', help='trace file of [capture] directory')
+    parser.add_argument('-c', '--config', help='config file, defaults to the settings of the trace')
+    parser.add_argument('-x', '--speed', help='speed against the wall clock, 0 as fast as possible', type=float, default=0.0)
+    parser.add_argument('-t', '--tolerance', help='seconds an edge may move, defaults to the longest actuator cycle plus the sensor cycle',
+                        type=float, default=None)
+    parser.add_argument('-v', '--verbose', help='log the control loops', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    settings = read_config(args.config) if args.config else None
+    replay = TraceReplay(args.trace, settings=settings, speed=args.speed,
+                         log_level=None if args.verbose else logging.WARNING)
+    settings = replay.settings
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = max(settings.PUMP_CONTROL_CYCLE_TIME, settings.VALVE_CONTROL_CYCLE_TIME) + settings.PRESSURE_SENSOR_CYCLE_TIME
+
+    time_start = perf_counter()
+    replay.run()
+    time_wall = perf_counter() - time_start
+
+    kinds = {}
+    for record in replay.records:
+        kinds[record[1]] = kinds.get(record[1], 0) + 1
+    duration = (replay.records[-1][0] - replay.header['time_ns']) / 1e9 if replay.records else 0.0
+    summary = {
+        'trace' : args.trace,
+        'duration' : duration,
+        'time_wall' : time_wall,
+        'speedup' : duration / time_wall if time_wall > 0 else None,
+        'samples' : kinds.get(TraceCapture.KIND_SAMPLE, 0),
+        'stale' : kinds.get(TraceCapture.KIND_STALE, 0),
+        'commands' : kinds.get(TraceCapture.KIND_COMMAND, 0),
+        'steps' : kinds.get(TraceCapture.KIND_STEP, 0),
+        **replay.diff(tolerance)
+    }
+    print(json.dumps(summary, indent=2))
+    # a divergence fails, e.g. for git bisect run
+    sys.exit(0 if summary['divergence'] is None else 1)
+
+
+if __name__ == '__main__':
+    main()
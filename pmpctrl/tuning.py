@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import logging
+import os
+import pmpctrl.logging_config
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from pmpctrl.__main__ import Settings
+from pmpctrl.__main__ import read_config
+from pmpctrl.control_data import ControlData
+from pmpctrl.simulation import Simulation
+from time import perf_counter
+
+# config.ini keys that can be swept, mapped to the Settings they set
+PARAMETERS = {
+    'pressure_control.tolerance_plus' : 'PRESSURE_CONTROL_TOLERANCE_PLUS',
+    'pressure_control.tolerance_minus' : 'PRESSURE_CONTROL_TOLERANCE_MINUS',
+    'pressure_control.cycle_time' : 'PRESSURE_CONTROL_CYCLE_TIME',
+    'pressure_sensor.cycle_time' : 'PRESSURE_SENSOR_CYCLE_TIME',
+    'pump_control.cycle_time' : 'PUMP_CONTROL_CYCLE_TIME',
+    'valve_control.cycle_time' : 'VALVE_CONTROL_CYCLE_TIME',
+    'mode_interval.peak_pressure' : 'MODE_INTERVAL_PEAK_PRESSURE',
+    'mode_interval.interval_time' : 'MODE_INTERVAL_TIME',
+    'mode_pulsating.pump_time' : 'MODE_PULSATING_PUMP_TIME',
+    'mode_pulsating.release_time' : 'MODE_PULSATING_RELEASE_TIME',
+}
+
+MODES = {
+    'hold' : ControlData.MODE_PRESSURE_HOLD,
+    'interval' : ControlData.MODE_INTERVAL,
+    'pulsating' : ControlData.MODE_PULSATING,
+}
+
+# time before the session starts, lets the sensor settle
+SESSION_START = 1.0
+
+
+def parse_range(text: str) -> list:
+    """
+    Parses `start:stop:step` (stop included) or a comma separated list of
+    values.
+    """
+    if ':' in text:
+        start, stop, step = (float(value) for value in text.split(':'))
+        if step <= 0:
+            raise ValueError(f'step of {text} must be positive')
+        count = int(round((stop - start) / step)) + 1
+        return [round(start + i * step, 9) for i in range(max(count, 1))]
+    return [float(value) for value in text.split(',')]
+
+
+def parse_parameter(text: str) -> tuple:
+    name, _, values = text.partition('=')
+    if name not in PARAMETERS:
+        raise argparse.ArgumentTypeError(f'unknown parameter {name}, one of: {", ".join(PARAMETERS)}')
+    try:
+        return name, parse_range(values)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'invalid range for {name}: {e}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Sweeps controller parameters over simulated sessions.')
+    parser.add_argument('-p', '--param', help='SECTION.KEY=START:STOP:STEP or SECTION.KEY=V1,V2,...',
+                        type=parse_parameter, action='append', required=True)
+    parser.add_argument('-c', '--config', help='config file with the base settings, defaults to the built-in settings')
+    parser.add_argument('-m', '--mode', help='session mode', choices=list(MODES), default='hold')
+    parser.add_argument('-d', '--duration', help='session duration in seconds', type=float, default=600.0)
+    parser.add_argument('-t', '--target', help='pressure target', type=float, default=875.0)
+    parser.add_argument('-b', '--band', help='half width of the band around the target to score against',
+                        type=float, default=10.0)
+    parser.add_argument('-s', '--seed', help='seed of the sensor noise', type=int, default=0)
+    parser.add_argument('-w', '--workers', help='worker processes', type=int, default=os.cpu_count())
+    parser.add_argument('-n', '--top', help='rows of the ranked table', type=int, default=10)
+    parser.add_argument('--weight-overshoot', help='score penalty per mbar of overshoot', type=float, default=1.0)
+    parser.add_argument('--weight-actuations', help='score penalty per actuation per minute', type=float, default=1.0)
+    parser.add_argument('--weight-settling', help='score penalty per second of settling time', type=float, default=0.1)
+    return parser.parse_args()
+
+
+def evaluate(trace: list, band: float) -> dict:
+    """
+    Time in band, settling time and overshoot of the session part of a
+    trace. Overshoot is the largest excursion beyond the band once the
+    pressure settled into it.
+    """
+    records = [record for record in trace if record.session_on]
+    if not records:
+        return { 'time_in_band' : 0.0, 'settling_time' : None, 'overshoot' : None }
+    in_band = [abs(record.pressure - record.pressure_target) <= band for record in records]
+    settled = next((i for i, value in enumerate(in_band) if value), None)
+    if settled is None:
+        return { 'time_in_band' : 0.0, 'settling_time' : None, 'overshoot' : None }
+    overshoot = max(abs(record.pressure - record.pressure_target) - band for record in records[settled:])
+    return {
+        'time_in_band' : sum(in_band) / len(in_band),
+        'settling_time' : records[settled].time - records[0].time,
+        'overshoot' : max(overshoot, 0.0),
+    }
+
+
+def run_session(parameters: dict, config_file: str, mode: str, duration: float,
+                target: float, band: float, seed: int) -> dict:
+    """Runs one simulated session, executed in a worker process."""
+    settings = read_config(config_file) if config_file else Settings()
+    for name, value in parameters.items():
+        setattr(settings, PARAMETERS[name], value)
+    # the sweep would otherwise drown in the log output of every run
+    settings.LOG_LEVEL = logging.ERROR
+
+    simulation = Simulation(settings=settings, seed=seed, trace_interval=0.1)
+    control_data = simulation.control_data
+    control_data.set_mode(MODES[mode])
+    control_data.set_pressure_target(target)
+    simulation.at(SESSION_START, control_data.start_session)
+    simulation.at(SESSION_START + duration, control_data.stop_session)
+    trace = simulation.run(SESSION_START + duration)
+
+    result = evaluate(trace, band)
+    result['parameters'] = parameters
+    result['pump_starts'] = simulation.gpio.starts.get(settings.PUMP_CONTROL_PIN_NUMBER, 0)
+    result['valve_starts'] = simulation.gpio.starts.get(settings.VALVE_CONTROL_PIN_NUMBER, 0)
+    result['actuations_per_minute'] = (result['pump_starts'] + result['valve_starts']) / duration * 60
+    return result
+
+
+def score(result: dict, args) -> float:
+    """Higher is better, time in band counts 100 points at most."""
+    if result['settling_time'] is None:
+        return float('-inf')
+    return (result['time_in_band'] * 100
+            - result['overshoot'] * args.weight_overshoot
+            - result['actuations_per_minute'] * args.weight_actuations
+            - result['settling_time'] * args.weight_settling)
+
+
+def format_table(results: list, names: list) -> str:
+    columns = ['rank', 'score', 'in_band', 'settle_s', 'overshoot', 'act/min'] + names
+    rows = []
+    for rank, result in enumerate(results, 1):
+        settling_time = result['settling_time']
+        overshoot = result['overshoot']
+        rows.append([str(rank),
+                     f'{result["score"]:.2f}',
+                     f'{result["time_in_band"] * 100:.1f}%',
+                     f'{settling_time:.1f}' if settling_time is not None else '-',
+                     f'{overshoot:.2f}' if overshoot is not None else '-',
+                     f'{result["actuations_per_minute"]:.2f}']
+                    + [f'{result["parameters"][name]:g}' for name in names])
+    widths = [max(len(row[i]) for row in rows + [columns]) for i in range(len(columns))]
+    lines = ['  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in [columns] + rows]
+    return '\n'.join(lines)
+
+
+def format_config(parameters: dict) -> str:
+    sections = {}
+    for name, value in parameters.items():
+        section, key = name.split('.')
+        sections.setdefault(section, []).append(f'{key} = {value:g}')
+    return '\n\n'.join(f'[{section}]\n' + '\n'.join(lines) for section, lines in sections.items())
+
+
+def main():
+    args = parse_arguments()
+    names = [name for name, _ in args.param]
+    grid = [dict(zip(names, values)) for values in itertools.product(*(values for _, values in args.param))]
+    print(f'running {len(grid)} simulated sessions of {args.duration:g}s on {args.workers} workers', file=sys.stderr)
+
+    time_start = perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_session, parameters, args.config, args.mode, args.duration,
+                                   args.target, args.band, args.seed)
+                   for parameters in grid]
+        results = [future.result() for future in futures]
+    time_wall = perf_counter() - time_start
+
+    for result in results:
+        result['score'] = score(result, args)
+    results.sort(key=lambda result: result['score'], reverse=True)
+
+    print(format_table(results[:args.top], names))
+    print(f'\n{len(grid)} sessions, {len(grid) * args.duration / 3600:.1f}h simulated in {time_wall:.1f}s', file=sys.stderr)
+    if results[0]['score'] == float('-inf'):
+        print('\nno parameter set settled into the band, no recommendation', file=sys.stderr)
+        return
+    print('\n# recommended')
+    print(format_config(results[0]['parameters']))
+
+
+if __name__ == '__main__':
+    main()
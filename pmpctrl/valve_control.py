@@ -1,60 +1,134 @@
 import logging
 import pmpctrl.logging_config
-import RPi.GPIO as GPIO
 
+from pmpctrl.clock import Clock
 from pmpctrl.control_data import ControlData
-from time import sleep
+from threading import Lock
 
 class ValveControl:
     _logger: logging.Logger
     _control_data: ControlData
     _cycle_time: float
+    _idle_cycle_time: float
     _pin_number: int
+    _clock: Clock
+    _lock: Lock
 
     
     def __init__(self,
                  control_data: ControlData,
                  pin_number: int,
-                 cycle_time: float=0.1):
+                 cycle_time: float=0.1,
+                 gpio=None,
+                 idle_cycle_time: float=0.5):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(control_data.get_log_level())
         self._control_data = control_data
         self._cycle_time = cycle_time
+        # requests wake the loop through event_active
+        self._idle_cycle_time = idle_cycle_time
         self._pin_number = pin_number
+        self._clock = control_data.get_clock()
+        # a forced opening must not interleave with a step closing
+        self._lock = Lock()
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self._gpio = gpio
         
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self._pin_number, GPIO.OUT)
-        GPIO.output(self._pin_number, GPIO.LOW)
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setup(self._pin_number, self._gpio.OUT)
+        self._gpio.output(self._pin_number, self._gpio.LOW)
         
    
+    def set_log_level(self, log_level: int):
+        self._logger.setLevel(log_level)
+
+    def set_cycle_time(self, cycle_time: float):
+        self._cycle_time = cycle_time
+
     def _open_valve(self) -> None:
         self._logger.info('openeing valve')
-        GPIO.output(self._pin_number, GPIO.HIGH)
+        self._gpio.output(self._pin_number, self._gpio.HIGH)
+        if self._control_data.event_valve_state_closed.is_set():
+            self._control_data.add_actuator_edge(ControlData.ACTUATOR_VALVE, True)
         self._control_data.event_valve_state_closed.clear()
         self._control_data.event_valve_open.clear()
 
     
     def _close_valve(self) -> None:
         self._logger.info('closing valve')
-        GPIO.output(self._pin_number, GPIO.LOW)
+        self._gpio.output(self._pin_number, self._gpio.LOW)
+        if not self._control_data.event_valve_state_closed.is_set():
+            self._control_data.add_actuator_edge(ControlData.ACTUATOR_VALVE, False)
         self._control_data.event_valve_state_closed.set()
         self._control_data.event_valve_close.clear()
 
 
-    def run(self) -> None:
+    def force_open(self, cause: int, timeout: float=0.1) -> None:
+        """
+        Opens the valve right away, called from the thread of the Interlock
+        or the Supervisor. A loop stuck within its step for `timeout`
+        seconds does not block the caller, the pin is then driven HIGH
+        regardless and the valve loop opens the valve once it returns.
+        """
+        self._control_data.request_valve_open(cause)
+        if not self._lock.acquire(timeout=timeout):
+            self._logger.error('Valve loop is stuck within a step -> setting pin HIGH regardless')
+            self._gpio.output(self._pin_number, self._gpio.HIGH)
+            return
         try:
-            while self._control_data.event_run.is_set():
-                if self._control_data.event_valve_open.is_set():
-                    self._logger.debug('EVENT_VALVE_OPEN is set -> openeing valve')
-                    self._open_valve()
-                if self._control_data.event_valve_close.is_set():
+            self._open_valve()
+        finally:
+            self._lock.release()
+
+
+    def shutdown(self, timeout: float=1.0) -> None:
+        """
+        Closes the valve for good and releases the pin, called by the
+        shutdown of the service once the loop exited and the pump is off.
+        A loop stuck within its step for `timeout` seconds does not keep
+        the valve powered, the pin is then driven LOW regardless.
+        """
+        if not self._lock.acquire(timeout=timeout):
+            self._logger.error('Valve loop is stuck within a step -> setting pin LOW regardless')
+            self._gpio.output(self._pin_number, self._gpio.LOW)
+            return
+        try:
+            self._control_data.request_valve_close(ControlData.CAUSE_SHUTDOWN)
+            self._close_valve()
+            self._gpio.cleanup(self._pin_number)
+        finally:
+            self._lock.release()
+
+    def step(self) -> None:
+        with self._lock:
+            if self._control_data.event_valve_open.is_set():
+                self._logger.debug('EVENT_VALVE_OPEN is set -> openeing valve')
+                self._open_valve()
+            if self._control_data.event_valve_close.is_set():
+                if self._control_data.event_interlock_tripped.is_set():
+                    # the chamber stays vented until the interlock is reset
+                    self._logger.warning('Interlock is tripped -> ignoring request to close valve')
+                    self._control_data.event_valve_close.clear()
+                else:
                     self._logger.debug('EVENT_VALVE_CLOSE is set -> closing valve')
                     self._close_valve()
-                sleep(self._cycle_time)
+
+
+    def run(self) -> None:
+        # after a crash the Supervisor vents the chamber and restarts the
+        # loop, after a stop the shutdown of the service calls shutdown once
+        # the pump is off, the loop leaves the pin alone either way
+        try:
+            while self._control_data.event_run.is_set():
+                self.step()
+                if self._control_data.event_active.is_set():
+                    self._control_data.heartbeat(self.__class__.__name__, self._cycle_time)
+                    self._clock.wait(self._control_data.event_stop, self._cycle_time)
+                else:
+                    self._control_data.heartbeat(self.__class__.__name__, self._idle_cycle_time)
+                    self._clock.wait(self._control_data.event_active, self._idle_cycle_time)
             self._logger.info('run event is FALSE -> Exiting')
         except KeyboardInterrupt:
             self._logger.info('Program stopped by user through keyboard interrupt.')
-            self._control_data.event_run.clear()
-        finally:
-            self._close_valve()
-            GPIO.cleanup(self._pin_number)
\ No newline at end of file
+            self._control_data.stop()